@@ -0,0 +1,37 @@
+import pyarrow as pa
+
+# Arrow schemas of the online store datasets, shared by the CSV converters and the Parquet output of
+# dataset_generator_online_store.py
+BROWSING_SCHEMA = pa.schema([
+    ('ip', pa.string()),
+    ('ts', pa.timestamp('us')),
+    ('tz', pa.string()),
+    ('verb', pa.string()),
+    ('resource_type', pa.string()),
+    ('resource_fk', pa.string()),
+    ('response', pa.int32()),
+    ('browser', pa.string()),
+    ('os', pa.string()),
+    ('customer', pa.int64()),
+    ('d_day_name', pa.string()),
+    ('i_current_price', pa.float64()),
+    ('i_category', pa.string()),
+    ('i_description', pa.string()),
+    ('c_preferred_cust_flag', pa.bool_()),
+    ('ds', pa.date32())
+])
+
+TRANSACTION_SCHEMA = pa.schema([
+    ('client_id', pa.int64()),
+    ('transaction_id', pa.string()),
+    ('item_id', pa.string()),
+    ('transaction_date', pa.timestamp('us')),
+    ('country', pa.string()),
+    ('customer_type', pa.string()),
+    ('item_description', pa.string()),
+    ('category', pa.string()),
+    ('quantity', pa.int32()),
+    ('total_amount', pa.float64()),
+    ('marketing_campaign', pa.string()),
+    ('returned', pa.bool_())
+])
@@ -0,0 +1,293 @@
+import os
+import glob
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+
+DEFAULT_ROW_GROUP_ROWS = 1000000
+DEFAULT_BLOCK_SIZE = 16 * 1024 * 1024
+# Rows buffered over all partitions of a partitioned conversion, beyond it the largest buffers are written early
+DEFAULT_MAX_BUFFERED_ROWS = DEFAULT_ROW_GROUP_ROWS
+# Leading underscore so that Trino and Spark skip the manifest when listing the dataset
+MANIFEST_FILE = '_manifest.json'
+# Directory name Hive and Trino give the partition of null values
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+
+def csv_stream(input_file, schema, timestamp_format, block_size=DEFAULT_BLOCK_SIZE):
+    """ Incremental reader of a CSV file that parses every column to its type in schema while reading
+
+    Timestamps are parsed with timestamp_format, empty strings are read as nulls like pd.read_csv does.
+    """
+    read_options = pv.ReadOptions(block_size=block_size)
+    convert_options = pv.ConvertOptions(
+        column_types=schema,
+        include_columns=schema.names,
+        timestamp_parsers=[timestamp_format],
+        strings_can_be_null=True
+    )
+    return pv.open_csv(input_file, read_options=read_options, convert_options=convert_options)
+
+
+class RowGroupWriter:
+    """ A ParquetWriter that buffers batches and writes them as row groups of row_group_rows rows once they fill
+
+    parquet_options are passed to the ParquetWriter, e.g. compression, compression_level and use_dictionary.
+    """
+
+    def __init__(self, path, schema, row_group_rows=DEFAULT_ROW_GROUP_ROWS, **parquet_options):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.schema = schema
+        self.row_group_rows = row_group_rows
+        self.writer = pq.ParquetWriter(path, schema, **parquet_options)
+        self.buffered = []
+        self.buffered_rows = 0
+        self.rows = 0
+
+    def write(self, batch):
+        self.buffered.append(batch)
+        self.buffered_rows += batch.num_rows
+        if self.buffered_rows >= self.row_group_rows:
+            table = pa.Table.from_batches(self.buffered, schema=self.schema)
+            full_rows = self.buffered_rows - self.buffered_rows % self.row_group_rows
+            self.writer.write_table(table.slice(0, full_rows), row_group_size=self.row_group_rows)
+            self.buffered = table.slice(full_rows).to_batches()
+            self.buffered_rows -= full_rows
+            self.rows += full_rows
+
+    def flush(self):
+        """ Write the buffered rows as a row group shorter than row_group_rows """
+        if self.buffered_rows:
+            self.writer.write_table(pa.Table.from_batches(self.buffered, schema=self.schema), row_group_size=self.row_group_rows)
+            self.rows += self.buffered_rows
+            self.buffered = []
+            self.buffered_rows = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        return self.rows
+
+
+def partition_slices(batch, partition_by):
+    """ Split a batch by the values of the partition_by column, returned as (value, batch without the column)
+
+    Every partition is taken into its own buffers, a slice would keep the whole batch alive while it is buffered.
+    """
+    indices = pc.sort_indices(batch, [(partition_by, 'ascending')])
+    values = batch.column(partition_by).take(indices)
+    columns = batch.select([name for name in batch.schema.names if name != partition_by])
+    offset = 0
+    for counts in pc.value_counts(values):
+        count = counts['counts'].as_py()
+        yield counts['values'].as_py(), columns.take(indices.slice(offset, count))
+        offset += count
+
+
+def flush_largest(writers, max_buffered_rows):
+    """ Write the largest partition buffers early once all of them hold max_buffered_rows, until half is free """
+    buffered_rows = sum(writer.buffered_rows for writer in writers.values())
+    if buffered_rows < max_buffered_rows:
+        return
+    for writer in sorted(writers.values(), key=lambda writer: writer.buffered_rows, reverse=True):
+        if buffered_rows < max_buffered_rows // 2:
+            break
+        buffered_rows -= writer.buffered_rows
+        writer.flush()
+
+
+def convert(input_files, output, schema, timestamp_format='%Y-%m-%d %H:%M:%S', row_group_rows=DEFAULT_ROW_GROUP_ROWS,
+            block_size=DEFAULT_BLOCK_SIZE, partition_by=None, file_name=None, max_buffered_rows=DEFAULT_MAX_BUFFERED_ROWS,
+            **parquet_options):
+    """ Convert one CSV file, or several into the same output files, to Parquet one block at a time
+
+    Parsed batches are buffered until they fill a row group of row_group_rows rows, which is then written, so peak
+    memory is about one row group plus one block. With partition_by, output is the root of a Hive style dataset and
+    the rows go to output/<partition_by>=<value>/file_name without the partition column, with a buffer per partition.
+    The partition buffers together hold at most max_buffered_rows rows, beyond it the largest are written as shorter
+    row groups. Returns the rows written, the elapsed seconds and the input files of each written file.
+    """
+    start = time.perf_counter()
+    if isinstance(input_files, str):
+        input_files = [input_files]
+    if partition_by:
+        file_schema = schema.remove(schema.get_field_index(partition_by))
+        file_name = file_name or os.path.splitext(os.path.basename(input_files[0]))[0] + '.parquet'
+    writers = {}
+    sources = {}
+    try:
+        for input_file in input_files:
+            for batch in csv_stream(input_file, schema, timestamp_format, block_size):
+                # open_csv returns the columns in file order, the Parquet files keep the order of the schema
+                batch = batch.select(schema.names)
+                if not partition_by:
+                    if None not in writers:
+                        writers[None] = RowGroupWriter(output, schema, row_group_rows, **parquet_options)
+                    writers[None].write(batch)
+                    sources.setdefault(None, set()).add(input_file)
+                    continue
+                for value, partition in partition_slices(batch, partition_by):
+                    if value not in writers:
+                        path = os.path.join(output, f"{partition_by}={NULL_PARTITION if value is None else value}", file_name)
+                        writers[value] = RowGroupWriter(path, file_schema, row_group_rows, **parquet_options)
+                    writers[value].write(partition)
+                    sources.setdefault(value, set()).add(input_file)
+                flush_largest(writers, max_buffered_rows)
+        if not writers and not partition_by:
+            # A CSV file with only a header still gives an empty Parquet file, as the pandas conversion did
+            writers[None] = RowGroupWriter(output, schema, row_group_rows, **parquet_options)
+    finally:
+        rows = sum(writer.close() for writer in writers.values())
+    return rows, time.perf_counter() - start, {writer.path: sorted(sources.get(value, input_files)) for value, writer in writers.items()}
+
+
+def report(input_file, output_file, rows, elapsed, input_bytes=None):
+    input_bytes = os.path.getsize(input_file) if input_bytes is None else input_bytes
+    print(f"Converted '{input_file}' to '{output_file}' successfully: {rows} rows, {input_bytes} bytes in {elapsed:.2f}s, "
+          f"{rows / elapsed:,.0f} rows/s, {input_bytes / elapsed / 1024 / 1024:,.1f} MiB/s")
+
+
+def input_files(input_path):
+    """ The CSV files of a file, a directory or a glob pattern, sorted """
+    if os.path.isdir(input_path):
+        return sorted(glob.glob(os.path.join(input_path, '*.csv')))
+    return sorted(glob.glob(input_path))
+
+
+def file_statistics(path):
+    """ Row count, size and per column min, max and null count of a Parquet file, from the row group statistics """
+    metadata = pq.read_metadata(path)
+    columns = {}
+    for index in range(metadata.num_row_groups):
+        row_group = metadata.row_group(index)
+        for column_index in range(row_group.num_columns):
+            column = row_group.column(column_index)
+            stats = column.statistics
+            if stats is None:
+                continue
+            entry = columns.setdefault(column.path_in_schema, {'min': None, 'max': None, 'null_count': 0})
+            entry['null_count'] += stats.null_count
+            if stats.has_min_max:
+                entry['min'] = stats.min if entry['min'] is None else min(entry['min'], stats.min)
+                entry['max'] = stats.max if entry['max'] is None else max(entry['max'], stats.max)
+    for entry in columns.values():
+        entry['min'], entry['max'] = [None if value is None else str(value) for value in (entry['min'], entry['max'])]
+    return {'rows': metadata.num_rows, 'size_bytes': os.path.getsize(path), 'columns': columns}
+
+
+def manifest_entries(outputs, output_dir, partition_by):
+    entries = []
+    for path, sources in sorted(outputs.items()):
+        entry = {'path': os.path.relpath(path, output_dir), 'sources': sources}
+        if partition_by:
+            entry['partition'] = {partition_by: os.path.basename(os.path.dirname(path)).split('=', 1)[1]}
+        entry.update(file_statistics(path))
+        entries.append(entry)
+    return entries
+
+
+def convert_file(input_file, output_dir, schema, options):
+    """ Flat batch mode task of one input file, returns the manifest entries of its output file """
+    output = os.path.join(output_dir, os.path.splitext(os.path.basename(input_file))[0] + '.parquet')
+    rows, elapsed, outputs = convert(input_file, output, schema, **options)
+    report(input_file, output, rows, elapsed)
+    return manifest_entries(outputs, output_dir, None)
+
+
+def convert_group(index, files, output_dir, schema, partition_by, options):
+    """ Partitioned batch mode task of a group of input files, written to one part-<index>.parquet file per partition """
+    rows, elapsed, outputs = convert(files, output_dir, schema, partition_by=partition_by, file_name=f"part-{index:05d}.parquet", **options)
+    report(f"{len(files)} files", output_dir, rows, elapsed, sum(os.path.getsize(input_file) for input_file in files))
+    return manifest_entries(outputs, output_dir, partition_by)
+
+
+def file_groups(files, groups):
+    """ Split the files into groups of about the same total size, largest files first """
+    sized = sorted(files, key=os.path.getsize, reverse=True)
+    buckets = [[] for _ in range(min(groups, len(files)))]
+    sizes = [0] * len(buckets)
+    for input_file in sized:
+        smallest = sizes.index(min(sizes))
+        buckets[smallest].append(input_file)
+        sizes[smallest] += os.path.getsize(input_file)
+    return [sorted(bucket) for bucket in buckets]
+
+
+def convert_batch(files, output_dir, schema, partition_by=None, processes=None, **options):
+    """ Convert many CSV files into output_dir on a process pool and write the dataset's manifest
+
+    Flat, every input file is one task that writes its own output file, named after it. Partitioned, the files are
+    split into one group per process, and each group task merges its files into one file per partition, so a
+    partition gets a file per process instead of a small file per input. Tasks never share a file.
+    """
+    start = time.perf_counter()
+    processes = processes or os.cpu_count()
+    print(f"Converting {len(files)} files into '{output_dir}' with {processes} processes")
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        if partition_by:
+            futures = [
+                executor.submit(convert_group, index, group, output_dir, schema, partition_by, options)
+                for index, group in enumerate(file_groups(files, processes))
+            ]
+        else:
+            futures = [executor.submit(convert_file, input_file, output_dir, schema, options) for input_file in files]
+        entries = [entry for future in futures for entry in future.result()]
+    elapsed = time.perf_counter() - start
+
+    manifest = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'partitioned_by': [partition_by] if partition_by else [],
+        'options': {name: value for name, value in options.items() if name in ('compression', 'compression_level', 'use_dictionary', 'row_group_rows')},
+        'inputs': files,
+        'rows': sum(entry['rows'] for entry in entries),
+        'files': entries
+    }
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, MANIFEST_FILE), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    report(f"{len(files)} files", output_dir, manifest['rows'], elapsed, sum(os.path.getsize(input_file) for input_file in files))
+    return manifest
+
+
+def add_arguments(parser):
+    parser.add_argument('input', help='CSV file, directory of CSV files or glob pattern, quoted so the shell does not expand it')
+    parser.add_argument('--output-dir', help='Batch mode: convert every input file into this directory on a process pool and write a manifest')
+    parser.add_argument('--processes', type=int, help='Worker processes of the batch mode, defaults to the number of cores')
+    parser.add_argument('--compression', default='snappy', help='Parquet compression codec, e.g. snappy, zstd, gzip or none')
+    parser.add_argument('--compression-level', type=int, help='Level of codecs that have one, e.g. 1 to 22 for zstd')
+    parser.add_argument('--dictionary-columns', nargs='*', help='Dictionary encode only these columns, none if the list is empty, all by default')
+    parser.add_argument('--row-group-rows', type=int, default=DEFAULT_ROW_GROUP_ROWS, help='Rows per Parquet row group')
+    parser.add_argument('--max-buffered-rows', type=int, default=DEFAULT_MAX_BUFFERED_ROWS,
+                        help='Rows buffered over all partitions of a partitioned conversion before the largest are written early')
+    parser.add_argument('--block-size', type=int, default=DEFAULT_BLOCK_SIZE, help='Bytes of CSV parsed per batch')
+
+
+def run(parser, args, schema, partition_by=None):
+    """ Convert the input of the parsed arguments, in batch mode when an output directory is given
+
+    The flat single file mode writes the Parquet file next to the CSV file, the batch mode partitions the files by
+    partition_by when it is set.
+    """
+    files = input_files(args.input)
+    if not files:
+        parser.error(f"No CSV files found for '{args.input}'")
+    options = {
+        'row_group_rows': args.row_group_rows,
+        'block_size': args.block_size,
+        'max_buffered_rows': args.max_buffered_rows,
+        'compression': args.compression,
+        'compression_level': args.compression_level,
+        'use_dictionary': True if args.dictionary_columns is None else args.dictionary_columns or False
+    }
+    if args.output_dir:
+        return convert_batch(files, args.output_dir, schema, partition_by, args.processes, **options)
+    if len(files) > 1:
+        parser.error(f"'{args.input}' matches {len(files)} files, use --output-dir to convert them in batch mode")
+    output_file = os.path.splitext(files[0])[0] + '.parquet'
+    rows, elapsed, _ = convert(files[0], output_file, schema, **options)
+    report(files[0], output_file, rows, elapsed)
@@ -1,9 +1,16 @@
 import pandas as pd
+import numpy as np
 from faker import Faker
 import random
 from datetime import datetime, timedelta
 import calendar
 import argparse
+import logging
+import vectorized_online_store
+import sharded_generation
+import parquet_output
+
+logging.basicConfig(level=logging.INFO)
 
 # Initialize Faker
 fake = Faker()
@@ -122,18 +129,124 @@ def generate_transactions(clients, items, browsing_logs):
         })
     return pd.DataFrame(transactions)
 
+def output_paths(output_format, partition_by_ds):
+    """ Browsing and transaction output paths of a run, the browsing path is a directory of ds partitions with partition_by_ds """
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    extension = '.parquet' if output_format == 'parquet' else '.csv'
+    browsing_path = f'browsing_data_{timestamp}' + ('' if partition_by_ds else extension)
+    return browsing_path, f'transaction_data_{timestamp}{extension}'
+
+def generate_shard(shard_id, num_shards, start, stop, chunk_rows, seed, clients, items, now, browsing_path, transaction_path,
+                   output_format='csv', partition_by_ds=False):
+    """ Generate the views [start, stop) of one shard and their transactions, appending them chunk by chunk to the
+    shard's own CSV or Parquet files """
+    rng = sharded_generation.shard_rng(seed, shard_id)
+    transaction_path = sharded_generation.shard_file_name(transaction_path, shard_id, num_shards)
+    if output_format == 'parquet':
+        if partition_by_ds:
+            browsing_output = parquet_output.ParquetOutput(browsing_path, parquet_output.BROWSING_SCHEMA, True,
+                                                           sharded_generation.shard_file_name('part.parquet', shard_id, num_shards))
+        else:
+            browsing_path = sharded_generation.shard_file_name(browsing_path, shard_id, num_shards)
+            browsing_output = parquet_output.ParquetOutput(browsing_path, parquet_output.BROWSING_SCHEMA)
+        transaction_output = parquet_output.ParquetOutput(transaction_path, parquet_output.TRANSACTION_SCHEMA)
+    else:
+        browsing_path = sharded_generation.shard_file_name(browsing_path, shard_id, num_shards)
+    rows = 0
+    for index, (chunk_start, chunk_stop) in enumerate(sharded_generation.chunk_ranges(start, stop, chunk_rows)):
+        browsing = vectorized_online_store.browsing_log_columns(rng, clients, items, chunk_stop - chunk_start, now)
+        transactions = vectorized_online_store.transaction_columns(rng, clients, items, browsing)
+        if output_format == 'parquet':
+            browsing_output.write(browsing)
+            transaction_output.write(transactions)
+        else:
+            mode = 'w' if index == 0 else 'a'
+            vectorized_online_store.text_frame(browsing).to_csv(browsing_path, mode=mode, header=index == 0, index=False)
+            vectorized_online_store.text_frame(transactions).to_csv(transaction_path, mode=mode, header=index == 0, index=False)
+        rows += len(browsing['ts'])
+    if output_format == 'parquet':
+        browsing_output.close()
+        transaction_output.close()
+    logging.info(f"Shard {shard_id}: {rows} browsing logs and transactions saved to {browsing_path} and {transaction_path}")
+    return rows
+
 def main():
     parser = argparse.ArgumentParser(description='Generate retail datasets with realistic trends.')
     parser.add_argument('num_clients', type=int, help='Number of clients to generate')
     parser.add_argument('num_items', type=int, help='Number of items to generate')
     parser.add_argument('num_transactions', type=int, help='Number of transactions to generate')
     parser.add_argument('num_logs', type=int, help='Number of browsing logs to generate')
+    parser.add_argument('--engine', choices=['faker', 'numpy'], default='faker',
+                        help='faker generates row by row, numpy draws whole columns with a seeded NumPy Generator')
+    parser.add_argument('--seed', type=int, help='Seed of the numpy engine, needs --as-of. Runs with the same seed, --as-of, --shards and '
+                        '--chunk-rows generate the same data')
+    parser.add_argument('--as-of', type=datetime.fromisoformat, help="End of the numpy engine's view time range, defaults to now")
+    parser.add_argument('--shards', type=int, help='Split the browsing logs into this many shards, each written to its own files by a pool of processes with the numpy engine')
+    parser.add_argument('--processes', type=int, help='Worker processes of the sharded mode, defaults to the number of cores')
+    parser.add_argument('--chunk-rows', type=int, default=1000000,
+                        help='Browsing logs generated and written at a time in the sharded mode and with --format parquet. Each chunk draws its '
+                        'rows in one pass, so a different chunk size draws different rows from the same seed')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv',
+                        help='parquet writes Arrow batches of the numpy engine with the schemas of the convert_to_parquet scripts')
+    parser.add_argument('--partition-by-ds', action='store_true', help='Write the Parquet browsing logs as ds=YYYY-MM-DD partitions of a directory')
     args = parser.parse_args()
+    if args.format == 'parquet' and args.engine != 'numpy':
+        parser.error('--format parquet needs --engine numpy')
+    if args.shards and args.engine != 'numpy':
+        parser.error('--shards needs --engine numpy')
+    if args.seed is not None and args.as_of is None:
+        parser.error('--seed needs --as-of, the view time range otherwise ends at the current time and changes every run')
+    if args.partition_by_ds and args.format != 'parquet':
+        parser.error('--partition-by-ds needs --format parquet')
+
+    if args.shards:
+        if args.seed is None:
+            args.seed = int(np.random.SeedSequence().entropy % 2 ** 63)
+        now = args.as_of or datetime.now()
+        logging.info(f"Sharded generation with seed {args.seed} as of {now.isoformat()}")
+        # Clients and items are shared by every shard, their ids stay unique across the whole dataset
+        rng = np.random.default_rng(args.seed)
+        clients = vectorized_online_store.generate_clients(rng, args.num_clients)
+        items = vectorized_online_store.generate_items_with_categories(rng, args.num_items, product_names_by_category, marketing_campaigns)
+        browsing_path, transaction_path = output_paths(args.format, args.partition_by_ds)
+        shard_args = [
+            (shard_id, args.shards, start, stop, args.chunk_rows, args.seed, clients, items, now, browsing_path, transaction_path,
+             args.format, args.partition_by_ds)
+            for shard_id, (start, stop) in enumerate(sharded_generation.shard_ranges(args.num_logs, args.shards))
+        ]
+        rows = sum(sharded_generation.run_shards(generate_shard, shard_args, args.processes))
+        print(f'Data generated and saved to {args.shards} shards of {browsing_path} and {transaction_path}, {rows} rows each')
+        return
+
+    if args.format == 'parquet':
+        rng = np.random.default_rng(args.seed)
+        clients = vectorized_online_store.generate_clients(rng, args.num_clients)
+        items = vectorized_online_store.generate_items_with_categories(rng, args.num_items, product_names_by_category, marketing_campaigns)
+        now = args.as_of or datetime.now()
+        browsing_path, transaction_path = output_paths(args.format, args.partition_by_ds)
+        browsing_output = parquet_output.ParquetOutput(browsing_path, parquet_output.BROWSING_SCHEMA, args.partition_by_ds)
+        transaction_output = parquet_output.ParquetOutput(transaction_path, parquet_output.TRANSACTION_SCHEMA)
+        # Streamed chunk by chunk like the shards, only one chunk of columns is in memory at a time
+        for start, stop in sharded_generation.chunk_ranges(0, args.num_logs, args.chunk_rows):
+            browsing = vectorized_online_store.browsing_log_columns(rng, clients, items, stop - start, now)
+            browsing_output.write(browsing)
+            transaction_output.write(vectorized_online_store.transaction_columns(rng, clients, items, browsing))
+        browsing_output.close()
+        transaction_output.close()
+        print(f'Data generated and saved to Parquet: {browsing_path} and {transaction_path}')
+        return
 
-    clients = generate_clients(args.num_clients)
-    items = generate_items_with_categories(args.num_items)
-    browsing_logs = generate_browsing_logs(clients, items, args.num_logs)
-    transaction_data = generate_transactions(clients, items, browsing_logs)
+    if args.engine == 'numpy':
+        rng = np.random.default_rng(args.seed)
+        clients = vectorized_online_store.generate_clients(rng, args.num_clients)
+        items = vectorized_online_store.generate_items_with_categories(rng, args.num_items, product_names_by_category, marketing_campaigns)
+        browsing_logs = vectorized_online_store.generate_browsing_logs(rng, clients, items, args.num_logs, args.as_of)
+        transaction_data = vectorized_online_store.generate_transactions(rng, clients, items, browsing_logs)
+    else:
+        clients = generate_clients(args.num_clients)
+        items = generate_items_with_categories(args.num_items)
+        browsing_logs = generate_browsing_logs(clients, items, args.num_logs)
+        transaction_data = generate_transactions(clients, items, browsing_logs)
 
     # Save data to CSV
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
@@ -4,10 +4,12 @@ import os
 import logging
 import random
 import datetime
+import numpy as np
 from faker import Faker
 import boto3
 import requests
 import argparse
+import sharded_generation
 
 logging.basicConfig(level=logging.INFO)
 
@@ -32,6 +34,22 @@ def check_env_variables():
         return False
     return True
 
+product_categories = ["Clothing", "Accessories", "Footwear", "Electronics", "Jewelry"]
+product_names_by_category = {
+    "Clothing": ["T-shirt", "Jeans", "Dress", "Jacket", "Sweater", "Skirt", "Scarf", "Gloves", "Socks", "Hat", "Coat", "Blouse", "Pants", "Hoodie", "Pajamas"],
+    "Accessories": ["Belt", "Bag", "Watch", "Hat", "Scarf", "Gloves", "Socks", "Tie", "Wallet", "Backpack", "Bracelet", "Earrings", "Necklace", "Ring", "Briefcase"],
+    "Footwear": ["Sneakers", "Shoes", "Boots", "Sandals", "Slippers"],
+    "Electronics": ["Phone", "Laptop", "Tablet", "Smartwatch", "Headphones", "Speaker", "Camera", "Charger", "Power Bank", "Mouse", "Keyboard", "Monitor", "TV"],
+    "Jewelry": ["Ring", "Necklace", "Earrings", "Bracelet", "Pendant", "Brooch", "Chain", "Cufflinks", "Anklet", "Charm", "Choker", "Pin", "Tiara", "Watch"]
+}
+
+def csv_header(include_personal_data):
+    header = ['InvoiceNo', 'StockCode', 'Description', 'Quantity', 'InvoiceDate', 'Price', 'CustomerID', 'Country', 'PaymentMethod', 'ProductCategory']
+    if include_personal_data:
+        header.extend(['SSN', 'Email'])
+    header.append('LegalIssue')
+    return header
+
 def generate_fake_data(shop_id, date, num_entries, include_personal_data, include_legal_issue):
     try:
         parsed_date = datetime.datetime.strptime(date, '%d-%m-%Y')
@@ -41,14 +59,6 @@ def generate_fake_data(shop_id, date, num_entries, include_personal_data, includ
 
     file_name = f"{shop_id}_{date.replace('-', '_')}.csv"
     fake = Faker()
-    product_categories = ["Clothing", "Accessories", "Footwear", "Electronics", "Jewelry"]
-    product_names_by_category = {
-        "Clothing": ["T-shirt", "Jeans", "Dress", "Jacket", "Sweater", "Skirt", "Scarf", "Gloves", "Socks", "Hat", "Coat", "Blouse", "Pants", "Hoodie", "Pajamas"],
-        "Accessories": ["Belt", "Bag", "Watch", "Hat", "Scarf", "Gloves", "Socks", "Tie", "Wallet", "Backpack", "Bracelet", "Earrings", "Necklace", "Ring", "Briefcase"],
-        "Footwear": ["Sneakers", "Shoes", "Boots", "Sandals", "Slippers"],
-        "Electronics": ["Phone", "Laptop", "Tablet", "Smartwatch", "Headphones", "Speaker", "Camera", "Charger", "Power Bank", "Mouse", "Keyboard", "Monitor", "TV"],
-        "Jewelry": ["Ring", "Necklace", "Earrings", "Bracelet", "Pendant", "Brooch", "Chain", "Cufflinks", "Anklet", "Charm", "Choker", "Pin", "Tiara", "Watch"]
-    }
 
     fake_data = []
     legal_added = False
@@ -80,16 +90,77 @@ def generate_fake_data(shop_id, date, num_entries, include_personal_data, includ
 
     with open(file_name, 'w', newline='') as csvfile:
         writer = csv.writer(csvfile)
-        header = ['InvoiceNo', 'StockCode', 'Description', 'Quantity', 'InvoiceDate', 'Price', 'CustomerID', 'Country', 'PaymentMethod', 'ProductCategory']
-        if include_personal_data:
-            header.extend(['SSN', 'Email'])
-        header.append('LegalIssue')
-        writer.writerow(header)
+        writer.writerow(csv_header(include_personal_data))
         writer.writerows(fake_data)
 
     logging.info(f"Fake data generated and saved to '{file_name}'")
     upload_to_s3(file_name)
 
+def generate_fake_rows(rng, fake, shop_id, parsed_date, num_rows, include_personal_data):
+    """ Draw num_rows rows column by column with rng, with the distributions of generate_fake_data """
+    names = [product_names_by_category[category] for category in product_categories]
+    name_table = np.array([category_names + [''] * (max(map(len, names)) - len(category_names)) for category_names in names])
+    name_counts = np.array([len(category_names) for category_names in names])
+    minute_of_day = np.arange(24 * 60)
+    invoice_dates = np.array([parsed_date.replace(hour=minute // 60, minute=minute % 60).strftime('%d-%m-%Y %H:%M') for minute in minute_of_day])
+
+    category_index = rng.integers(0, len(product_categories), num_rows)
+    name_index = (rng.random(num_rows) * name_counts[category_index]).astype(np.int64)
+    columns = [
+        rng.integers(10000, 100000, num_rows).tolist(),
+        rng.integers(10000, 100000, num_rows).tolist(),
+        name_table[category_index, name_index].tolist(),
+        rng.integers(1, 21, num_rows).tolist(),
+        invoice_dates[rng.integers(0, 24, num_rows) * 60 + rng.integers(0, 60, num_rows)].tolist(),
+        np.round(rng.uniform(1, 100, num_rows), 2).tolist(),
+        rng.integers(10000, 100000, num_rows).tolist(),
+        [get_country_from_shop_id(shop_id)] * num_rows,
+        np.array(["Credit Card", "Cash"])[rng.integers(0, 2, num_rows)].tolist(),
+        np.array(product_categories)[category_index].tolist()
+    ]
+    if include_personal_data:
+        ssn_parts = [rng.integers(100, 1000, num_rows), rng.integers(10, 100, num_rows), rng.integers(1000, 10000, num_rows)]
+        columns.append([f"{area}-{group}-{serial}" for area, group, serial in zip(*ssn_parts)])
+        columns.append([fake.email() for _ in range(num_rows)])
+    columns.append(['no'] * num_rows)
+    return [list(row) for row in zip(*columns)]
+
+def generate_shard(shard_id, num_shards, start, stop, chunk_rows, seed, shop_id, date, include_personal_data, include_legal_issue):
+    """ Generate the rows [start, stop) of one shard chunk by chunk into the shard's own CSV file and upload it """
+    parsed_date = datetime.datetime.strptime(date, '%d-%m-%Y')
+    rng = sharded_generation.shard_rng(seed, shard_id)
+    fake = Faker()
+    fake.seed_instance(int(rng.integers(0, 2 ** 63)))
+    file_name = sharded_generation.shard_file_name(f"{shop_id}_{date.replace('-', '_')}.csv", shard_id, num_shards)
+    with open(file_name, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(csv_header(include_personal_data))
+        for chunk_start, chunk_stop in sharded_generation.chunk_ranges(start, stop, chunk_rows):
+            rows = generate_fake_rows(rng, fake, shop_id, parsed_date, chunk_stop - chunk_start, include_personal_data)
+            # Like generate_fake_data, only the first row of the whole dataset has a legal issue
+            if include_legal_issue and chunk_start == 0 and rows:
+                rows[0][-1] = 'legal'
+            writer.writerows(rows)
+
+    logging.info(f"Shard {shard_id}: {stop - start} rows of fake data saved to '{file_name}'")
+    upload_to_s3(file_name)
+    return file_name
+
+def generate_sharded_fake_data(shop_id, date, num_entries, include_personal_data, include_legal_issue, num_shards, processes, chunk_rows, seed):
+    try:
+        datetime.datetime.strptime(date, '%d-%m-%Y')
+    except ValueError:
+        logging.error("Invalid date format. Please use DD-MM-YYYY format.")
+        return
+    if seed is None:
+        seed = int(np.random.SeedSequence().entropy % 2 ** 63)
+    logging.info(f"Sharded generation with seed {seed}")
+    shard_args = [
+        (shard_id, num_shards, start, stop, chunk_rows, seed, shop_id, date, include_personal_data, include_legal_issue)
+        for shard_id, (start, stop) in enumerate(sharded_generation.shard_ranges(num_entries, num_shards))
+    ]
+    sharded_generation.run_shards(generate_shard, shard_args, processes)
+
 def get_country_from_shop_id(shop_id):
     country_mapping = {
         "shop1": "Spain", "shop2": "France", "shop3": "Germany", "shop4": "Italy", "shop5": "Netherlands"
@@ -146,5 +217,13 @@ if __name__ == "__main__":
     parser.add_argument("num_entries", type=int, help="Number of entries to generate")
     parser.add_argument("--include-personal-data", action="store_true", help="Include personal data columns")
     parser.add_argument("--include-legal-issue", action="store_true", help="Include a legal issue column with one entry set to 'legal'")
+    parser.add_argument("--shards", type=int, help="Split the entries into this many files, generated and uploaded by a pool of processes")
+    parser.add_argument("--processes", type=int, help="Worker processes of the sharded mode, defaults to the number of cores")
+    parser.add_argument("--chunk-rows", type=int, default=100000, help="Entries a worker generates and writes at a time in the sharded mode")
+    parser.add_argument("--seed", type=int, help="Seed of the sharded mode, the same seed, shard count and chunk size generate the same files")
     args = parser.parse_args()
-    generate_fake_data(args.shop_id, args.date, args.num_entries, args.include_personal_data, args.include_legal_issue)
+    if args.shards:
+        generate_sharded_fake_data(args.shop_id, args.date, args.num_entries, args.include_personal_data, args.include_legal_issue,
+                                   args.shards, args.processes, args.chunk_rows, args.seed)
+    else:
+        generate_fake_data(args.shop_id, args.date, args.num_entries, args.include_personal_data, args.include_legal_issue)
@@ -0,0 +1,100 @@
+import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from convert_to_parquet.schemas import BROWSING_SCHEMA, TRANSACTION_SCHEMA
+
+# Rows of a ds partition buffered into one row group, and the rows buffered over all partitions before the largest
+# buffers are written early
+PARTITION_ROW_GROUP_ROWS = 131072
+MAX_BUFFERED_ROWS = 2000000
+
+
+def record_batch(columns, schema, rows=None):
+    """ Arrow record batch of the schema's columns from NumPy arrays, scalars are repeated over the rows
+
+    datetime64 columns become timestamp(us) and date32 values without going through text.
+    """
+    if rows is None:
+        rows = next(len(values) for values in columns.values() if np.ndim(values))
+    arrays = []
+    for field in schema:
+        values = columns[field.name]
+        if not np.ndim(values):
+            values = np.full(rows, values)
+        arrays.append(pa.array(values, type=field.type))
+    return pa.record_batch(arrays, schema=schema)
+
+
+class ParquetOutput:
+    """ Streams the chunks of one dataset into a Parquet file with a ParquetWriter
+
+    With partition_by_ds, path is a directory and every chunk is split into Hive style ds=YYYY-MM-DD partitions,
+    each with its own writer and file_name, without the ds column in the files. A chunk spreads over hundreds of days,
+    so the rows of each day are buffered and written once they fill a row group of row_group_rows. When all buffers
+    together hold max_buffered_rows, the largest are written early, which bounds the memory over the current chunk.
+    """
+
+    def __init__(self, path, schema, partition_by_ds=False, file_name='part-00000.parquet',
+                 row_group_rows=PARTITION_ROW_GROUP_ROWS, max_buffered_rows=MAX_BUFFERED_ROWS):
+        self.path = path
+        self.schema = schema
+        self.partition_by_ds = partition_by_ds
+        self.file_name = file_name
+        self.file_schema = schema.remove(schema.get_field_index('ds')) if partition_by_ds else schema
+        self.row_group_rows = row_group_rows
+        self.max_buffered_rows = max_buffered_rows
+        self.writers = {}
+        self.buffers = {}
+        self.buffered_rows = 0
+
+    def writer(self, ds=None):
+        if ds not in self.writers:
+            if ds is None:
+                path = self.path
+            else:
+                path = os.path.join(self.path, f"ds={ds}", self.file_name)
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self.writers[ds] = pq.ParquetWriter(path, self.file_schema, compression='snappy')
+        return self.writers[ds]
+
+    def buffer(self, ds, batch):
+        self.buffers.setdefault(ds, []).append(batch)
+        self.buffered_rows += batch.num_rows
+        if sum(buffered.num_rows for buffered in self.buffers[ds]) >= self.row_group_rows:
+            self.flush(ds)
+
+    def flush(self, ds):
+        """ Write the buffered rows of a ds partition, as row groups of up to row_group_rows rows """
+        table = pa.Table.from_batches(self.buffers.pop(ds), schema=self.file_schema)
+        self.writer(ds).write_table(table, row_group_size=self.row_group_rows)
+        self.buffered_rows -= table.num_rows
+
+    def write(self, columns):
+        """ Write a chunk given as columns of NumPy arrays """
+        if not self.partition_by_ds:
+            self.writer().write_batch(record_batch(columns, self.file_schema))
+            return
+        days = columns['ds']
+        order = np.argsort(days, kind='stable')
+        sorted_days = days[order]
+        partition_days, starts = np.unique(sorted_days, return_index=True)
+        stops = list(starts[1:]) + [len(sorted_days)]
+        for day, start, stop in zip(partition_days, starts, stops):
+            rows = order[start:stop]
+            partition = {name: values[rows] if np.ndim(values) else values for name, values in columns.items()}
+            self.buffer(np.datetime_as_string(day, unit='D'), record_batch(partition, self.file_schema, len(rows)))
+        if self.buffered_rows >= self.max_buffered_rows:
+            # Largest first, until half of the budget is free for the next chunk
+            by_size = sorted(self.buffers, key=lambda ds: sum(batch.num_rows for batch in self.buffers[ds]), reverse=True)
+            for ds in by_size:
+                if self.buffered_rows < self.max_buffered_rows // 2:
+                    break
+                self.flush(ds)
+
+    def close(self):
+        for ds in list(self.buffers):
+            self.flush(ds)
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
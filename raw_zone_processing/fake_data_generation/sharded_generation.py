@@ -0,0 +1,47 @@
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+
+def shard_ranges(total_rows, num_shards):
+    """ Split [0, total_rows) into num_shards disjoint, contiguous ranges whose sizes differ by at most one row """
+    base, extra = divmod(total_rows, num_shards)
+    ranges = []
+    start = 0
+    for shard_id in range(num_shards):
+        stop = start + base + (1 if shard_id < extra else 0)
+        ranges.append((start, stop))
+        start = stop
+    return ranges
+
+
+def chunk_ranges(start, stop, chunk_rows):
+    """ Split [start, stop) into ranges of at most chunk_rows rows """
+    return [(chunk_start, min(chunk_start + chunk_rows, stop)) for chunk_start in range(start, stop, chunk_rows)]
+
+
+def shard_rng(seed, shard_id):
+    """ The NumPy Generator of a shard, an independent stream derived from the base seed and the shard id
+
+    The same seed, shard count and chunk size give the same rows, whatever the number of processes.
+    """
+    return np.random.default_rng(np.random.SeedSequence([seed, shard_id]))
+
+
+def shard_file_name(file_name, shard_id, num_shards):
+    """ Insert the shard id before the extension, e.g. data.csv becomes data_shard00003.csv """
+    root, extension = os.path.splitext(file_name)
+    return f"{root}_shard{shard_id:0{max(5, len(str(num_shards - 1)))}d}{extension}"
+
+
+def run_shards(generate_shard, shard_args, processes=None):
+    """ Run generate_shard(*args) for every shard in a process pool and return the results in shard order
+
+    Each worker holds one chunk of its shard at a time, so peak memory per worker is set by the chunk size.
+    """
+    processes = processes or os.cpu_count()
+    logging.info(f"Generating {len(shard_args)} shards with {processes} processes")
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(generate_shard, *args) for args in shard_args]
+        return [future.result() for future in futures]
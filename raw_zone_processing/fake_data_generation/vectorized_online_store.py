@@ -0,0 +1,195 @@
+import calendar
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+EUROPEAN_COUNTRIES = np.array(
+    ['GB', 'ES'] * 20 + ['DE'] * 10 + ['FR', 'DE', 'IT', 'NL', 'PL', 'SE', 'FI', 'NO', 'DK', 'IE', 'PT', 'CZ', 'RO', 'HU',
+                                      'SK', 'BG', 'LT', 'LV', 'EE', 'GR', 'HR', 'SI', 'MT', 'CY', 'LU']
+)
+CUSTOMER_TYPES = np.array(["New", "Returning", "VIP"])
+BROWSERS = np.array(['Chrome', 'Firefox', 'Safari', 'Edge', 'Opera'])
+OPERATING_SYSTEMS = np.array(['Windows', 'MacOS', 'Linux', 'iOS', 'Android'])
+DAY_NAMES = np.array(list(calendar.day_name))
+IP_FIRST_OCTETS = np.array([8, 9, 10])
+HEX_DIGITS = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+# Positions of the hex digits in the 36 character UUID text, the others are dashes
+UUID_DIGIT_POSITIONS = np.array([i for i in range(36) if i not in (8, 13, 18, 23)])
+# Decimal digits and digit count of every octet value
+OCTET_DIGITS = np.array([list(str(value).ljust(3, '\0').encode()) for value in range(256)], dtype=np.uint8)
+OCTET_LENGTHS = np.array([len(str(value)) for value in range(256)])
+
+
+def catalog_arrays(product_names_by_category, marketing_campaigns):
+    """ The product catalog as arrays indexed by category and by product within the category """
+    categories = np.array(list(product_names_by_category))
+    names = np.array([[name for name, _ in products] for products in product_names_by_category.values()])
+    prices = np.array([[price for _, price in products] for products in product_names_by_category.values()], dtype=np.float64)
+    campaigns = np.array([marketing_campaigns[category] for category in categories])
+    return categories, names, prices, campaigns
+
+
+def uuid4_strings(rng, size):
+    """ Random version 4 UUIDs in their text form, built column-wise from one draw of random bytes """
+    raw = rng.integers(0, 256, size=(size, 16), dtype=np.uint8)
+    raw[:, 6] = (raw[:, 6] & 0x0f) | 0x40
+    raw[:, 8] = (raw[:, 8] & 0x3f) | 0x80
+    digits = np.empty((size, 32), dtype=np.uint8)
+    digits[:, 0::2] = raw >> 4
+    digits[:, 1::2] = raw & 0x0f
+    text = np.full((size, 36), ord('-'), dtype=np.uint8)
+    text[:, UUID_DIGIT_POSITIONS] = HEX_DIGITS[digits]
+    return text.view('S36').ravel().astype(str)
+
+
+def format_ips(octets):
+    """ Dotted quad text of a (4, size) array of octets, written into a byte matrix one digit column at a time """
+    size = octets.shape[1]
+    text = np.zeros((size, 15), dtype=np.uint8)
+    rows = np.arange(size)
+    position = np.zeros(size, dtype=np.int64)
+    for index, octet in enumerate(octets):
+        if index:
+            text[rows, position] = ord('.')
+            position += 1
+        lengths = OCTET_LENGTHS[octet]
+        for digit in range(3):
+            has_digit = digit < lengths
+            text[rows[has_digit], position[has_digit] + digit] = OCTET_DIGITS[octet[has_digit], digit]
+        position += lengths
+    # The trailing zero bytes are dropped by the conversion from fixed width bytes
+    return text.view('S15').ravel().astype(str)
+
+
+def generate_custom_ips(rng, size):
+    first_octets = IP_FIRST_OCTETS[rng.integers(0, len(IP_FIRST_OCTETS), size)]
+    other_octets = rng.integers(0, 256, size=(3, size))
+    return format_ips(np.vstack([first_octets, other_octets]))
+
+
+def format_timestamps(ts):
+    """ 'YYYY-MM-DD HH:MM:SS' text of datetime64[s] values """
+    text = np.datetime_as_string(ts, unit='s').astype('S19')
+    text.view(np.uint8).reshape(-1, 19)[:, 10] = ord(' ')
+    return text.astype(str)
+
+
+def generate_clients(rng, num_clients):
+    """ Clients with unique ids in [100000, 999999], countries weighted like the Faker engine's list """
+    return pd.DataFrame({
+        "client_id": rng.choice(900000, size=num_clients, replace=False) + 100000,
+        "country": EUROPEAN_COUNTRIES[rng.integers(0, len(EUROPEAN_COUNTRIES), num_clients)],
+        "customer_type": CUSTOMER_TYPES[rng.integers(0, len(CUSTOMER_TYPES), num_clients)]
+    })
+
+
+def generate_items_with_categories(rng, num_items, product_names_by_category, marketing_campaigns):
+    """ Items of a uniformly drawn category and product, priced within 20% of the base price """
+    categories, names, prices, campaigns = catalog_arrays(product_names_by_category, marketing_campaigns)
+    category_index = rng.integers(0, len(categories), num_items)
+    product_index = rng.integers(0, names.shape[1], num_items)
+    return pd.DataFrame({
+        "item_id": uuid4_strings(rng, num_items),
+        "item_name": names[category_index, product_index],
+        "category": categories[category_index],
+        "base_price": np.round(prices[category_index, product_index] * rng.uniform(0.8, 1.2, num_items), 2),
+        "marketing_campaign": campaigns[category_index],
+        "returned": rng.uniform(0.01, 0.05, num_items)
+    })
+
+
+def view_times(rng, size, now=None):
+    """ Uniform times between the start of this year and now, to the second, like fake.date_time_this_year """
+    now = now or datetime.now()
+    start = np.datetime64(datetime(now.year, 1, 1), 's')
+    span = int((np.datetime64(now, 's') - start).astype(np.int64))
+    return start + rng.integers(0, span + 1, size).astype('timedelta64[s]')
+
+
+def browsing_log_columns(rng, clients, items, num_logs, now=None):
+    """ Draws num_logs views and drops 20% of those between 21:00 and 07:59, as the Faker engine does
+
+    Returns the columns as arrays, ts as datetime64[s] and ds as datetime64[D], constant columns as scalars.
+    """
+    ts = view_times(rng, num_logs, now)
+    client_index = rng.integers(0, len(clients), num_logs)
+    item_index = rng.integers(0, len(items), num_logs)
+    hours = (ts - ts.astype('datetime64[D]')).astype('timedelta64[h]').astype(np.int64)
+    night = (hours < 8) | (hours > 20)
+    keep = ~night | (rng.random(num_logs) >= 0.2)
+
+    ts, client_index, item_index = ts[keep], client_index[keep], item_index[keep]
+    size = len(ts)
+    days = ts.astype('datetime64[D]')
+    # 1970-01-01 was a Thursday, weekday 3 counting from Monday
+    weekdays = (days.astype(np.int64) + 3) % 7
+    return {
+        "ip": generate_custom_ips(rng, size),
+        "ts": ts,
+        "tz": "UTC",
+        "verb": "GET",
+        "resource_type": "Item",
+        "resource_fk": items['item_id'].to_numpy()[item_index],
+        "response": 200,
+        "browser": BROWSERS[rng.integers(0, len(BROWSERS), size)],
+        "os": OPERATING_SYSTEMS[rng.integers(0, len(OPERATING_SYSTEMS), size)],
+        "customer": clients['client_id'].to_numpy()[client_index],
+        "d_day_name": DAY_NAMES[weekdays],
+        "i_current_price": items['base_price'].to_numpy()[item_index],
+        "i_category": items['category'].to_numpy()[item_index],
+        "i_description": items['item_name'].to_numpy()[item_index],
+        "c_preferred_cust_flag": rng.random(size) < 0.5,
+        "ds": days
+    }
+
+
+def transaction_columns(rng, clients, items, browsing):
+    """ One purchase 1 to 24 hours after each view of the browsing columns, clients and items are looked up by array
+    position. Returns the columns as arrays, transaction_date as datetime64[s]. """
+    size = len(browsing['ts'])
+    client_order = np.argsort(clients['client_id'].to_numpy())
+    client_index = client_order[np.searchsorted(clients['client_id'].to_numpy()[client_order], browsing['customer'])]
+    item_index = pd.Index(items['item_id']).get_indexer(browsing['resource_fk'])
+    if (item_index < 0).any():
+        raise KeyError("Browsing logs refer to items missing from the item list")
+
+    transaction_time = browsing['ts'] + rng.integers(1, 25, size).astype('timedelta64[h]')
+    campaigns = np.where(rng.random(size) < 0.1, items['marketing_campaign'].to_numpy()[item_index], None)
+    return {
+        "client_id": browsing['customer'],
+        "transaction_id": uuid4_strings(rng, size),
+        "item_id": browsing['resource_fk'],
+        "transaction_date": transaction_time,
+        "country": clients['country'].to_numpy()[client_index],
+        "customer_type": clients['customer_type'].to_numpy()[client_index],
+        "item_description": browsing['i_description'],
+        "category": browsing['i_category'],
+        "quantity": rng.integers(1, 6, size),
+        "total_amount": np.round(browsing['i_current_price'] * rng.integers(1, 6, size), 2),
+        "marketing_campaign": campaigns,
+        "returned": rng.random(size) < items['returned'].to_numpy()[item_index]
+    }
+
+
+def text_column(values):
+    """ Timestamps and dates as the text written to CSV, other columns unchanged """
+    dtype = np.asarray(values).dtype
+    if dtype == np.dtype('datetime64[s]'):
+        return format_timestamps(values)
+    if dtype == np.dtype('datetime64[D]'):
+        return np.datetime_as_string(values, unit='D')
+    return values
+
+
+def text_frame(columns):
+    return pd.DataFrame({name: text_column(values) for name, values in columns.items()})
+
+
+def generate_browsing_logs(rng, clients, items, num_logs, now=None):
+    return text_frame(browsing_log_columns(rng, clients, items, num_logs, now))
+
+
+def generate_transactions(rng, clients, items, browsing_logs):
+    browsing = {name: browsing_logs[name].to_numpy() for name in ('customer', 'resource_fk', 'i_description', 'i_category', 'i_current_price')}
+    browsing['ts'] = browsing_logs['ts'].to_numpy().astype('datetime64[s]')
+    return text_frame(transaction_columns(rng, clients, items, browsing))
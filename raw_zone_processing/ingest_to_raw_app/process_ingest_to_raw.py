@@ -5,34 +5,162 @@ import logging
 import requests
 import boto3
 import time
+import sys
+import signal
+import threading
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from flask import Flask, request, jsonify
 from cloudevents.http import from_http
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from processed_ledger import SQLiteLedger, TagWriter
 
 # Initialize logging
 app = Flask(__name__)
 __version__ = "1.2.0"
 logging.basicConfig(level=logging.INFO, format=f'%(asctime)s - %(levelname)s - Script Version {__version__} - %(message)s')
 
-
-def has_personal_info(csv_content):
-    patterns = [
-        r'\b\d{3}-\d{2}-\d{4}\b',  # Social Security Number (SSN)
-        r'\b\d{4}-\d{4}-\d{4}-\d{4}\b',  # Credit Card Number
-        r'\b\d{16}\b',  # Another format of Credit Card Number
-        r'\b\d{3}\b',  # CVV
-    ]
-
-    for pattern in patterns:
-        if re.search(pattern, csv_content):
-            return True
+# Credentials are refreshed this many seconds before they expire
+CREDENTIAL_REFRESH_MARGIN = int(os.getenv('CREDENTIAL_REFRESH_MARGIN', '300'))
+S3_MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', '20'))
+# Records of one bucket notification event are processed concurrently by this many threads
+RECORD_WORKERS = int(os.getenv('RECORD_WORKERS', '4'))
+# Error codes S3 and STS return with a 4xx status that still succeed when retried
+RETRYABLE_ERROR_CODES = {
+    'RequestTimeout', 'RequestTimeTooSkewed', 'SlowDown', 'Throttling', 'ThrottlingException', 'TooManyRequests',
+    'RequestLimitExceeded', 'ExpiredToken', 'InvalidIdentityToken', 'IDPCommunicationError'
+}
+
+# Process-wide cache of the OIDC token, STS clients and per role S3 clients. _credentials_lock only guards the
+# dictionaries, the OIDC and STS requests run under a refresh lock per credential so one thread renews it at a time
+_credentials_lock = threading.Lock()
+_refresh_locks = {}
+_jwt_token_cache = {}
+_sts_clients = {}
+_role_s3_clients = {}
+
+record_executor = ThreadPoolExecutor(max_workers=RECORD_WORKERS, thread_name_prefix='record')
+
+# Local ledger of processed objects, 'sqlite' or 'none' to always ask S3
+LEDGER_BACKEND = os.getenv('LEDGER_BACKEND', 'sqlite')
+LEDGER_PATH = os.getenv('LEDGER_PATH', '/tmp/processed_ledger.db')
+LEDGER_BLOOM_CAPACITY = int(os.getenv('LEDGER_BLOOM_CAPACITY', '1000000'))
+LEDGER_BLOOM_ERROR_RATE = float(os.getenv('LEDGER_BLOOM_ERROR_RATE', '0.001'))
+LEDGER_RETENTION_SECONDS = int(os.getenv('LEDGER_RETENTION_SECONDS', str(7 * 24 * 3600)))
+# When false, objects missing from the ledger are processed without reading their tags from S3
+LEDGER_REMOTE_CHECK = os.getenv('LEDGER_REMOTE_CHECK', 'true').lower() == 'true'
+TAG_BATCH_SIZE = int(os.getenv('TAG_BATCH_SIZE', '100'))
+TAG_FLUSH_INTERVAL = float(os.getenv('TAG_FLUSH_INTERVAL', '1.0'))
+# Failed tags are retried with an exponential backoff, then left untagged in the ledger and resubmitted periodically
+TAG_MAX_ATTEMPTS = int(os.getenv('TAG_MAX_ATTEMPTS', '5'))
+TAG_RETRY_BACKOFF = float(os.getenv('TAG_RETRY_BACKOFF', '1.0'))
+TAG_RESYNC_INTERVAL = float(os.getenv('TAG_RESYNC_INTERVAL', '300'))
+# Seconds the queued tags are given to be written on SIGTERM, below the pod's terminationGracePeriodSeconds
+TAG_DRAIN_TIMEOUT = float(os.getenv('TAG_DRAIN_TIMEOUT', '20'))
+
+processed_ledger = None
+tag_writer = None
+
+# Prometheus metrics exposed on /metrics
+STAGE_LATENCY = Histogram(
+    'ingest_stage_duration_seconds', 'Time spent in each stage of the ingest pipeline', ['stage'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+)
+BYTES_IN = Counter('ingest_bytes_in_total', 'Bytes read from the source bucket', ['bucket'])
+BYTES_OUT = Counter('ingest_bytes_out_total', 'Bytes written to each destination bucket', ['bucket'])
+ROUTED_OBJECTS = Counter('ingest_routed_objects_total', 'Objects routed by classification: personal_info, no_personal_info or legal_hold', ['route'])
+RECORD_RESULTS = Counter('ingest_records_total', 'Notification records processed, by result status', ['status'])
+IN_FLIGHT_REQUESTS = Gauge('ingest_in_flight_requests', 'POST requests being processed')
+IN_FLIGHT_RECORDS = Gauge('ingest_in_flight_records', 'Notification records being processed')
+
+
+# All personal information patterns combined so each block is scanned once
+PII_PATTERN = re.compile(rb"""
+    \b\d{3}-\d{2}-\d{4}\b          # Social Security Number (SSN)
+  | \b\d{4}-\d{4}-\d{4}-\d{4}\b    # Credit Card Number
+  | \b\d{16}\b                     # Another format of Credit Card Number
+  | \b\d{3}\b                      # CVV
+""", re.VERBOSE)
+CSV_CHUNK_SIZE = int(os.getenv('CSV_CHUNK_SIZE', str(1024 * 1024)))
+
+# Objects bigger than STREAMING_THRESHOLD are streamed to the destination with a multipart upload,
+# holding at most STREAMING_BUFFER_SIZE bytes of parts in memory
+STREAMING_THRESHOLD = int(os.getenv('STREAMING_THRESHOLD', str(64 * 1024 * 1024)))
+STREAMING_PART_SIZE = max(int(os.getenv('STREAMING_PART_SIZE', str(8 * 1024 * 1024))), 5 * 1024 * 1024)
+STREAMING_BUFFER_SIZE = int(os.getenv('STREAMING_BUFFER_SIZE', str(64 * 1024 * 1024)))
+# 'prescan' reads the object once to decide the destination, 'staged' uploads to a staging key and copies it afterwards
+STREAMING_ROUTING_STRATEGY = os.getenv('STREAMING_ROUTING_STRATEGY', 'prescan')
+STREAMING_STAGING_PREFIX = os.getenv('STREAMING_STAGING_PREFIX', 'staging/')
+
+
+def new_classification():
+    return {'personal_info': False, 'legal_issue': False}
+
+def has_legal_cell(block):
+    for line in block.split(b'\n'):
+        if b'legal' in line:
+            row = next(csv.reader([line.decode('utf-8', errors='replace')]), [])
+            if 'legal' in row:
+                return True
     return False
 
-def has_legal_issue(csv_content):
-    reader = csv.reader(csv_content.splitlines())
-    for row in reader:
-        if 'legal' in row:
-            return True
-    return False
+def transform_block(block, prefix, classification):
+    """ Prefix every non empty line of block with the shop id, drop carriage returns and update classification """
+    rows = block.replace(b'\r', b'').split(b'\n')
+    transformed = b'\n'.join([prefix + row if row.strip() else row for row in rows])
+    if not classification['personal_info'] and PII_PATTERN.search(transformed):
+        classification['personal_info'] = True
+    if not classification['legal_issue'] and b'legal' in transformed:
+        classification['legal_issue'] = has_legal_cell(transformed)
+    return transformed
+
+def transform_csv_chunks(chunks, shop_id, classification):
+    """ Transform and classify a CSV byte stream in one pass, yielding the transformed bytes block by block """
+    prefix = f"{shop_id},".encode('utf-8')
+    pending = b''
+    elapsed = 0.0
+    try:
+        for chunk in chunks:
+            data = pending + chunk if pending else chunk
+            cut = data.rfind(b'\n') + 1
+            if not cut:
+                pending = data
+                continue
+            pending = data[cut:]
+            start = time.perf_counter()
+            block = transform_block(data[:cut], prefix, classification)
+            elapsed += time.perf_counter() - start
+            yield block
+        start = time.perf_counter()
+        block = transform_block(pending, prefix, classification)
+        elapsed += time.perf_counter() - start
+        yield block
+    finally:
+        STAGE_LATENCY.labels('classify').observe(elapsed)
+
+def read_object_chunks(body, bucket_name):
+    """ Yield the chunks of an object body, counting its bytes and observing the total read time once done """
+    chunks = body.iter_chunks(CSV_CHUNK_SIZE)
+    bytes_in = BYTES_IN.labels(bucket_name)
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            chunk = next(chunks, None)
+            elapsed += time.perf_counter() - start
+            if chunk is None:
+                break
+            bytes_in.inc(len(chunk))
+            yield chunk
+    finally:
+        STAGE_LATENCY.labels('read').observe(elapsed)
+
+def transform_and_classify_csv(chunks, shop_id):
+    classification = new_classification()
+    payload = b''.join(transform_csv_chunks(chunks, shop_id, classification))
+    return payload, classification
 
 def check_environment():
     missing_params = []
@@ -75,135 +203,209 @@ def enable_legal_hold(s3, bucket_name, object_key):
 
 def read_csv_from_s3(bucket_name, object_key, s3_endpoint_url, sts_client):
     try:
-        role_arn = os.getenv('SOURCE_ROLE_ARN')
-        role_session_name = 'source_session'
-        provider_url = os.getenv('OIDC_PROVIDER_URL')
-        client_id = os.getenv('OIDC_CLIENT_ID')
-        client_secret = os.getenv('OIDC_CLIENT_SECRET')
-        jwt_token = get_jwt_token(provider_url, client_id, client_secret)
-        assumed_role = sts_client.assume_role_with_web_identity(
-            RoleArn=role_arn,
-            RoleSessionName=role_session_name,
-            WebIdentityToken=jwt_token
-        )
+        s3 = get_s3_client(os.getenv('SOURCE_ROLE_ARN'), 'source_session', s3_endpoint_url, sts_client)
 
-        # Initialize S3 client with temporary credentials
-        s3 = boto3.client(
-            's3',
-            aws_access_key_id=assumed_role['Credentials']['AccessKeyId'],
-            aws_secret_access_key=assumed_role['Credentials']['SecretAccessKey'],
-            aws_session_token=assumed_role['Credentials']['SessionToken'],
-            endpoint_url=s3_endpoint_url
-        )
-
-        # Get object from S3
-        response = s3.get_object(Bucket=bucket_name, Key=object_key)
-        csv_content = response['Body'].read().decode('utf-8')
-        return csv_content
+        # Get object from S3, the body is consumed in chunks by the caller
+        with STAGE_LATENCY.labels('get').time():
+            return s3.get_object(Bucket=bucket_name, Key=object_key)
     except Exception as e:
         logging.error(f"Error reading CSV from S3: {e}")
-        return None
-
-def process_csv_files_in_bucket(bucket_name, object_name, s3_endpoint_url, sts_client, personal_info_bucket, no_personal_info_bucket):
+        raise
+
+def is_permanent_error(error):
+    """ Whether processing the object again can not succeed: a 4xx answer from S3, e.g. NoSuchKey or AccessDenied,
+    other than a timeout or throttling, or an object whose name or content can not be parsed. Failures to get
+    credentials, 5xx answers and connection errors are transient """
+    if isinstance(error, ClientError):
+        if error.operation_name == 'AssumeRoleWithWebIdentity':
+            return False
+        code = error.response.get('Error', {}).get('Code', '')
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return 400 <= status < 500 and status not in (408, 429) and code not in RETRYABLE_ERROR_CODES
+    return isinstance(error, (ValueError, csv.Error))
+
+def process_csv_files_in_bucket(bucket_name, object_name, s3_endpoint_url, sts_client, personal_info_bucket, no_personal_info_bucket, etag=None):
+    """ Process one object and return a result dict with its status: processed, skipped, empty, rejected when it
+    failed with a permanent error or failed when a retry can succeed """
+    result = {'bucket': bucket_name, 'key': object_name, 'status': 'failed'}
     try:
-        # Get temporary credentials using AssumeRoleWithWebIdentity
-        role_arn = os.getenv('SOURCE_ROLE_ARN')
-        role_session_name = 'source_session'
-        provider_url = os.getenv('OIDC_PROVIDER_URL')
-        client_id = os.getenv('OIDC_CLIENT_ID')
-        client_secret = os.getenv('OIDC_CLIENT_SECRET')
-        jwt_token = get_jwt_token(provider_url, client_id, client_secret)
-        assumed_role = sts_client.assume_role_with_web_identity(
-            RoleArn=role_arn,
-            RoleSessionName=role_session_name,
-            WebIdentityToken=jwt_token
-        )
-
-        # Initialize S3 client with temporary credentials
-        s3 = boto3.client(
-            's3',
-            aws_access_key_id=assumed_role['Credentials']['AccessKeyId'],
-            aws_secret_access_key=assumed_role['Credentials']['SecretAccessKey'],
-            aws_session_token=assumed_role['Credentials']['SessionToken'],
-            endpoint_url=s3_endpoint_url
-        )
+        s3 = get_s3_client(os.getenv('SOURCE_ROLE_ARN'), 'source_session', s3_endpoint_url, sts_client)
         object_key = object_name
-        if is_processed_object(s3, bucket_name, object_key):
+        with STAGE_LATENCY.labels('tag_check').time():
+            processed = is_processed_object(s3, bucket_name, object_key, etag)
+        if processed:
             logging.info(f"Skipping processed object: {object_key}")
-            return None
-        csv_content = read_csv_from_s3(bucket_name, object_key, s3_endpoint_url, sts_client)
-        if csv_content:
-            shop_id, _ = object_key.split('_', 1)  # Extract shop ID from filename until first underscore
-            csv_content = insert_shop_id_to_csv(csv_content, shop_id)
-            if has_personal_info(csv_content):
+            result['status'] = 'skipped'
+            return result
+        response = read_csv_from_s3(bucket_name, object_key, s3_endpoint_url, sts_client)
+        if not response['ContentLength']:
+            result['status'] = 'empty'
+            return result
+        shop_id, _ = object_key.split('_', 1)  # Extract shop ID from filename until first underscore
+        if response['ContentLength'] > STREAMING_THRESHOLD:
+            destination_bucket, classification = stream_csv_to_destination(
+                response, bucket_name, object_key, shop_id, s3_endpoint_url, sts_client,
+                personal_info_bucket, no_personal_info_bucket
+            )
+        else:
+            payload, classification = transform_and_classify_csv(read_object_chunks(response['Body'], bucket_name), shop_id)
+            if classification['personal_info']:
                 destination_bucket = personal_info_bucket
-                tag_color = 'red'
             else:
                 destination_bucket = no_personal_info_bucket
-                tag_color = 'green'
             logging.info(f"Uploading Object To destination bucket: {destination_bucket}")
-            upload_csv_to_s3(destination_bucket, object_key, csv_content, s3_endpoint_url, sts_client)
+            upload_csv_to_s3(destination_bucket, object_key, payload, s3_endpoint_url, sts_client)
+        ROUTED_OBJECTS.labels('personal_info' if classification['personal_info'] else 'no_personal_info').inc()
+        tag_color = 'red' if classification['personal_info'] else 'green'
+        with STAGE_LATENCY.labels('tagging').time():
             tag_s3_object(s3, destination_bucket, object_key, tag_color)
-            tag_object_as_processed(s3, bucket_name, object_key)
-            if has_legal_issue(csv_content):
+            record_object_as_processed(s3, bucket_name, object_key, etag)
+            if classification['legal_issue']:
+                ROUTED_OBJECTS.labels('legal_hold').inc()
                 enable_legal_hold(s3, bucket_name, object_name)
+        result.update(status='processed', destination_bucket=destination_bucket, legal_issue=classification['legal_issue'])
     except Exception as e:
-        logging.error(f"Error processing CSV files in bucket: {e}")
-
-def insert_shop_id_to_csv(csv_content, shop_id):
-    rows = csv_content.split('\n')
-    for i, row in enumerate(rows):
-        if row.strip():  # Skip empty rows
-            rows[i] = f"{shop_id},{row}"
-    modified_csv_content = '\n'.join(rows)
-    modified_csv_content = modified_csv_content.replace('\r', '')
-    return modified_csv_content
-
-def upload_csv_to_s3(bucket_name, object_key, csv_content, s3_endpoint_url, sts_client):
+        if is_permanent_error(e):
+            # Redelivering the event fails the same way, the object is skipped instead of blocking its event forever
+            logging.error(f"Skipping {object_name} in {bucket_name}, it can not be processed: {e}")
+            result['status'] = 'rejected'
+        else:
+            logging.error(f"Error processing CSV files in bucket: {e}")
+        result['error'] = str(e)
+    return result
+
+def iter_parts(blocks, part_size):
+    """ Regroup byte blocks into multipart upload parts of at least part_size bytes, the last one may be smaller """
+    buffer = bytearray()
+    parts = 0
+    for block in blocks:
+        buffer += block
+        if len(buffer) >= part_size:
+            yield bytes(buffer)
+            buffer = bytearray()
+            parts += 1
+    if buffer or not parts:
+        yield bytes(buffer)
+
+def multipart_upload_stream(s3, bucket_name, object_key, blocks):
+    """ Upload byte blocks with a concurrent multipart upload, keeping at most STREAMING_BUFFER_SIZE bytes of parts in flight """
+    max_inflight_parts = max(STREAMING_BUFFER_SIZE // STREAMING_PART_SIZE, 1)
+    slots = threading.BoundedSemaphore(max_inflight_parts)
+    bytes_out = BYTES_OUT.labels(bucket_name)
+    upload_id = s3.create_multipart_upload(Bucket=bucket_name, Key=object_key)['UploadId']
+
+    def upload_part(part_number, body):
+        try:
+            response = s3.upload_part(Bucket=bucket_name, Key=object_key, UploadId=upload_id, PartNumber=part_number, Body=body)
+            bytes_out.inc(len(body))
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        finally:
+            slots.release()
+
+    parts = []
+    pending = []
+    start = time.perf_counter()
     try:
-        # Get temporary credentials using AssumeRoleWithWebIdentity
-        role_arn = os.getenv('DESTINATION_ROLE_ARN')
-        role_session_name = 'destination_session'
-        provider_url = os.getenv('OIDC_PROVIDER_URL')
-        client_id = os.getenv('OIDC_CLIENT_ID')
-        client_secret = os.getenv('OIDC_CLIENT_SECRET')
-        jwt_token = get_jwt_token(provider_url, client_id, client_secret)
-        assumed_role = sts_client.assume_role_with_web_identity(
-            RoleArn=role_arn,
-            RoleSessionName=role_session_name,
-            WebIdentityToken=jwt_token
-        )
-
-        s3 = boto3.client(
-            's3',
-            aws_access_key_id=assumed_role['Credentials']['AccessKeyId'],
-            aws_secret_access_key=assumed_role['Credentials']['SecretAccessKey'],
-            aws_session_token=assumed_role['Credentials']['SessionToken'],
-            endpoint_url=s3_endpoint_url
-        )
-
-        response = s3.put_object(Bucket=bucket_name, Key=object_key, Body=csv_content.encode('utf-8'))
+        with ThreadPoolExecutor(max_workers=max_inflight_parts) as executor:
+            for part_number, body in enumerate(iter_parts(blocks, STREAMING_PART_SIZE), start=1):
+                slots.acquire()
+                # Collect finished parts, re-raising the first failure so the upload is aborted early
+                for future in [f for f in pending if f.done()]:
+                    parts.append(future.result())
+                    pending.remove(future)
+                pending.append(executor.submit(upload_part, part_number, body))
+            parts.extend(future.result() for future in pending)
+        parts.sort(key=lambda part: part['PartNumber'])
+        s3.complete_multipart_upload(Bucket=bucket_name, Key=object_key, UploadId=upload_id, MultipartUpload={'Parts': parts})
+        logging.info(f"Multipart upload of {object_key} to {bucket_name} completed with {len(parts)} parts")
+    except Exception:
+        s3.abort_multipart_upload(Bucket=bucket_name, Key=object_key, UploadId=upload_id)
+        raise
+    finally:
+        # In streaming mode the upload is pipelined with reading and classifying the object
+        STAGE_LATENCY.labels('put').observe(time.perf_counter() - start)
+
+def prescan_classification(chunks, shop_id):
+    """ Classify a CSV stream without keeping the output, stopping as soon as personal information is found """
+    classification = new_classification()
+    for _ in transform_csv_chunks(chunks, shop_id, classification):
+        if classification['personal_info']:
+            break
+    return classification
+
+def stream_csv_to_destination(response, bucket_name, object_key, shop_id, s3_endpoint_url, sts_client, personal_info_bucket, no_personal_info_bucket):
+    """ Transform, classify and upload a large object chunk by chunk, returning the destination bucket and the classification """
+    s3_source = get_s3_client(os.getenv('SOURCE_ROLE_ARN'), 'source_session', s3_endpoint_url, sts_client)
+    s3_destination = get_s3_client(os.getenv('DESTINATION_ROLE_ARN'), 'destination_session', s3_endpoint_url, sts_client)
+    classification = new_classification()
+
+    if STREAMING_ROUTING_STRATEGY == 'staged':
+        # Upload to a staging key in the confidential bucket, then copy it to its destination once the verdict is known
+        staging_key = f"{STREAMING_STAGING_PREFIX}{object_key}"
+        blocks = transform_csv_chunks(read_object_chunks(response['Body'], bucket_name), shop_id, classification)
+        multipart_upload_stream(s3_destination, personal_info_bucket, staging_key, blocks)
+        destination_bucket = personal_info_bucket if classification['personal_info'] else no_personal_info_bucket
+        logging.info(f"Copying staged object {staging_key} to destination bucket: {destination_bucket}")
+        s3_destination.copy({'Bucket': personal_info_bucket, 'Key': staging_key}, destination_bucket, object_key)
+        s3_destination.delete_object(Bucket=personal_info_bucket, Key=staging_key)
+        return destination_bucket, classification
+
+    # Pre-scan the object for personal information, this stops reading at the first match
+    prescan = prescan_classification(read_object_chunks(response['Body'], bucket_name), shop_id)
+    response['Body'].close()
+    destination_bucket = personal_info_bucket if prescan['personal_info'] else no_personal_info_bucket
+    logging.info(f"Streaming Object To destination bucket: {destination_bucket}")
+    body = s3_source.get_object(Bucket=bucket_name, Key=object_key)['Body']
+    blocks = transform_csv_chunks(read_object_chunks(body, bucket_name), shop_id, classification)
+    multipart_upload_stream(s3_destination, destination_bucket, object_key, blocks)
+    return destination_bucket, classification
+
+def upload_csv_to_s3(bucket_name, object_key, payload, s3_endpoint_url, sts_client):
+    try:
+        s3 = get_s3_client(os.getenv('DESTINATION_ROLE_ARN'), 'destination_session', s3_endpoint_url, sts_client)
+        with STAGE_LATENCY.labels('put').time():
+            response = s3.put_object(Bucket=bucket_name, Key=object_key, Body=payload)
+        BYTES_OUT.labels(bucket_name).inc(len(payload))
         logging.info(f"Modified CSV uploaded to S3: {object_key}")
     except Exception as e:
         logging.error(f"Error uploading CSV to S3: {e}")
+        raise
 
 def tag_object_as_processed(s3, bucket_name, object_key):
     try:
-        s3.put_object_tagging(
-            Bucket=bucket_name,
-            Key=object_key,
-            Tagging={'TagSet': [{'Key': 'processed', 'Value': 'true'}]}
-        )
+        with STAGE_LATENCY.labels('tag_write').time():
+            s3.put_object_tagging(
+                Bucket=bucket_name,
+                Key=object_key,
+                Tagging={'TagSet': [{'Key': 'processed', 'Value': 'true'}]}
+            )
         logging.info(f"Object tagged as processed: {object_key}")
+        return True
     except Exception as e:
         logging.error(f"Error tagging object as processed: {e}")
+        return False
 
-def is_processed_object(s3, bucket_name, object_key):
+def record_object_as_processed(s3, bucket_name, object_key, etag=None):
+    """ Record the object in the local ledger and queue its processed tag, or tag it right away without a ledger """
+    if processed_ledger is None:
+        return tag_object_as_processed(s3, bucket_name, object_key)
+    processed_ledger.add(bucket_name, object_key, etag)
+    tag_writer.submit(bucket_name, object_key, etag)
+    return True
+
+def is_processed_object(s3, bucket_name, object_key, etag=None):
+    if processed_ledger is not None:
+        if processed_ledger.contains(bucket_name, object_key, etag):
+            return True
+        if not LEDGER_REMOTE_CHECK:
+            return False
     try:
         response = s3.get_object_tagging(Bucket=bucket_name, Key=object_key)
         tags = response['TagSet']
         for tag in tags:
             if tag['Key'] == 'processed' and tag['Value'] == 'true':
+                if processed_ledger is not None:
+                    processed_ledger.add(bucket_name, object_key, etag, tagged=True)
                 return True
         return False
     except s3.exceptions.NoSuchKey:
@@ -225,50 +427,170 @@ def tag_s3_object(s3, bucket_name, object_key, tag_value):
         logging.error(f"Error tagging object {object_key} in {bucket_name} as {tag_value}: {e}")
 
 
-def get_jwt_token(provider_url, client_id, client_secret):
-    username = os.getenv('OIDC_USERNAME')
-    password = os.getenv('OIDC_PASSWORD')
-    token_endpoint = f"{provider_url}/token"
-    
-    payload = {
-        'grant_type': 'password',
-        'client_id': client_id,
-        'client_secret': client_secret,
-        'username': username,
-        'password': password
-    }
-    
+def refresh_time(expires_at):
+    """ When credentials valid until expires_at are renewed, CREDENTIAL_REFRESH_MARGIN seconds before they expire but
+    never earlier than half of their lifetime, so that tokens living no longer than the margin are still reused """
+    return expires_at - min(CREDENTIAL_REFRESH_MARGIN, (expires_at - time.time()) / 2)
+
+def needs_refresh(cached):
+    return time.time() >= cached['refresh_at']
+
+def cached_credential(cache, key):
+    """ The cached entry of key, or None when it is missing or due for refresh """
+    with _credentials_lock:
+        cached = cache.get(key)
+        if cached and not needs_refresh(cached):
+            return cached
+        return None
+
+def refresh_credential(name, cache, key, request):
+    """ Return the cached entry of key, calling request for a new one when it is due for refresh
+
+    Only one thread per credential runs request, without holding _credentials_lock. While it does, the others keep
+    using the cached entry as long as it has not expired, or wait for the new one. request returns the new entry
+    with its expires_at and refresh_at times, which is swapped in under _credentials_lock.
+    """
+    with _credentials_lock:
+        lock = _refresh_locks.setdefault(name, threading.Lock())
+    if not lock.acquire(blocking=False):
+        with _credentials_lock:
+            cached = cache.get(key)
+        if cached and time.time() < cached['expires_at']:
+            return cached
+        lock.acquire()
     try:
-        response = requests.post(token_endpoint, data=payload)
+        # Another thread may have refreshed the entry while this one waited for the lock
+        cached = cached_credential(cache, key)
+        if cached:
+            return cached
+        entry = request()
+        with _credentials_lock:
+            cache[key] = entry
+        return entry
+    finally:
+        lock.release()
+
+def get_jwt_token(provider_url, client_id, client_secret):
+    """ Return the cached OIDC token, requesting a new one when it is close to expiry """
+    cached = cached_credential(_jwt_token_cache, 'token')
+    if cached:
+        return cached['access_token']
+
+    def request_token():
+        username = os.getenv('OIDC_USERNAME')
+        password = os.getenv('OIDC_PASSWORD')
+        token_endpoint = f"{provider_url}/token"
+
+        payload = {
+            'grant_type': 'password',
+            'client_id': client_id,
+            'client_secret': client_secret,
+            'username': username,
+            'password': password
+        }
+
+        with STAGE_LATENCY.labels('oidc').time():
+            response = requests.post(token_endpoint, data=payload)
         response.raise_for_status()
         token_data = response.json()
-        return token_data['access_token']
+        if 'expires_in' not in token_data:
+            # Stored as already expired, the next call requests a new token
+            logging.warning("The OIDC token response has no expires_in, the token is not cached")
+            return {'access_token': token_data['access_token'], 'expires_at': 0, 'refresh_at': 0}
+        expires_at = time.time() + int(token_data['expires_in'])
+        return {'access_token': token_data['access_token'], 'expires_at': expires_at, 'refresh_at': refresh_time(expires_at)}
+
+    try:
+        return refresh_credential('oidc', _jwt_token_cache, 'token', request_token)['access_token']
     except Exception as e:
         logging.error(f"Error obtaining JWT token: {e}")
         return None
 
+def get_sts_client(sts_endpoint_url):
+    with _credentials_lock:
+        if sts_endpoint_url not in _sts_clients:
+            _sts_clients[sts_endpoint_url] = boto3.client('sts', endpoint_url=sts_endpoint_url)
+        return _sts_clients[sts_endpoint_url]
+
+def get_s3_client(role_arn, role_session_name, s3_endpoint_url, sts_client):
+    """ Return a pooled S3 client for role_arn, assuming the role again only when its credentials are close to expiry """
+    cached = cached_credential(_role_s3_clients, role_arn)
+    if cached:
+        return cached['s3']
+
+    def assume_role():
+        provider_url = os.getenv('OIDC_PROVIDER_URL')
+        client_id = os.getenv('OIDC_CLIENT_ID')
+        client_secret = os.getenv('OIDC_CLIENT_SECRET')
+        jwt_token = get_jwt_token(provider_url, client_id, client_secret)
+        with STAGE_LATENCY.labels('sts').time():
+            assumed_role = sts_client.assume_role_with_web_identity(
+                RoleArn=role_arn,
+                RoleSessionName=role_session_name,
+                WebIdentityToken=jwt_token
+            )
+
+        # Initialize S3 client with temporary credentials
+        s3 = boto3.client(
+            's3',
+            aws_access_key_id=assumed_role['Credentials']['AccessKeyId'],
+            aws_secret_access_key=assumed_role['Credentials']['SecretAccessKey'],
+            aws_session_token=assumed_role['Credentials']['SessionToken'],
+            endpoint_url=s3_endpoint_url,
+            config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS)
+        )
+        expires_at = assumed_role['Credentials']['Expiration'].timestamp()
+        logging.info(f"Assumed role {role_arn}, credentials valid until {assumed_role['Credentials']['Expiration']}")
+        return {'s3': s3, 'expires_at': expires_at, 'refresh_at': refresh_time(expires_at)}
+
+    return refresh_credential(f"role:{role_arn}", _role_s3_clients, role_arn, assume_role)['s3']
+
+def process_record(record, s3_endpoint_url, sts_client, personal_info_bucket, no_personal_info_bucket):
+    try:
+        bucket_name = record['s3']['bucket']['name']
+        object_name = record['s3']['object']['key']
+        etag = record['s3']['object'].get('eTag', '').strip('"')
+    except (KeyError, TypeError, AttributeError) as e:
+        logging.error(f"Missing key in notification record: {e}")
+        # Retrying cannot fix a malformed record, so it is reported without failing the event
+        RECORD_RESULTS.labels('invalid').inc()
+        return {'status': 'invalid', 'error': f'Missing key in notification record: {e}'}
+    logging.info(f"{bucket_name} {object_name}")
+    with IN_FLIGHT_RECORDS.track_inprogress(), STAGE_LATENCY.labels('record').time():
+        result = process_csv_files_in_bucket(bucket_name, object_name, s3_endpoint_url, sts_client, personal_info_bucket, no_personal_info_bucket, etag)
+    RECORD_RESULTS.labels(result['status']).inc()
+    return result
+
 @app.route('/', methods=['GET', 'POST'])
+@IN_FLIGHT_REQUESTS.track_inprogress()
 def trigger_process():
     if request.method == 'GET':
         return 'Health OK', 200
     elif request.method == 'POST':
         try:
             event = from_http(request.headers, request.get_data())
-            records = event.data['Records'][0]
-            bucket_name = records['s3']['bucket']['name']
-            object_name = records['s3']['object']['key']
-            logging.info(f"{bucket_name} {object_name}")
+            records = event.data['Records']
 
             s3_endpoint_url = os.getenv('S3_ENDPOINT_URL')
             sts_endpoint_url = os.getenv('STS_ENDPOINT_URL')
             personal_info_bucket = 'confidential'
             no_personal_info_bucket = 'anonymized'
 
-            sts_client = boto3.client('sts', endpoint_url=sts_endpoint_url)
-
-            process_csv_files_in_bucket(bucket_name, object_name ,s3_endpoint_url, sts_client, personal_info_bucket, no_personal_info_bucket)
-
-            return jsonify({'message': 'CSV processing triggered for POST request'}), 204
+            sts_client = get_sts_client(sts_endpoint_url)
+
+            # Every record is processed on the shared pool, a failing record does not affect the others
+            futures = [
+                record_executor.submit(process_record, record, s3_endpoint_url, sts_client, personal_info_bucket, no_personal_info_bucket)
+                for record in records
+            ]
+            results = [future.result() for future in futures]
+            failed = sum(1 for result in results if result['status'] == 'failed')
+            rejected = sum(1 for result in results if result['status'] == 'rejected')
+            logging.info(f"Processed {len(results)} records, {failed} failed, {rejected} rejected")
+
+            # Only a retryable failure makes the event be redelivered, records already processed are skipped then
+            status_code = 500 if failed else 200
+            return jsonify({'message': 'CSV processing completed for POST request', 'records': results}), status_code
         except KeyError as e:
             logging.error(f"Missing key in CloudEvent payload: {e}")
             return jsonify({'error': f'Missing key in CloudEvent payload: {e}'}), 400
@@ -280,8 +602,42 @@ def trigger_process():
 def health_check():
     return 'Health OK', 200
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return generate_latest(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+
+def init_processed_ledger():
+    global processed_ledger, tag_writer
+    if LEDGER_BACKEND == 'none':
+        return
+    if LEDGER_BACKEND != 'sqlite':
+        raise ValueError(f"Unknown LEDGER_BACKEND: {LEDGER_BACKEND}")
+    if os.path.abspath(LEDGER_PATH).startswith('/tmp/'):
+        logging.warning(f"LEDGER_PATH {LEDGER_PATH} is not on a persistent volume, tags not written before a restart are lost with it")
+    processed_ledger = SQLiteLedger(LEDGER_PATH, LEDGER_BLOOM_CAPACITY, LEDGER_BLOOM_ERROR_RATE, LEDGER_RETENTION_SECONDS)
+    tag_writer = TagWriter(
+        processed_ledger,
+        lambda: get_s3_client(os.getenv('SOURCE_ROLE_ARN'), 'source_session', os.getenv('S3_ENDPOINT_URL'), get_sts_client(os.getenv('STS_ENDPOINT_URL'))),
+        tag_object_as_processed,
+        batch_size=TAG_BATCH_SIZE,
+        flush_interval=TAG_FLUSH_INTERVAL,
+        max_attempts=TAG_MAX_ATTEMPTS,
+        retry_backoff=TAG_RETRY_BACKOFF,
+        resync_interval=TAG_RESYNC_INTERVAL
+    )
+    atexit.register(tag_writer.drain, TAG_DRAIN_TIMEOUT)
+    # As PID 1 the process ignores SIGTERM unless it handles it, and is killed without running atexit
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+def handle_sigterm(signum, frame):
+    logging.info("SIGTERM received, writing the queued processed tags before exiting")
+    if tag_writer is not None:
+        tag_writer.drain(TAG_DRAIN_TIMEOUT)
+    sys.exit(0)
+
 if __name__ == "__main__":
     if not check_environment():
         exit(1)
 
+    init_processed_ledger()
     app.run(host='0.0.0.0', port=8080)
@@ -0,0 +1,221 @@
+import hashlib
+import logging
+import math
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BloomFilter:
+    """ Fixed size Bloom filter over strings, using double hashing of a single blake2b digest """
+
+    def __init__(self, capacity, error_rate):
+        capacity = max(capacity, 1)
+        self.size = max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class SQLiteLedger:
+    """ Processed objects keyed by bucket, key and ETag, with a Bloom filter answering most misses from memory """
+
+    def __init__(self, path, bloom_capacity=1000000, bloom_error_rate=0.001, retention_seconds=7 * 24 * 3600):
+        self.retention_seconds = retention_seconds
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS processed_objects ('
+            ' bucket TEXT NOT NULL, object_key TEXT NOT NULL, etag TEXT NOT NULL,'
+            ' processed_at REAL NOT NULL, tagged INTEGER NOT NULL DEFAULT 0,'
+            ' PRIMARY KEY (bucket, object_key, etag))'
+        )
+        self.connection.commit()
+        self.prune()
+        self.bloom = BloomFilter(bloom_capacity, bloom_error_rate)
+        with self.lock:
+            for bucket, object_key, etag in self.connection.execute('SELECT bucket, object_key, etag FROM processed_objects'):
+                self.bloom.add(self._bloom_key(bucket, object_key, etag))
+
+    @staticmethod
+    def _bloom_key(bucket, object_key, etag):
+        return f"{bucket}\0{object_key}\0{etag or ''}"
+
+    def contains(self, bucket, object_key, etag):
+        if self._bloom_key(bucket, object_key, etag) not in self.bloom:
+            return False
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT 1 FROM processed_objects WHERE bucket = ? AND object_key = ? AND etag = ?',
+                (bucket, object_key, etag or '')
+            ).fetchone()
+        return row is not None
+
+    def add(self, bucket, object_key, etag, tagged=False):
+        with self.lock:
+            self.connection.execute(
+                'INSERT INTO processed_objects (bucket, object_key, etag, processed_at, tagged) VALUES (?, ?, ?, ?, ?)'
+                ' ON CONFLICT (bucket, object_key, etag) DO UPDATE SET tagged = MAX(tagged, excluded.tagged)',
+                (bucket, object_key, etag or '', time.time(), int(tagged))
+            )
+            self.connection.commit()
+            self.bloom.add(self._bloom_key(bucket, object_key, etag))
+
+    def mark_tagged(self, entries):
+        with self.lock:
+            self.connection.executemany(
+                'UPDATE processed_objects SET tagged = 1 WHERE bucket = ? AND object_key = ? AND etag = ?',
+                [(bucket, object_key, etag or '') for bucket, object_key, etag in entries]
+            )
+            self.connection.commit()
+
+    def untagged(self):
+        with self.lock:
+            return self.connection.execute('SELECT bucket, object_key, etag FROM processed_objects WHERE tagged = 0').fetchall()
+
+    def prune(self):
+        """ Forget objects processed before the retention period, the lifecycle rule has expired them by then """
+        with self.lock:
+            self.connection.execute(
+                'DELETE FROM processed_objects WHERE tagged = 1 AND processed_at < ?',
+                (time.time() - self.retention_seconds,)
+            )
+            self.connection.commit()
+
+
+class TagWriter:
+    """ Writes the processed tag back to S3 in the background, in batches of up to batch_size objects
+
+    A failed tag is retried after an exponential backoff starting at retry_backoff seconds. After max_attempts it
+    stays untagged in the ledger, and every resync_interval seconds the untagged rows that are not queued anymore
+    are submitted again, so an S3 outage delays the tags instead of losing them.
+    """
+
+    def __init__(self, ledger, client_factory, tag_function, batch_size=100, flush_interval=1.0, workers=4, max_attempts=5,
+                 retry_backoff=1.0, max_retry_backoff=60.0, resync_interval=300.0):
+        self.ledger = ledger
+        self.client_factory = client_factory
+        self.tag_function = tag_function
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+        self.resync_interval = resync_interval
+        self.pending = queue.Queue()
+        # Objects queued or waiting for a retry, so that the resync does not submit them twice
+        self.queued = set()
+        self.queued_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tag-writer')
+        self.thread = threading.Thread(target=self._run, name='tag-writer', daemon=True)
+        self.thread.start()
+        self.resync_thread = threading.Thread(target=self._resync_loop, name='tag-writer-resync', daemon=True)
+        self.resync_thread.start()
+        # Objects processed before a restart whose tag was never written
+        self.resync()
+
+    def submit(self, bucket, object_key, etag):
+        with self.queued_lock:
+            if (bucket, object_key, etag) in self.queued:
+                return
+            self.queued.add((bucket, object_key, etag))
+        self.pending.put((bucket, object_key, etag, 1))
+
+    def resync(self):
+        """ Submit the objects of the ledger whose tag has not been written """
+        for bucket, object_key, etag in self.ledger.untagged():
+            self.submit(bucket, object_key, etag)
+
+    def _resync_loop(self):
+        while not self.stopped.wait(self.resync_interval):
+            try:
+                self.resync()
+            except Exception as e:
+                logging.error(f"Error resubmitting untagged objects: {e}")
+
+    def _next_batch(self):
+        batch = [self.pending.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.pending.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self.flush(batch)
+            except Exception as e:
+                logging.error(f"Error writing processed tags: {e}")
+                self.retry(batch)
+            finally:
+                for _ in batch:
+                    self.pending.task_done()
+
+    def _done(self, items):
+        with self.queued_lock:
+            for bucket, object_key, etag, _ in items:
+                self.queued.discard((bucket, object_key, etag))
+
+    def retry(self, batch):
+        """ Requeue the failed items of a batch after their backoff, the ones out of attempts are left to the resync """
+        retries = {}
+        for item in batch:
+            bucket, object_key, etag, attempt = item
+            if attempt < self.max_attempts:
+                retries.setdefault(attempt, []).append((bucket, object_key, etag, attempt + 1))
+            else:
+                logging.error(f"Tagging {object_key} in {bucket} as processed failed {attempt} times, "
+                              f"it stays untagged in the ledger until the next resync")
+                self._done([item])
+        for attempt, items in retries.items():
+            delay = min(self.retry_backoff * 2 ** (attempt - 1), self.max_retry_backoff)
+            timer = threading.Timer(delay, lambda items=items: [self.pending.put(item) for item in items])
+            timer.daemon = True
+            timer.start()
+
+    def flush(self, batch):
+        s3 = self.client_factory()
+        futures = [(item, self.executor.submit(self.tag_function, s3, item[0], item[1])) for item in batch]
+        tagged = [item for item, future in futures if future.result()]
+        self.retry([item for item, future in futures if not future.result()])
+        self.ledger.mark_tagged([item[:3] for item in tagged])
+        self._done(tagged)
+        logging.info(f"Tagged {len(tagged)} of {len(batch)} objects as processed")
+
+    def drain(self, timeout=None):
+        """ Wait until every queued tag has been written or failed, at most timeout seconds
+
+        Tags waiting for a retry are not waited for, they stay untagged in the ledger and are written after a restart.
+        """
+        self.stopped.set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.pending.unfinished_tasks:
+            if deadline is not None and time.monotonic() >= deadline:
+                logging.warning(f"{self.pending.unfinished_tasks} processed tags still queued at shutdown")
+                return False
+            time.sleep(0.1)
+        return True
@@ -0,0 +1,71 @@
+import os
+import time
+import argparse
+import cidr_filter
+import process_ingest_to_raw as app
+
+
+def run_timed(name, results, stats, repeat_index):
+    start = time.perf_counter()
+    bytes_out = sum(len(data) for data in results)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<10} run {repeat_index}: {elapsed:8.3f}s, {bytes_out} bytes returned, stats {stats}")
+    return elapsed, bytes_out
+
+
+def benchmark_local_file(csv_file, cidr_range, repeat):
+    """ Time the local engine alone on a CSV file, e.g. one written by dataset_generator_online_store.py """
+    starts, ends = cidr_filter.parse_cidr_ranges(cidr_range)
+    with open(csv_file, 'rb') as f:
+        columns = f.readline().decode('utf-8').strip().split(',')
+    file_size = os.path.getsize(csv_file)
+    for repeat_index in range(1, repeat + 1):
+        stats = {}
+        with open(csv_file, 'rb') as f:
+            batches = app.count_rows(cidr_filter.csv_batches(f, columns, app.LOCAL_FILTER_BLOCK_SIZE), stats, 'RowsScanned')
+            batches = app.count_rows(cidr_filter.filter_batches(batches, starts, ends), stats, 'RowsReturned')
+            elapsed, _ = run_timed('local', cidr_filter.csv_output(batches), stats, repeat_index)
+        print(f"{'':<10} {stats['RowsScanned'] / elapsed:,.0f} rows/s, {file_size / elapsed / 1024 / 1024:,.1f} MiB/s")
+
+
+def benchmark_s3(bucket, key, cidr_range, repeat):
+    """ Time the S3 Select path and the local engine on the same object, without writing the results """
+    s3 = app.get_s3_client(os.getenv('SOURCE_ROLE_ARN'), 'benchmarkSession')
+    if not s3:
+        raise SystemExit("Failed to obtain credentials for SOURCE_ROLE_ARN")
+    object_size = s3.head_object(Bucket=bucket, Key=key)['ContentLength']
+    query = app.build_select_query(cidr_range)
+    totals = {'s3select': 0.0, 'local': 0.0}
+    for repeat_index in range(1, repeat + 1):
+        stats = {}
+        if app.SELECT_PARALLELISM > 1 and object_size > app.SELECT_SCAN_RANGE_SIZE:
+            results = app.parallel_s3_select(bucket, key, cidr_range, s3, stats, object_size)
+        else:
+            results = app.s3_select_query(bucket, key, query, s3, stats)
+        totals['s3select'] += run_timed('s3select', results, stats, repeat_index)[0]
+        stats = {}
+        totals['local'] += run_timed('local', app.local_csv_filter(bucket, key, cidr_range, s3, stats), stats, repeat_index)[0]
+    for name, total in totals.items():
+        print(f"{name:<10} mean {total / repeat:8.3f}s, {object_size / (total / repeat) / 1024 / 1024:,.1f} MiB/s")
+    print("Note: the S3 Select path matches LIKE patterns while the local engine matches CIDR blocks, row counts can differ.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the local CIDR filter engine against S3 Select on browsing logs.')
+    parser.add_argument('--file', help='Local CSV file, benchmarks the local engine only')
+    parser.add_argument('--bucket', help='Bucket of the object to benchmark both engines on')
+    parser.add_argument('--key', help='Key of the object to benchmark both engines on')
+    parser.add_argument('--cidr-ranges', default=os.getenv('CIDR_RANGES', '10.0.0.0/24|192.168.0.0/16'), help="'|' separated CIDR blocks")
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs of each engine')
+    args = parser.parse_args()
+
+    if args.file:
+        benchmark_local_file(args.file, args.cidr_ranges, args.repeat)
+    elif args.bucket and args.key:
+        benchmark_s3(args.bucket, args.key, args.cidr_ranges, args.repeat)
+    else:
+        parser.error('either --file or --bucket and --key are required')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import io
+import ipaddress
+import logging
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+
+IPV4_PATTERN = r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$'
+
+
+def parse_cidr_ranges(cidr_range):
+    """ Build a sorted, merged interval index (starts, ends) of IPv4 addresses from a '|' separated CIDR_RANGES value """
+    intervals = []
+    for part in cidr_range.split('|'):
+        part = part.strip()
+        if not part:
+            continue
+        if part.endswith('.%'):
+            # Prefix patterns of the S3 Select path, e.g. 10.% or 192.168.%
+            octets = part[:-2].split('.')
+            part = '.'.join(octets + ['0'] * (4 - len(octets))) + f"/{8 * len(octets)}"
+        network = ipaddress.IPv4Network(part, strict=False)
+        intervals.append((int(network.network_address), int(network.broadcast_address)))
+    intervals.sort()
+    merged = []
+    for start, end in intervals:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    starts = np.array([start for start, _ in merged], dtype=np.int64)
+    ends = np.array([end for _, end in merged], dtype=np.int64)
+    return starts, ends
+
+
+def ipv4_to_int(ips):
+    """ Convert an Arrow string array of IPv4 addresses to int64, -1 for null or malformed addresses """
+    valid = pc.fill_null(pc.match_substring_regex(ips, IPV4_PATTERN), False)
+    octets = pc.split_pattern(pc.if_else(valid, ips, '0.0.0.0'), '.')
+    octets = pc.cast(pc.list_flatten(octets), pa.int64()).to_numpy().reshape(-1, 4)
+    addresses = (octets[:, 0] << 24) | (octets[:, 1] << 16) | (octets[:, 2] << 8) | octets[:, 3]
+    valid = valid.to_numpy(zero_copy_only=False) & (octets.max(axis=1) <= 255)
+    return np.where(valid, addresses, -1)
+
+
+def in_ranges(addresses, starts, ends):
+    """ Vectorized membership of addresses in the interval index """
+    if not len(starts):
+        return np.zeros(len(addresses), dtype=bool)
+    index = np.searchsorted(starts, addresses, side='right') - 1
+    return (index >= 0) & (addresses <= ends[np.clip(index, 0, None)])
+
+
+def filter_batches(batches, starts, ends, ip_column='ip'):
+    """ Yield each record batch without the rows whose ip falls in one of the ranges, malformed ips are kept """
+    for batch in batches:
+        if not batch.num_rows:
+            continue
+        ips = batch.column(batch.schema.get_field_index(ip_column))
+        if ips.type != pa.string():
+            ips = pc.cast(ips, pa.string())
+        keep = ~in_ranges(ipv4_to_int(ips), starts, ends)
+        yield batch.filter(pa.array(keep))
+
+
+def csv_batches(stream, columns, block_size):
+    """ Read a CSV stream in record batches, keeping every column as a string so rows are written back unchanged """
+    reader = pv.open_csv(
+        stream,
+        read_options=pv.ReadOptions(block_size=block_size),
+        convert_options=pv.ConvertOptions(column_types={name: pa.string() for name in columns}, strings_can_be_null=False)
+    )
+    for batch in reader:
+        yield batch
+
+
+def needs_quoting(batch):
+    for column in batch.columns:
+        if pa.types.is_string(column.type) and pc.any(pc.match_substring_regex(column, r'[,"\r\n]')).as_py():
+            return True
+    return False
+
+
+def csv_output(batches):
+    """ Yield the batches as CSV bytes without header and quoting values only when needed, like the S3 Select CSV output """
+    plain = pv.WriteOptions(include_header=False, quoting_style='none')
+    quoted = pv.WriteOptions(include_header=False, quoting_style='needed')
+    for batch in batches:
+        sink = io.BytesIO()
+        pv.write_csv(batch, sink, write_options=quoted if needs_quoting(batch) else plain)
+        yield sink.getvalue()
+
+
+def parquet_batches(source, batch_size):
+    parquet_file = pq.ParquetFile(source)
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+        yield batch
+
+
+def write_parquet(batches, sink, schema):
+    """ Write batches to sink as Parquet, returning the number of rows written """
+    rows = 0
+    with pq.ParquetWriter(sink, schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    logging.info(f"Wrote {rows} filtered rows as Parquet")
+    return rows
@@ -1,13 +1,56 @@
 import os
+import time
+import json
 import logging
+import itertools
+import collections
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import boto3
 import requests
+from botocore.config import Config
 from flask import Flask, request, jsonify
+import cidr_filter
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 
 app = Flask(__name__)
 __version__ = "1.2.0"
 logging.basicConfig(level=logging.INFO, format=f'%(asctime)s - %(levelname)s - Script Version {__version__} - %(message)s')
 
+# Credentials are refreshed this many seconds before they expire
+CREDENTIAL_REFRESH_MARGIN = int(os.getenv('CREDENTIAL_REFRESH_MARGIN', '300'))
+S3_MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', '20'))
+# S3 Select results are uploaded in parts of STREAMING_PART_SIZE, holding at most STREAMING_BUFFER_SIZE bytes of parts in memory
+STREAMING_PART_SIZE = max(int(os.getenv('STREAMING_PART_SIZE', str(8 * 1024 * 1024))), 5 * 1024 * 1024)
+STREAMING_BUFFER_SIZE = int(os.getenv('STREAMING_BUFFER_SIZE', str(64 * 1024 * 1024)))
+# Objects bigger than SELECT_SCAN_RANGE_SIZE are filtered by SELECT_PARALLELISM concurrent S3 Select requests,
+# each over a ScanRange aligned to CSV record boundaries; 1 keeps a single request per object
+SELECT_PARALLELISM = int(os.getenv('SELECT_PARALLELISM', '1'))
+SELECT_SCAN_RANGE_SIZE = int(os.getenv('SELECT_SCAN_RANGE_SIZE', str(64 * 1024 * 1024)))
+SELECT_ALIGN_WINDOW = 64 * 1024
+# Result bytes a scan range buffers while the ranges before it are still being uploaded
+SELECT_RANGE_BUFFER_SIZE = int(os.getenv('SELECT_RANGE_BUFFER_SIZE', str(8 * 1024 * 1024)))
+# 's3select' filters with S3 Select LIKE patterns on RGW, 'local' with the vectorized CIDR engine in cidr_filter.py
+FILTER_ENGINE = os.getenv('FILTER_ENGINE', 's3select')
+LOCAL_FILTER_BLOCK_SIZE = int(os.getenv('LOCAL_FILTER_BLOCK_SIZE', str(8 * 1024 * 1024)))
+LOCAL_FILTER_BATCH_ROWS = int(os.getenv('LOCAL_FILTER_BATCH_ROWS', '65536'))
+
+# Process-wide cache of the OIDC token, the STS client and per role S3 clients
+_credentials_lock = threading.RLock()
+_jwt_token_cache = {}
+_sts_client = None
+_role_s3_clients = {}
+
+# Prometheus metrics exposed on /metrics
+STAGE_LATENCY = Histogram(
+    'ingest_stage_duration_seconds', 'Time spent in each stage of the ingest pipeline', ['stage'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+)
+BYTES_IN = Counter('ingest_bytes_in_total', 'Bytes scanned by S3 Select in the source bucket', ['bucket'])
+BYTES_OUT = Counter('ingest_bytes_out_total', 'Bytes written to each destination bucket', ['bucket'])
+IN_FLIGHT_REQUESTS = Gauge('ingest_in_flight_requests', 'POST requests being processed')
+
 def check_environment():
     missing_params = []
     required_env_vars = [
@@ -23,45 +66,72 @@ def check_environment():
         return False
     return True
 
+def refresh_time(expires_at):
+    """ When credentials valid until expires_at are renewed, CREDENTIAL_REFRESH_MARGIN seconds before they expire but
+    never earlier than half of their lifetime, so that tokens living no longer than the margin are still reused """
+    return expires_at - min(CREDENTIAL_REFRESH_MARGIN, (expires_at - time.time()) / 2)
+
+def needs_refresh(cached):
+    return time.time() >= cached['refresh_at']
+
 def get_jwt_token(provider_url, client_id, client_secret):
-    username = os.getenv('OIDC_USERNAME')
-    password = os.getenv('OIDC_PASSWORD')
-    token_endpoint = f"{provider_url}/token"
-    payload = {
-        'grant_type': 'password',
-        'client_id': client_id,
-        'client_secret': client_secret,
-        'username': username,
-        'password': password
-    }
-    try:
-        response = requests.post(token_endpoint, data=payload)
-        response.raise_for_status()
-        token_data = response.json()
-        return token_data['access_token']
-    except requests.exceptions.HTTPError as e:
-        logging.error(f"HTTP Error obtaining JWT token: {e}, Status Code: {e.response.status_code}")
-        return None
-    except Exception as e:
-        logging.error(f"Error obtaining JWT token: {e}")
-        return None
+    with _credentials_lock:
+        if _jwt_token_cache and not needs_refresh(_jwt_token_cache):
+            return _jwt_token_cache['access_token']
+        username = os.getenv('OIDC_USERNAME')
+        password = os.getenv('OIDC_PASSWORD')
+        token_endpoint = f"{provider_url}/token"
+        payload = {
+            'grant_type': 'password',
+            'client_id': client_id,
+            'client_secret': client_secret,
+            'username': username,
+            'password': password
+        }
+        try:
+            with STAGE_LATENCY.labels('oidc').time():
+                response = requests.post(token_endpoint, data=payload)
+            response.raise_for_status()
+            token_data = response.json()
+            _jwt_token_cache.clear()
+            if 'expires_in' in token_data:
+                _jwt_token_cache['access_token'] = token_data['access_token']
+                _jwt_token_cache['refresh_at'] = refresh_time(time.time() + int(token_data['expires_in']))
+            else:
+                logging.warning("The OIDC token response has no expires_in, the token is not cached")
+            return token_data['access_token']
+        except requests.exceptions.HTTPError as e:
+            logging.error(f"HTTP Error obtaining JWT token: {e}, Status Code: {e.response.status_code}")
+            return None
+        except Exception as e:
+            logging.error(f"Error obtaining JWT token: {e}")
+            return None
+
+def get_sts_client():
+    global _sts_client
+    with _credentials_lock:
+        if _sts_client is None:
+            _sts_client = boto3.client(
+                'sts',
+                region_name=os.getenv('AWS_DEFAULT_REGION'),
+                endpoint_url=os.getenv('STS_ENDPOINT_URL')
+            )
+        return _sts_client
 
 def assume_role_with_web_identity(role_arn, role_session_name, jwt_token):
-    sts_client = boto3.client(
-        'sts',
-        region_name=os.getenv('AWS_DEFAULT_REGION'),
-        endpoint_url=os.getenv('STS_ENDPOINT_URL')
-    )
+    sts_client = get_sts_client()
     try:
-        assumed_role = sts_client.assume_role_with_web_identity(
-            RoleArn=role_arn,
-            RoleSessionName=role_session_name,
-            WebIdentityToken=jwt_token
-        )
+        with STAGE_LATENCY.labels('sts').time():
+            assumed_role = sts_client.assume_role_with_web_identity(
+                RoleArn=role_arn,
+                RoleSessionName=role_session_name,
+                WebIdentityToken=jwt_token
+            )
         return {
             'aws_access_key_id': assumed_role['Credentials']['AccessKeyId'],
             'aws_secret_access_key': assumed_role['Credentials']['SecretAccessKey'],
-            'aws_session_token': assumed_role['Credentials']['SessionToken']
+            'aws_session_token': assumed_role['Credentials']['SessionToken'],
+            'expiration': assumed_role['Credentials']['Expiration']
         }
     except Exception as e:
         logging.error("Error assuming role with web identity: %s", str(e))
@@ -74,87 +144,364 @@ def initialize_s3_client(role_credentials):
         aws_secret_access_key=role_credentials['aws_secret_access_key'],
         aws_session_token=role_credentials['aws_session_token'],
         region_name=os.getenv('AWS_DEFAULT_REGION'),
-        endpoint_url=os.getenv('S3_ENDPOINT_URL')
+        endpoint_url=os.getenv('S3_ENDPOINT_URL'),
+        config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS)
+    )
+
+def get_s3_client(role_arn, role_session_name):
+    """ Return a pooled S3 client for role_arn, assuming the role again only when its credentials are close to expiry """
+    with _credentials_lock:
+        cached = _role_s3_clients.get(role_arn)
+        if cached and not needs_refresh(cached):
+            return cached['s3']
+        jwt_token = get_jwt_token(os.getenv('OIDC_PROVIDER_URL'), os.getenv('OIDC_CLIENT_ID'), os.getenv('OIDC_CLIENT_SECRET'))
+        if not jwt_token:
+            logging.error("Failed to obtain JWT token, cannot assume role %s.", role_arn)
+            return None
+        role_credentials = assume_role_with_web_identity(role_arn, role_session_name, jwt_token)
+        if not role_credentials:
+            return None
+        s3 = initialize_s3_client(role_credentials)
+        _role_s3_clients[role_arn] = {'s3': s3, 'refresh_at': refresh_time(role_credentials['expiration'].timestamp())}
+        logging.info("Assumed role %s, credentials valid until %s", role_arn, role_credentials['expiration'])
+        return s3
+
+def build_select_query(cidr_range, ip_column='ip'):
+    """ Build the S3 Select expression dropping rows whose ip matches one of the CIDR_RANGES patterns """
+    query_parts = cidr_range.split('|')
+    condition = " OR ".join([f"{ip_column} LIKE '{part}'" for part in query_parts])
+    return f"SELECT * FROM S3Object WHERE NOT ({condition});"
+
+def s3_select_query(bucket_name, object_key, query, s3_client, stats, scan_range=None, file_header_info='USE'):
+    """ Yield the result of an S3 Select query as raw CSV bytes, filling stats from its Stats event """
+    logging.info(f"Executing S3 Select on Bucket: '{bucket_name}', Key: '{object_key}', Query: '{query}', ScanRange: {scan_range}")
+    select_args = {}
+    if scan_range:
+        select_args['ScanRange'] = scan_range
+    response = s3_client.select_object_content(
+        Bucket=bucket_name,
+        Key=object_key,
+        ExpressionType='SQL',
+        Expression=query,
+        InputSerialization={'CSV': {"FileHeaderInfo": file_header_info}},
+        OutputSerialization={'CSV': {}},
+        **select_args
     )
+    for event in response['Payload']:
+        if 'Records' in event:
+            yield event['Records']['Payload']
+        elif 'Stats' in event:
+            stats.update(event['Stats']['Details'])
+            BYTES_IN.labels(bucket_name).inc(stats.get('BytesScanned', 0))
+            logging.info(f"Statistics: {json.dumps(stats)}")
+        elif 'End' in event:
+            logging.info("Reached end of the data stream.")
+
+def read_range(s3_client, bucket_name, object_key, start, end):
+    response = s3_client.get_object(Bucket=bucket_name, Key=object_key, Range=f"bytes={start}-{end - 1}")
+    return response['Body'].read()
+
+def find_record_boundary(s3_client, bucket_name, object_key, offset, object_size):
+    """ Return the offset of the first CSV record starting at or after offset """
+    if offset == 0:
+        return 0
+    # The record containing offset - 1 ends at the first newline from there
+    position = offset - 1
+    while position < object_size:
+        window = read_range(s3_client, bucket_name, object_key, position, min(position + SELECT_ALIGN_WINDOW, object_size))
+        newline = window.find(b'\n')
+        if newline >= 0:
+            return position + newline + 1
+        position += len(window)
+    return object_size
+
+def read_header(s3_client, bucket_name, object_key, object_size):
+    """ Return the column names of the CSV header """
+    header_end = find_record_boundary(s3_client, bucket_name, object_key, 1, object_size)
+    header = read_range(s3_client, bucket_name, object_key, 0, header_end)
+    return header.decode('utf-8').strip().split(',')
+
+class RangeBuffer:
+    """ Result chunks of one scan range, handed in order from its worker to the consumer
+
+    put blocks while max_bytes are buffered, so a range that finishes ahead of the ones before it waits instead of
+    holding its whole result. cancel wakes up a blocked worker and makes it stop.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.chunks = collections.deque()
+        self.size = 0
+        self.finished = False
+        self.cancelled = False
+        self.error = None
+        self.condition = threading.Condition()
+
+    def put(self, chunk):
+        """ Buffer a chunk, returns False when the consumer cancelled the range """
+        with self.condition:
+            while self.size >= self.max_bytes and not self.cancelled:
+                self.condition.wait()
+            if self.cancelled:
+                return False
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+            self.condition.notify_all()
+            return True
+
+    def close(self, error=None):
+        with self.condition:
+            self.finished = True
+            self.error = error
+            self.condition.notify_all()
+
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            self.chunks.clear()
+            self.condition.notify_all()
 
-def s3_select_query(bucket_name, object_key, query, s3_client):
-    logging.info(f"Executing S3 Select on Bucket: '{bucket_name}', Key: '{object_key}', Query: '{query}'")
+    def __iter__(self):
+        while True:
+            with self.condition:
+                while not self.chunks and not self.finished:
+                    self.condition.wait()
+                if not self.chunks:
+                    if self.error:
+                        raise self.error
+                    return
+                chunk = self.chunks.popleft()
+                self.size -= len(chunk)
+                self.condition.notify_all()
+            yield chunk
+
+def parallel_s3_select(bucket_name, object_key, cidr_range, s3_client, stats, object_size):
+    """ Run one S3 Select per scan range concurrently and yield their results in object order
+
+    Range index covers the records starting in [index * SELECT_SCAN_RANGE_SIZE, (index + 1) * SELECT_SCAN_RANGE_SIZE),
+    each worker aligns its own boundaries to CSV records, so no request waits for a serial boundary scan. At most
+    SELECT_PARALLELISM ranges run at once, each buffering at most SELECT_RANGE_BUFFER_SIZE bytes of its result.
+    """
+    range_count = -(-object_size // SELECT_SCAN_RANGE_SIZE)
+    range_stats = [{} for _ in range(range_count)]
+    header_lock = threading.Lock()
+    header = []
+    logging.info(f"Filtering {object_key} with {range_count} scan ranges, {SELECT_PARALLELISM} at a time")
+
+    def positional_query():
+        # Only the first range contains the header, the others address the ip column by position
+        with header_lock:
+            if not header:
+                header.extend(read_header(s3_client, bucket_name, object_key, object_size))
+        return build_select_query(cidr_range, f"_{header.index('ip') + 1}")
+
+    def select_range(index, buffer):
+        try:
+            start = find_record_boundary(s3_client, bucket_name, object_key, index * SELECT_SCAN_RANGE_SIZE, object_size)
+            end = find_record_boundary(s3_client, bucket_name, object_key, min((index + 1) * SELECT_SCAN_RANGE_SIZE, object_size), object_size)
+            # A record longer than the range leaves it empty, the range where the record starts returns it
+            if start < end:
+                if index == 0:
+                    query, file_header_info = build_select_query(cidr_range), 'USE'
+                else:
+                    query, file_header_info = positional_query(), 'NONE'
+                scan_range = {'Start': start, 'End': end - 1}
+                for chunk in s3_select_query(bucket_name, object_key, query, s3_client, range_stats[index], scan_range, file_header_info):
+                    if not buffer.put(chunk):
+                        return
+            buffer.close()
+        except Exception as e:
+            buffer.close(e)
+
+    buffers = [RangeBuffer(SELECT_RANGE_BUFFER_SIZE) for _ in range(range_count)]
+    try:
+        with ThreadPoolExecutor(max_workers=SELECT_PARALLELISM) as executor:
+            try:
+                # Sliding window: a range is started when the one SELECT_PARALLELISM places before it is consumed
+                for index in range(min(SELECT_PARALLELISM, range_count)):
+                    executor.submit(select_range, index, buffers[index])
+                for index in range(range_count):
+                    yield from buffers[index]
+                    buffers[index] = None
+                    next_index = index + SELECT_PARALLELISM
+                    if next_index < range_count:
+                        executor.submit(select_range, next_index, buffers[next_index])
+            finally:
+                # Stops the running workers when the upload fails or the consumer stops early
+                for buffer in buffers:
+                    if buffer is not None:
+                        buffer.cancel()
+    finally:
+        for details in range_stats:
+            for name, value in details.items():
+                stats[name] = stats.get(name, 0) + value
+
+def count_rows(batches, stats, name):
+    for batch in batches:
+        stats[name] = stats.get(name, 0) + batch.num_rows
+        yield batch
+
+def local_csv_filter(bucket_name, object_key, cidr_range, s3_client, stats):
+    """ Yield the CSV rows of the object whose ip is outside CIDR_RANGES, filtered locally in Arrow batches """
+    starts, ends = cidr_filter.parse_cidr_ranges(cidr_range)
+    response = s3_client.get_object(Bucket=bucket_name, Key=object_key)
+    object_size = response['ContentLength']
+    stats['BytesScanned'] = object_size
+    if not object_size:
+        return
+    BYTES_IN.labels(bucket_name).inc(object_size)
+    columns = read_header(s3_client, bucket_name, object_key, object_size)
+    batches = count_rows(cidr_filter.csv_batches(response['Body'], columns, LOCAL_FILTER_BLOCK_SIZE), stats, 'RowsScanned')
+    batches = count_rows(cidr_filter.filter_batches(batches, starts, ends), stats, 'RowsReturned')
+    for data in cidr_filter.csv_output(batches):
+        stats['BytesReturned'] = stats.get('BytesReturned', 0) + len(data)
+        yield data
+
+def local_parquet_filter(bucket_name, object_key, cidr_range, s3_source, s3_destination, destination_bucket, stats):
+    """ Filter a Parquet object locally and upload the kept rows as Parquet, returning the bytes written """
+    starts, ends = cidr_filter.parse_cidr_ranges(cidr_range)
+    with tempfile.TemporaryFile() as source, tempfile.TemporaryFile() as output:
+        s3_source.download_fileobj(bucket_name, object_key, source)
+        stats['BytesScanned'] = source.tell()
+        BYTES_IN.labels(bucket_name).inc(stats['BytesScanned'])
+        source.seek(0)
+        schema = cidr_filter.pq.ParquetFile(source).schema_arrow
+        source.seek(0)
+        batches = count_rows(cidr_filter.parquet_batches(source, LOCAL_FILTER_BATCH_ROWS), stats, 'RowsScanned')
+        batches = count_rows(cidr_filter.filter_batches(batches, starts, ends), stats, 'RowsReturned')
+        if not cidr_filter.write_parquet(batches, output, schema):
+            return 0
+        stats['BytesReturned'] = output.tell()
+        output.seek(0)
+        s3_destination.upload_fileobj(output, destination_bucket, object_key)
+        return stats['BytesReturned']
+
+def iter_parts(blocks, part_size):
+    """ Regroup byte blocks into upload parts of at least part_size bytes, the last one may be smaller """
+    buffer = bytearray()
+    for block in blocks:
+        buffer += block
+        if len(buffer) >= part_size:
+            yield bytes(buffer)
+            buffer = bytearray()
+    if buffer:
+        yield bytes(buffer)
+
+def multipart_upload_stream(s3, bucket_name, object_key, parts_iter):
+    """ Upload parts with a concurrent multipart upload, keeping at most STREAMING_BUFFER_SIZE bytes of parts in flight """
+    max_inflight_parts = max(STREAMING_BUFFER_SIZE // STREAMING_PART_SIZE, 1)
+    slots = threading.BoundedSemaphore(max_inflight_parts)
+    upload_id = s3.create_multipart_upload(Bucket=bucket_name, Key=object_key)['UploadId']
+
+    def upload_part(part_number, body):
+        try:
+            response = s3.upload_part(Bucket=bucket_name, Key=object_key, UploadId=upload_id, PartNumber=part_number, Body=body)
+            return {'PartNumber': part_number, 'ETag': response['ETag'], 'Size': len(body)}
+        finally:
+            slots.release()
+
+    parts = []
+    pending = []
     try:
-        response = s3_client.select_object_content(
-            Bucket=bucket_name,
-            Key=object_key,
-            ExpressionType='SQL',
-            Expression=query,
-            InputSerialization={'CSV': {"FileHeaderInfo": "USE"}},
-            OutputSerialization={'CSV': {}},
+        with ThreadPoolExecutor(max_workers=max_inflight_parts) as executor:
+            for part_number, body in enumerate(parts_iter, start=1):
+                slots.acquire()
+                # Collect finished parts, re-raising the first failure so the upload is aborted early
+                for future in [f for f in pending if f.done()]:
+                    parts.append(future.result())
+                    pending.remove(future)
+                pending.append(executor.submit(upload_part, part_number, body))
+            parts.extend(future.result() for future in pending)
+        parts.sort(key=lambda part: part['PartNumber'])
+        s3.complete_multipart_upload(
+            Bucket=bucket_name, Key=object_key, UploadId=upload_id,
+            MultipartUpload={'Parts': [{'PartNumber': part['PartNumber'], 'ETag': part['ETag']} for part in parts]}
         )
-        result_data = ''
-        for event in response['Payload']:
-            if 'Records' in event:
-                result_data += event['Records']['Payload'].decode('utf-8')
-            elif 'Stats' in event:
-                stats = event['Stats']['Details']
-                logging.info(f"Statistics: {stats}")
-            elif 'End' in event:
-                logging.info("Reached end of the data stream.")
-        return result_data
-    except Exception as e:
-        logging.error("Error during S3 Select: %s", str(e))
-        return None
+        logging.info(f"Multipart upload of {object_key} to {bucket_name} completed with {len(parts)} parts")
+        return sum(part['Size'] for part in parts)
+    except Exception:
+        s3.abort_multipart_upload(Bucket=bucket_name, Key=object_key, UploadId=upload_id)
+        raise
+
+def upload_stream(s3, bucket_name, object_key, blocks):
+    """ Upload byte blocks to bucket_name, with a single put when they fit in one part, returning the bytes written or 0 when there was no data """
+    parts_iter = iter_parts(blocks, STREAMING_PART_SIZE)
+    first_part = next(parts_iter, None)
+    if first_part is None:
+        return 0
+    second_part = next(parts_iter, None)
+    if second_part is None:
+        s3.put_object(Bucket=bucket_name, Key=object_key, Body=first_part)
+        return len(first_part)
+    return multipart_upload_stream(s3, bucket_name, object_key, itertools.chain([first_part, second_part], parts_iter))
 
 def tag_object_as_processed(s3, bucket_name, object_key):
     try:
-        s3.put_object_tagging(
-            Bucket=bucket_name,
-            Key=object_key,
-            Tagging={'TagSet': [{'Key': 'processed', 'Value': 'true'}]}
-        )
+        with STAGE_LATENCY.labels('tagging').time():
+            s3.put_object_tagging(
+                Bucket=bucket_name,
+                Key=object_key,
+                Tagging={'TagSet': [{'Key': 'processed', 'Value': 'true'}]}
+            )
         logging.info(f"Object tagged as processed: {object_key}")
     except Exception as e:
         logging.error(f"Error tagging object as processed: {e}")
 
+def filter_to_destination(source_bucket, object_key, query, cidr_range, s3_source, s3_destination, destination_bucket, stats):
+    """ Filter the object with the configured FILTER_ENGINE and write the result to the destination, returning the bytes written """
+    if FILTER_ENGINE == 'local':
+        if object_key.endswith('.parquet'):
+            return local_parquet_filter(source_bucket, object_key, cidr_range, s3_source, s3_destination, destination_bucket, stats)
+        results = local_csv_filter(source_bucket, object_key, cidr_range, s3_source, stats)
+    else:
+        object_size = None
+        if SELECT_PARALLELISM > 1:
+            object_size = s3_source.head_object(Bucket=source_bucket, Key=object_key)['ContentLength']
+        if object_size and object_size > SELECT_SCAN_RANGE_SIZE:
+            results = parallel_s3_select(source_bucket, object_key, cidr_range, s3_source, stats, object_size)
+        else:
+            results = s3_select_query(source_bucket, object_key, query, s3_source, stats)
+    return upload_stream(s3_destination, destination_bucket, object_key, results)
+
 @app.route('/', methods=['POST'])
+@IN_FLIGHT_REQUESTS.track_inprogress()
+@STAGE_LATENCY.labels('request').time()
 def trigger_processing():
     source_bucket = request.json.get('source_bucket')
     object_key = request.json.get('object_key')
     destination_bucket = os.getenv('DESTINATION_BUCKET')
     cidr_range = os.getenv('CIDR_RANGES')
-    provider_url = os.getenv('OIDC_PROVIDER_URL')
-    client_id = os.getenv('OIDC_CLIENT_ID')
-    client_secret = os.getenv('OIDC_CLIENT_SECRET')
-    jwt_token = get_jwt_token(provider_url, client_id, client_secret)
-    if not jwt_token:  
-        logging.error("Failed to obtain JWT token, cannot proceed with processing.")
+    s3_source = get_s3_client(os.getenv('SOURCE_ROLE_ARN'), 'sourceSession')
+    s3_destination = get_s3_client(os.getenv('DESTINATION_ROLE_ARN'), 'destinationSession')
+    if not s3_source or not s3_destination:
+        logging.error("Failed to obtain role credentials, cannot proceed with processing.")
         return jsonify({'error': 'Failed to obtain necessary authentication token'})
-    source_credentials = assume_role_with_web_identity(os.getenv('SOURCE_ROLE_ARN'), 'sourceSession', jwt_token)
-    destination_credentials = assume_role_with_web_identity(os.getenv('DESTINATION_ROLE_ARN'), 'destinationSession', jwt_token)
-    s3_source = initialize_s3_client(source_credentials)
-    s3_destination = initialize_s3_client(destination_credentials)
     # Construct the S3 Select SQL expression based on CIDR range
-    query_parts = cidr_range.split('|')
-    condition = " OR ".join([f"ip LIKE '{part}'" for part in query_parts])
-    query = f"SELECT * FROM S3Object WHERE NOT ({condition});"
+    query = build_select_query(cidr_range)
     logging.info(f"Executing S3 Select with query: {query}")
-    filtered_data = s3_select_query(source_bucket, object_key, query, s3_source)
+    # The Select result is piped to the destination as it arrives, without being held in memory
+    stats = {}
+    try:
+        with STAGE_LATENCY.labels('select_and_put').time():
+            bytes_written = filter_to_destination(source_bucket, object_key, query, cidr_range, s3_source, s3_destination, destination_bucket, stats)
+    except Exception as e:
+        logging.error("Error streaming S3 Select results to destination bucket: %s", str(e))
+        return jsonify({'error': 'Failed to save data', 'stats': stats}), 500
     tag_object_as_processed(s3_source, source_bucket, object_key)
-    if filtered_data:
-        try:
-            response = s3_destination.put_object(
-                Bucket=destination_bucket,
-                Key=object_key,
-                Body=filtered_data.encode('utf-8')
-            )
-            return jsonify({'message': 'Data processed and saved successfully'}), 200
-        except Exception as e:
-            logging.error("Error saving data to destination bucket: %s", str(e))
-            return jsonify({'error': 'Failed to save data'}), 500
+    if bytes_written:
+        BYTES_OUT.labels(destination_bucket).inc(bytes_written)
+        return jsonify({'message': 'Data processed and saved successfully', 'stats': stats}), 200
     else:
-        return jsonify({'message': 'No data to process'}), 404
+        return jsonify({'message': 'No data to process', 'stats': stats}), 404
 
 @app.route('/healthz', methods=['GET'])
 def health_check():
     return 'Service is up', 200
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return generate_latest(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+
 if __name__ == "__main__":
     if not check_environment():
         logging.error("Environment setup is incomplete, terminating application.")
@@ -0,0 +1,143 @@
+import os
+import time
+import argparse
+from datetime import datetime, timezone
+import boto3
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import col, expr, lit, date_add
+from spark_data_cleansing_from_raw_ecommerce import committer_configs
+from spark_job_report import JobReport
+
+# S3A statistics that show the cost of the commit, the copies and deletes are the renames of the file committer
+REPORTED_STATISTICS = [
+    "object_put_requests", "object_put_bytes", "object_copy_requests", "files_copied_bytes",
+    "object_delete_requests", "object_multipart_initiated", "object_list_request", "op_rename"
+]
+
+
+def build_local_spark_session():
+    """ A local SparkSession on the S3 stand-in at S3_ENDPOINT, with plain access keys instead of an assumed role
+
+    In local mode the tasks share the driver's S3A filesystem instance, so its statistics cover the whole write.
+    """
+    return SparkSession.builder \
+        .appName("Output committer benchmark") \
+        .master("local[*]") \
+        .config("spark.hadoop.fs.s3a.endpoint", os.getenv('S3_ENDPOINT')) \
+        .config("spark.hadoop.fs.s3a.access.key", os.getenv('AWS_ACCESS_KEY_ID')) \
+        .config("spark.hadoop.fs.s3a.secret.key", os.getenv('AWS_SECRET_ACCESS_KEY')) \
+        .config("spark.hadoop.fs.s3a.aws.credentials.provider", "org.apache.hadoop.fs.s3a.SimpleAWSCredentialsProvider") \
+        .config("spark.hadoop.fs.s3a.impl", "org.apache.hadoop.fs.s3a.S3AFileSystem") \
+        .config("spark.hadoop.fs.s3a.path.style.access", True) \
+        .config("spark.hadoop.fs.s3a.connection.ssl.enabled", os.getenv('S3_ENDPOINT', '').startswith('https')) \
+        .getOrCreate()
+
+
+def use_committer(spark, committer):
+    """ Switch the session to a committer, the Hadoop settings go to the shared Hadoop configuration """
+    hadoop_conf = spark.sparkContext._jsc.hadoopConfiguration()
+    defaults = {
+        "spark.sql.sources.commitProtocolClass": "org.apache.spark.sql.execution.datasources.SQLHadoopMapReduceCommitProtocol",
+        "spark.sql.parquet.output.committer.class": "org.apache.parquet.hadoop.ParquetOutputCommitter"
+    }
+    for key in committer_configs('magic'):
+        if key.startswith("spark.hadoop."):
+            hadoop_conf.unset(key[len("spark.hadoop."):])
+        else:
+            spark.conf.set(key, defaults[key])
+    for key, value in committer_configs(committer).items():
+        if key.startswith("spark.hadoop."):
+            hadoop_conf.set(key[len("spark.hadoop."):], value)
+        else:
+            spark.conf.set(key, value)
+
+
+def generated_browsing(spark, rows, days, partitions):
+    """ Browse log like rows spread evenly over days ds partitions """
+    return spark.range(0, rows, numPartitions=partitions) \
+        .withColumn("customer", (col("id") * 7919 % 100000).cast("int")) \
+        .withColumn("resource_fk", expr("concat('item-', cast(id % 5000 as string))")) \
+        .withColumn("ts", expr("timestamp_seconds(1704067200 + id % 86400)")) \
+        .withColumn("browser", expr("element_at(array('Chrome', 'Firefox', 'Safari', 'Edge'), cast(id % 4 + 1 as int))")) \
+        .withColumn("i_current_price", (col("id") % 10000) / lit(100.0)) \
+        .withColumn("ds", date_add(lit("2024-01-01").cast("date"), (col("id") % days).cast("int"))) \
+        .drop("id")
+
+
+def delete_prefix(s3, bucket, prefix):
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        keys = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+        if keys:
+            s3.delete_objects(Bucket=bucket, Delete={'Objects': keys, 'Quiet': True})
+
+
+def stage_end(completion_time):
+    return datetime.strptime(completion_time, '%Y-%m-%dT%H:%M:%S.%f%Z').replace(tzinfo=timezone.utc).timestamp()
+
+
+def benchmark_committer(spark, s3, report, bucket, committer, df, repeat_index):
+    """ Write df partitioned by ds with one committer, returning the write time, the job commit time and S3A statistics
+
+    The job commit time is the time between the end of the last write stage and the end of the write.
+    """
+    prefix = f"benchmark_output_committer/{committer}/"
+    delete_prefix(s3, bucket, prefix)
+    use_committer(spark, committer)
+    report.stage_metrics(spark)
+    report.s3a_statistics(spark, f"s3a://{bucket}/")
+    start = time.time()
+    with report.phase(committer, spark):
+        df.write.partitionBy("ds").mode("overwrite").parquet(f"s3a://{bucket}/{prefix}")
+    end = time.time()
+    stage_ends = [stage_end(stage['completion_time']) for stage in report.stage_metrics(spark)
+                  if stage['phase'] == committer and stage['completion_time']]
+    statistics = report.s3a_statistics(spark, f"s3a://{bucket}/")
+    commit_seconds = end - max(stage_ends) if stage_ends else None
+    commit_text = f"{commit_seconds:.2f}s" if commit_seconds is not None else "n/a"
+    print(f"{committer:<12} run {repeat_index}: write {end - start:7.2f}s, job commit {commit_text}")
+    for name in REPORTED_STATISTICS:
+        if name in statistics:
+            print(f"{'':<12} {name:<28} {statistics[name]:>16,}")
+    return end - start, commit_seconds, statistics
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the commit time and bytes written of the output committers on a local S3 stand-in.')
+    parser.add_argument('--bucket', required=True, help='Existing bucket on the S3 stand-in at S3_ENDPOINT, e.g. a MinIO or Ceph demo container')
+    parser.add_argument('--committers', default='file,magic,partitioned', help="',' separated committers to compare")
+    parser.add_argument('--rows', type=int, default=5000000, help='Rows written per run')
+    parser.add_argument('--days', type=int, default=30, help='Number of ds partitions')
+    parser.add_argument('--partitions', type=int, default=16, help='Spark partitions, i.e. tasks, of the write')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs of each committer')
+    args = parser.parse_args()
+
+    s3 = boto3.client(
+        's3',
+        endpoint_url=os.getenv('S3_ENDPOINT'),
+        aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+        aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+        region_name=os.getenv('AWS_REGION', 'us-east-1')
+    )
+    spark = build_local_spark_session()
+    report = JobReport('benchmark')
+    try:
+        df = generated_browsing(spark, args.rows, args.days, args.partitions).cache()
+        df.count()
+        totals = {}
+        for repeat_index in range(1, args.repeat + 1):
+            for committer in [name.strip() for name in args.committers.split(',') if name.strip()]:
+                write_seconds, commit_seconds, statistics = benchmark_committer(spark, s3, report, args.bucket, committer, df, repeat_index)
+                total = totals.setdefault(committer, {'write': 0.0, 'commit': 0.0, 'bytes': 0})
+                total['write'] += write_seconds
+                total['commit'] += commit_seconds or 0.0
+                total['bytes'] += statistics.get('object_put_bytes', 0) + statistics.get('files_copied_bytes', 0)
+        for committer, total in totals.items():
+            print(f"{committer:<12} mean write {total['write'] / args.repeat:7.2f}s, job commit {total['commit'] / args.repeat:7.2f}s, "
+                  f"{total['bytes'] / args.repeat:,.0f} bytes uploaded or copied")
+    finally:
+        spark.stop()
+
+
+if __name__ == "__main__":
+    main()
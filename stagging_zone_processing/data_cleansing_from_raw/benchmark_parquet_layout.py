@@ -0,0 +1,151 @@
+import os
+import random
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+
+BROWSING_SCHEMA = pa.schema([
+    ('ip', pa.string()),
+    ('ts', pa.timestamp('us')),
+    ('tz', pa.string()),
+    ('verb', pa.string()),
+    ('resource_type', pa.string()),
+    ('resource_fk', pa.string()),
+    ('response', pa.int32()),
+    ('browser', pa.string()),
+    ('os', pa.string()),
+    ('customer', pa.int64()),
+    ('d_day_name', pa.string()),
+    ('i_current_price', pa.float64()),
+    ('i_category', pa.string()),
+    ('i_description', pa.string()),
+    ('c_preferred_cust_flag', pa.bool_()),
+    ('ds', pa.date32())
+])
+
+
+def read_browsing_csv(csv_file):
+    """ Read a browsing log CSV written by dataset_generator_online_store.py with the browse log Parquet schema """
+    convert_options = pv.ConvertOptions(
+        column_types=BROWSING_SCHEMA,
+        timestamp_parsers=['%Y-%m-%d %H:%M:%S', '%Y-%m-%d'],
+        true_values=['True', 'true'],
+        false_values=['False', 'false']
+    )
+    return pv.read_csv(csv_file, convert_options=convert_options).select(BROWSING_SCHEMA.names)
+
+
+def task_slices(table, sort_columns, tasks, clustered):
+    """ The rows each of the Spark job's write tasks holds
+
+    Clustered, the rows are range partitioned by ds and sort_columns like layout_clustered, so every task holds a
+    contiguous range. Otherwise the rows are spread over all tasks, as a shuffle that ignores ds leaves them.
+    """
+    if clustered:
+        table = table.sort_by([(name, 'ascending') for name in ['ds'] + sort_columns])
+        size = -(-table.num_rows // tasks)
+        return [table.slice(start, size) for start in range(0, table.num_rows, size)]
+    return [table.take(pa.array(range(task, table.num_rows, tasks))) for task in range(tasks)]
+
+
+def write_layout(table, directory, sort_columns, row_group_rows, tasks, clustered):
+    """ Write the files partitionBy("ds") writes from tasks write tasks, one file per task and ds in its rows
+
+    The rows of each file are sorted by sort_columns, like layout_sorted does within each task.
+    """
+    files = []
+    for task, rows in enumerate(task_slices(table, sort_columns, tasks, clustered)):
+        for day in pc.unique(rows.column('ds')).to_pylist():
+            partition = rows.filter(pc.equal(rows.column('ds'), pa.scalar(day, pa.date32()))).drop(['ds'])
+            if sort_columns:
+                partition = partition.sort_by([(name, 'ascending') for name in sort_columns])
+            path = os.path.join(directory, f"ds={day}", f"part-{task:05d}.parquet")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            pq.write_table(partition, path, row_group_size=row_group_rows, use_dictionary=True, write_statistics=True, compression='snappy')
+            files.append(path)
+    return files
+
+
+def bytes_scanned(files, predicate):
+    """ Bytes and row groups a reader with min/max row group pruning reads to answer predicate, selecting all columns
+
+    predicate maps a column to the (low, high) range of values the query can match.
+    """
+    scanned = 0
+    row_groups = 0
+    for path in files:
+        metadata = pq.ParquetFile(path).metadata
+        names = [metadata.schema.column(i).name for i in range(metadata.num_columns)]
+        for index in range(metadata.num_row_groups):
+            row_group = metadata.row_group(index)
+            skipped = False
+            for name, (low, high) in predicate.items():
+                statistics = row_group.column(names.index(name)).statistics
+                if statistics is not None and statistics.has_min_max and (statistics.max < low or statistics.min > high):
+                    skipped = True
+                    break
+            if not skipped:
+                scanned += sum(row_group.column(i).total_compressed_size for i in range(row_group.num_columns))
+                row_groups += 1
+    return scanned, row_groups
+
+
+def example_predicates(table, seed):
+    """ Point lookups on the join keys of create_table_combined_trans_and_logs.sql and a one hour ts range """
+    rng = random.Random(seed)
+    row = table.slice(rng.randrange(table.num_rows), 1).to_pylist()[0]
+    hour = row['ts'].replace(minute=0, second=0, microsecond=0)
+    return {
+        f"customer = {row['customer']}": {'customer': (row['customer'], row['customer'])},
+        f"resource_fk = '{row['resource_fk']}'": {'resource_fk': (row['resource_fk'], row['resource_fk'])},
+        "customer and resource_fk join key": {
+            'customer': (row['customer'], row['customer']),
+            'resource_fk': (row['resource_fk'], row['resource_fk'])
+        },
+        f"ts in [{hour}, +1h)": {'ts': (hour, hour + timedelta(hours=1) - timedelta(microseconds=1))}
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the files written and the bytes scanned by the example queries on the default, sorted and clustered Parquet layouts.')
+    parser.add_argument('csv_file', help='Browsing log CSV, e.g. written by dataset_generator_online_store.py')
+    parser.add_argument('--sort-columns', default=os.getenv('SORT_COLUMNS', 'customer,resource_fk,ts'), help="',' separated sort columns")
+    parser.add_argument('--row-group-rows', type=int, default=100000, help='Rows per row group of the sorted layout')
+    parser.add_argument('--tasks', type=int, default=8, help='Write tasks of the Spark job, each writes one file per ds it holds')
+    parser.add_argument('--seed', type=int, default=42, help='Seed for picking the looked up customer and item')
+    args = parser.parse_args()
+
+    table = read_browsing_csv(args.csv_file)
+    sort_columns = [name.strip() for name in args.sort_columns.split(',') if name.strip()]
+    predicates = example_predicates(table, args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        start = datetime.now()
+        layouts = {
+            # Unsorted rows in large row groups, as the cleansing job wrote them before SORT_COLUMNS
+            'default': write_layout(table, os.path.join(directory, 'default'), [], 1024 * 1024, args.tasks, False),
+            # Sorted within each task, but every task writes a file into every ds
+            'sorted': write_layout(table, os.path.join(directory, 'sorted'), sort_columns, args.row_group_rows, args.tasks, False),
+            # Range partitioned by ds and the sort columns before the sort, as the cleansing job writes them
+            'clustered': write_layout(table, os.path.join(directory, 'clustered'), sort_columns, args.row_group_rows, args.tasks, True)
+        }
+        print(f"Wrote {table.num_rows} rows in {len(layouts)} layouts in {(datetime.now() - start).total_seconds():.1f}s")
+        for name, files in layouts.items():
+            days = len({os.path.dirname(path) for path in files})
+            print(f"{name:<9} {sum(os.path.getsize(path) for path in files):>14,} bytes on disk in {len(files)} files, "
+                  f"{len(files) / days:.1f} per ds")
+        for query, predicate in predicates.items():
+            print(query)
+            baseline, _ = bytes_scanned(layouts['default'], predicate)
+            for name, files in layouts.items():
+                scanned, row_groups = bytes_scanned(files, predicate)
+                ratio = scanned / baseline if baseline else 0
+                print(f"  {name:<9} {scanned:>14,} bytes in {row_groups} row groups ({ratio:.1%} of default)")
+    print("Bloom filters are not written by pyarrow, the Spark writer's filters on BLOOM_FILTER_COLUMNS prune point lookups further.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+import threading
+from botocore.exceptions import ClientError
+
+# Leases on ds partitions shared by the cleansing job and the compaction tool, stored in the destination bucket
+LEASE_PREFIX = os.getenv('LEASE_PREFIX', '_leases/')
+# A lease is renewed every third of LEASE_SECONDS, a holder that stops renewing loses it after LEASE_SECONDS
+LEASE_SECONDS = int(os.getenv('LEASE_SECONDS', '900'))
+LEASE_POLL_INTERVAL = float(os.getenv('LEASE_POLL_INTERVAL', '5'))
+# A holder considers its lease lost this many seconds before it would expire without a renewal, for clock skew and
+# slow requests, capped at a third of the lease
+LEASE_SAFETY_MARGIN = float(os.getenv('LEASE_SAFETY_MARGIN', '60'))
+CONDITION_FAILED_CODES = ('PreconditionFailed', 'ConditionalRequestConflict', '409', '412')
+
+
+class LeaseLost(RuntimeError):
+    pass
+
+
+def lease_owner(job):
+    return f"{job}@{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def lease_key(table_prefix, ds=None):
+    """ The lease of a ds partition of a table, or of the whole table without ds """
+    return f"{LEASE_PREFIX}{table_prefix}{'_table' if ds is None else f'ds={ds}'}.json"
+
+
+def condition_failed(error):
+    return error.response.get('Error', {}).get('Code') in CONDITION_FAILED_CODES
+
+
+class Lease:
+    """ Exclusive, expiring lease on one key, created with If-None-Match and renewed or taken over with If-Match
+
+    A background thread renews the lease while it is held. check raises LeaseLost if a renewal lost the lease to
+    another owner, or once no renewal succeeded for long enough that the lease may have expired, e.g. while S3 or
+    the credentials fail. Holders call it before every step that must not overlap with another holder.
+    """
+
+    def __init__(self, s3_client, bucket, key, owner, seconds=LEASE_SECONDS):
+        # Called for every request, so that a lease held longer than the role session gets renewed credentials
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.owner = owner
+        self.seconds = seconds
+        self.etag = None
+        self.lost = False
+        # Monotonic time of the request that last created or renewed the lease
+        self.renewed_at = None
+        self.released = threading.Event()
+        self.thread = None
+
+    def _body(self):
+        return json.dumps({'owner': self.owner, 'expires_at': time.time() + self.seconds}).encode('utf-8')
+
+    def try_acquire(self):
+        """ Take the lease if it is free or expired, returns False if another owner holds it """
+        requested_at = time.monotonic()
+        try:
+            self.etag = self.s3_client().put_object(Bucket=self.bucket, Key=self.key, Body=self._body(), IfNoneMatch='*')['ETag']
+        except ClientError as e:
+            if not condition_failed(e):
+                raise
+            holder = read_lease(self.s3_client(), self.bucket, self.key)
+            if holder is None or holder['expires_at'] > time.time():
+                return False
+            try:
+                self.etag = self.s3_client().put_object(Bucket=self.bucket, Key=self.key, Body=self._body(), IfMatch=holder['etag'])['ETag']
+            except ClientError as e:
+                if condition_failed(e):
+                    return False
+                raise
+            logging.warning(f"Took over the expired lease {self.key} of {holder['owner']}")
+        self.renewed_at = requested_at
+        self.thread = threading.Thread(target=self._renew, name=f"lease-{self.key}", daemon=True)
+        self.thread.start()
+        return True
+
+    def acquire(self, wait_seconds):
+        """ Wait up to wait_seconds for the lease, raises TimeoutError if it is still held by another owner """
+        deadline = time.monotonic() + wait_seconds
+        while not self.try_acquire():
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Lease {self.key} still held after {wait_seconds}s")
+            time.sleep(LEASE_POLL_INTERVAL)
+
+    def _renew(self):
+        while not self.released.wait(self.seconds / 3):
+            requested_at = time.monotonic()
+            try:
+                self.etag = self.s3_client().put_object(Bucket=self.bucket, Key=self.key, Body=self._body(), IfMatch=self.etag)['ETag']
+                self.renewed_at = requested_at
+            except Exception as e:
+                logging.error(f"Failed to renew the lease {self.key}: {e}")
+                if isinstance(e, ClientError) and condition_failed(e):
+                    self.lost = True
+                    return
+
+    def check(self):
+        if self.lost:
+            raise LeaseLost(f"Lost the lease {self.key}")
+        margin = min(LEASE_SAFETY_MARGIN, self.seconds / 3)
+        if time.monotonic() > self.renewed_at + self.seconds - margin:
+            raise LeaseLost(f"Lease {self.key} not renewed for {time.monotonic() - self.renewed_at:.0f}s, it may have expired")
+
+    def release(self):
+        self.released.set()
+        if self.thread:
+            self.thread.join()
+        if self.lost or self.etag is None:
+            return
+        try:
+            self.s3_client().delete_object(Bucket=self.bucket, Key=self.key, IfMatch=self.etag)
+        except ClientError as e:
+            logging.error(f"Failed to release the lease {self.key}: {e}")
+
+
+def read_lease(s3, bucket, key):
+    """ The owner, expiry and ETag of a lease, None if it does not exist """
+    try:
+        response = s3.get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+            return None
+        raise
+    return dict(json.loads(response['Body'].read()), etag=response['ETag'])
+
+
+def live_lease(s3, bucket, key):
+    lease = read_lease(s3, bucket, key)
+    return lease if lease and lease['expires_at'] > time.time() else None
+
+
+def live_partition_leases(s3, bucket, table_prefix):
+    """ The keys of the unexpired ds partition leases of a table """
+    prefix = f"{LEASE_PREFIX}{table_prefix}ds="
+    keys = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        keys.extend(obj['Key'] for obj in page.get('Contents', []))
+    return [key for key in keys if live_lease(s3, bucket, key)]
+
+
+def release_leases(leases):
+    for lease in reversed(leases):
+        lease.release()
+
+
+def acquire_partition_leases(s3_client, bucket, table_prefixes, days, owner, wait_seconds):
+    """ Wait for the leases of the given ds partitions of every table, taken in a fixed order
+
+    The partition leases are given up and taken again while a whole table lease is held. Returns the held leases,
+    or raises TimeoutError if they are not all free within wait_seconds.
+    """
+    deadline = time.monotonic() + wait_seconds
+    while True:
+        leases = []
+        try:
+            for table_prefix in sorted(table_prefixes):
+                for day in sorted(days):
+                    lease = Lease(s3_client, bucket, lease_key(table_prefix, day), owner)
+                    lease.acquire(max(deadline - time.monotonic(), 0))
+                    leases.append(lease)
+        except BaseException:
+            release_leases(leases)
+            raise
+        if not any(live_lease(s3_client(), bucket, lease_key(table_prefix)) for table_prefix in table_prefixes):
+            return leases
+        release_leases(leases)
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"Table leases of {', '.join(sorted(table_prefixes))} still held after {wait_seconds}s")
+        time.sleep(LEASE_POLL_INTERVAL)
+
+
+def acquire_table_leases(s3_client, bucket, table_prefixes, owner, wait_seconds):
+    """ Take the whole table leases, then wait until the partition leases taken before them are released
+
+    Partition lease holders check the table lease after taking theirs, so none can start once the table lease is held.
+    """
+    leases = []
+    deadline = time.monotonic() + wait_seconds
+    try:
+        for table_prefix in sorted(table_prefixes):
+            lease = Lease(s3_client, bucket, lease_key(table_prefix), owner)
+            lease.acquire(max(deadline - time.monotonic(), 0))
+            leases.append(lease)
+        for table_prefix in sorted(table_prefixes):
+            while live_partition_leases(s3_client(), bucket, table_prefix):
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"Partition leases of {table_prefix} still held after {wait_seconds}s")
+                time.sleep(LEASE_POLL_INTERVAL)
+    except BaseException:
+        release_leases(leases)
+        raise
+    return leases
@@ -0,0 +1,280 @@
+import os
+import sys
+import json
+import math
+import logging
+import argparse
+from datetime import date, timedelta
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+from spark_data_cleansing_from_raw_ecommerce import (
+    get_s3_client, build_spark_session, layout_sorted, parquet_options, TAG_WORKERS
+)
+from partition_lease import Lease, lease_key, lease_owner, live_lease
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+COMPACTION_JOURNAL_PREFIX = os.getenv('COMPACTION_JOURNAL_PREFIX', '_compaction/')
+# The rewritten files are staged outside the table and copied into the partition once they are complete
+COMPACTION_STAGING_PREFIX = os.getenv('COMPACTION_STAGING_PREFIX', '_compaction/staging/')
+
+
+def check_environment_variables():
+    """ Check for all necessary environment variables """
+    required_vars = [
+        'AWS_REGION', 'S3_ENDPOINT', 'DESTINATION_BUCKET', 'SOURCE_ROLE_ARN',
+        'AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'SPARK_MASTER_URL',
+        'STS_ENDPOINT', 'STS_REGION', 'SESSION_DURATION', 'SPARK_DRIVER_HOST'
+    ]
+    missing_vars = [var for var in required_vars if not os.getenv(var)]
+    if missing_vars:
+        logging.error("Missing environment variables:")
+        for var in missing_vars:
+            logging.error(var)
+        sys.exit(1)
+
+
+def list_partitions(bucket, table_prefix):
+    """ Return the Parquet files of each ds partition of a table as {ds: {key: size}} """
+    s3 = get_s3_client()
+    partitions = {}
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=table_prefix, PaginationConfig={'PageSize': 1000}):
+        for obj in page.get('Contents', []):
+            partition, _, name = obj['Key'][len(table_prefix):].partition('/')
+            if partition.startswith('ds=') and name.endswith('.parquet') and '/' not in name:
+                partitions.setdefault(partition[len('ds='):], {})[obj['Key']] = obj['Size']
+    return partitions
+
+
+def needs_compaction(files, min_files, min_average_bytes):
+    """ A partition is compacted when it has more than min_files files or its files average under min_average_bytes """
+    if len(files) < 2:
+        return False
+    return len(files) > min_files or sum(files.values()) / len(files) < min_average_bytes
+
+
+def journal_key(table_prefix, ds):
+    return f"{COMPACTION_JOURNAL_PREFIX}{table_prefix}ds={ds}.json"
+
+
+def list_journals(bucket, table_prefix):
+    """ Return the ds partitions of a table with a compaction journal """
+    s3 = get_s3_client()
+    prefix = f"{COMPACTION_JOURNAL_PREFIX}{table_prefix}ds="
+    journals = set()
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('.json'):
+                journals.add(obj['Key'][len(prefix):-len('.json')])
+    return journals
+
+
+def staging_prefix(table_prefix, ds):
+    return f"{COMPACTION_STAGING_PREFIX}{table_prefix}ds={ds}/"
+
+
+def list_staged(bucket, table_prefix, ds):
+    """ Return the staged Parquet files of a partition's compaction """
+    s3 = get_s3_client()
+    staged = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=staging_prefix(table_prefix, ds)):
+        staged.extend(obj['Key'] for obj in page.get('Contents', []) if obj['Key'].endswith('.parquet'))
+    return sorted(staged)
+
+
+def count_rows(spark, bucket, keys):
+    return spark.read.parquet(*[f"s3a://{bucket}/{key}" for key in sorted(keys)]).count()
+
+
+def common_tag_set(bucket, keys):
+    """ Return the union of the tags of the given objects, None if two of them disagree on the value of a tag """
+    s3 = get_s3_client()
+    with ThreadPoolExecutor(max_workers=TAG_WORKERS) as executor:
+        tag_sets = list(executor.map(lambda key: s3.get_object_tagging(Bucket=bucket, Key=key)['TagSet'], sorted(keys)))
+    tags = {}
+    for tag_set in tag_sets:
+        for tag in tag_set:
+            if tags.setdefault(tag['Key'], tag['Value']) != tag['Value']:
+                return None
+    return [{'Key': key, 'Value': value} for key, value in sorted(tags.items())]
+
+
+def copy_files(bucket, files, tag_set):
+    """ Server side copy of the staged files to their keys in the partition, with the tags of the files they replace """
+    s3 = get_s3_client()
+    tagging = urlencode([(tag['Key'], tag['Value']) for tag in tag_set or []])
+    with ThreadPoolExecutor(max_workers=TAG_WORKERS) as executor:
+        futures = [
+            executor.submit(
+                s3.copy_object, Bucket=bucket, Key=final_key, CopySource={'Bucket': bucket, 'Key': staged_key},
+                TaggingDirective='REPLACE', Tagging=tagging
+            )
+            for staged_key, final_key in sorted(files.items())
+        ]
+        for future in futures:
+            future.result()
+
+
+def delete_objects(bucket, keys):
+    s3 = get_s3_client()
+    keys = sorted(keys)
+    for start in range(0, len(keys), 1000):
+        response = s3.delete_objects(
+            Bucket=bucket,
+            Delete={'Objects': [{'Key': key} for key in keys[start:start + 1000]], 'Quiet': True}
+        )
+        if response.get('Errors'):
+            raise RuntimeError(f"Failed to delete {len(response['Errors'])} objects, first error: {response['Errors'][0]}")
+
+
+def write_journal(bucket, table_prefix, ds, journal):
+    get_s3_client().put_object(
+        Bucket=bucket,
+        Key=journal_key(table_prefix, ds),
+        Body=json.dumps(journal).encode('utf-8'),
+        ContentType='application/json'
+    )
+
+
+def swap_files(bucket, table_prefix, ds, journal, current_files):
+    """ Delete the old files, copy in the staged files missing from the partition, then delete the staged files and
+    the journal
+
+    The old files go first, so readers never see them next to their copies and count rows twice. A reader between
+    the delete and the last copy sees part of the partition, the staged files and the journal stay until the copies
+    are done so a rerun completes them.
+    """
+    delete_objects(bucket, set(journal['old_files']) & set(current_files))
+    missing = {staged: final for staged, final in journal['files'].items() if final not in current_files}
+    copy_files(bucket, missing, journal['tag_set'])
+    delete_objects(bucket, list_staged(bucket, table_prefix, ds))
+    get_s3_client().delete_object(Bucket=bucket, Key=journal_key(table_prefix, ds))
+
+
+def resolve_journal(bucket, table_prefix, ds, current_files):
+    """ Finish or roll back a compaction that was interrupted
+
+    A compaction interrupted while staging never touched the partition, its staged files are deleted. One interrupted
+    during the swap is rolled forward from the file list in its journal. Returns the files left in the partition.
+    """
+    s3 = get_s3_client()
+    response = s3.get_object(Bucket=bucket, Key=journal_key(table_prefix, ds))
+    journal = json.loads(response['Body'].read())
+    if journal.get('phase') != 'swap':
+        logging.info(f"Rolling back the interrupted compaction of {table_prefix}ds={ds}")
+        delete_objects(bucket, list_staged(bucket, table_prefix, ds))
+        s3.delete_object(Bucket=bucket, Key=journal_key(table_prefix, ds))
+        return current_files
+    logging.info(f"Completing the interrupted compaction of {table_prefix}ds={ds}")
+    swap_files(bucket, table_prefix, ds, journal, current_files)
+    return list_partitions(bucket, table_prefix).get(ds, {})
+
+
+def compact_partition(spark, bucket, table_prefix, ds, files, target_file_bytes, lease):
+    """ Rewrite one ds partition into files of about target_file_bytes, keeping its rows and tags
+
+    The caller holds the partition's lease, which the cleansing job takes before it writes a partition. The rewritten
+    files are staged outside the table and checked against the row count of the old files, then copied into the
+    partition and the old files deleted. A journal in the destination bucket records each phase, so a rerun rolls
+    back a compaction interrupted while staging and completes one interrupted during the swap. The old files are
+    deleted before the copies, readers may see the partition incomplete during the swap but never duplicated.
+    """
+    old_files = set(files)
+    tag_set = common_tag_set(bucket, old_files)
+    if tag_set is None:
+        logging.error(f"Skipping {table_prefix}ds={ds}, its files carry conflicting tags")
+        return
+    rows = count_rows(spark, bucket, old_files)
+    output_files = max(1, math.ceil(sum(files.values()) / target_file_bytes))
+    journal = {'phase': 'staging', 'old_files': sorted(old_files), 'rows': rows, 'tag_set': tag_set}
+    write_journal(bucket, table_prefix, ds, journal)
+
+    partition_path = f"s3a://{bucket}/{table_prefix}ds={ds}/"
+    partition_df = spark.read.parquet(*[f"s3a://{bucket}/{key}" for key in sorted(old_files)]).repartition(output_files)
+    # Keep the sort order and Parquet options of the cleansing job's layout
+    parquet_options(layout_sorted(partition_df, partition_columns=()).write.mode("append"), partition_df.columns) \
+        .parquet(f"s3a://{bucket}/{staging_prefix(table_prefix, ds)}")
+
+    staged_files = list_staged(bucket, table_prefix, ds)
+    staged_rows = count_rows(spark, bucket, staged_files) if staged_files else 0
+    if staged_rows != rows:
+        delete_objects(bucket, staged_files)
+        get_s3_client().delete_object(Bucket=bucket, Key=journal_key(table_prefix, ds))
+        raise RuntimeError(f"Compaction of {partition_path} staged {staged_rows} rows instead of {rows}, old files kept")
+
+    # The swap must not start once another writer could have taken over the partition
+    lease.check()
+    journal.update(phase='swap', files={key: f"{table_prefix}ds={ds}/{key.rsplit('/', 1)[1]}" for key in staged_files})
+    write_journal(bucket, table_prefix, ds, journal)
+    swap_files(bucket, table_prefix, ds, journal, files)
+    logging.info(f"Compacted {partition_path}: {len(old_files)} files into {len(staged_files)}, {rows} rows")
+
+
+def take_partition_lease(bucket, table_prefix, ds, owner):
+    """ Take the lease of a partition, None if the cleansing job holds it or the whole table """
+    lease = Lease(get_s3_client, bucket, lease_key(table_prefix, ds), owner)
+    if not lease.try_acquire():
+        return None
+    if live_lease(get_s3_client(), bucket, lease_key(table_prefix)):
+        lease.release()
+        return None
+    return lease
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compact the small Parquet files of the ds partitions of the browsing/ and masked/ tables.')
+    parser.add_argument('--tables', default='browsing/,masked/', help="',' separated table prefixes in DESTINATION_BUCKET")
+    parser.add_argument('--target-file-mb', type=int, default=128, help='Target size of the rewritten files')
+    parser.add_argument('--min-files', type=int, default=8, help='Compact partitions with more files than this')
+    parser.add_argument('--min-average-file-mb', type=float, default=32, help='Compact partitions whose files average less than this')
+    parser.add_argument('--min-age-days', type=int, default=1, help='Leave the partitions of the most recent days to the cleansing job')
+    parser.add_argument('--dry-run', action='store_true', help='Only list the partitions that would be compacted')
+    args = parser.parse_args()
+
+    check_environment_variables()
+    destination_bucket = os.getenv('DESTINATION_BUCKET')
+    newest_day = (date.today() - timedelta(days=args.min_age_days)).isoformat()
+    spark = None if args.dry_run else build_spark_session()
+    # The compacted files are copied from the staging prefix into the partitions, without a _SUCCESS marker
+    owner = lease_owner('compaction')
+    if spark:
+        spark.sparkContext._jsc.hadoopConfiguration().set("mapreduce.fileoutputcommitter.marksuccessfuljobs", "false")
+
+    try:
+        for table_prefix in [prefix.strip() for prefix in args.tables.split(',') if prefix.strip()]:
+            table_prefix = table_prefix if table_prefix.endswith('/') else table_prefix + '/'
+            journals = list_journals(destination_bucket, table_prefix) if spark else set()
+            for ds, files in sorted(list_partitions(destination_bucket, table_prefix).items()):
+                if ds > newest_day:
+                    continue
+                if ds not in journals and not needs_compaction(files, args.min_files, args.min_average_file_mb * 1024 * 1024):
+                    continue
+                if args.dry_run:
+                    logging.info(f"{table_prefix}ds={ds}: {len(files)} files, {sum(files.values())} bytes")
+                    continue
+                lease = take_partition_lease(destination_bucket, table_prefix, ds, owner)
+                if lease is None:
+                    logging.info(f"Skipping {table_prefix}ds={ds}, the cleansing job is writing it")
+                    continue
+                try:
+                    # List again under the lease, the cleansing job may have written the partition since
+                    files = list_partitions(destination_bucket, table_prefix).get(ds, {})
+                    if ds in journals:
+                        files = resolve_journal(destination_bucket, table_prefix, ds, files)
+                    if not needs_compaction(files, args.min_files, args.min_average_file_mb * 1024 * 1024):
+                        continue
+                    logging.info(f"{table_prefix}ds={ds}: {len(files)} files, {sum(files.values())} bytes")
+                    compact_partition(spark, destination_bucket, table_prefix, ds, files, args.target_file_mb * 1024 * 1024, lease)
+                finally:
+                    lease.release()
+    finally:
+        if spark:
+            spark.stop()
+
+
+if __name__ == "__main__":
+    main()
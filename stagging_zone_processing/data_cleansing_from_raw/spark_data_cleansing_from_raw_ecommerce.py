@@ -1,98 +1,589 @@
 import os
 import sys
+import json
+import time
+import random
 import logging
+import threading
+from datetime import date, datetime, timedelta, timezone
+from collections import OrderedDict
 import boto3
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
 from pyspark.sql.types import StructType, StructField, StringType, IntegerType, DoubleType, BooleanType, DateType
-from pyspark.sql.functions import col, to_timestamp
+from pyspark.sql.functions import col, to_timestamp, input_file_name, xxhash64, lit, broadcast, date_add, \
+    min as spark_min, max as spark_max
 from botocore.exceptions import ClientError
+from urllib.parse import unquote, unquote_plus
+from spark_job_report import JobReport
+from partition_lease import acquire_partition_leases, acquire_table_leases, lease_owner, release_leases
+from spark_rollups_ecommerce import update_rollups
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+TAG_WORKERS = int(os.getenv('TAG_WORKERS', '16'))
+TAG_MAX_RETRIES = int(os.getenv('TAG_MAX_RETRIES', '5'))
+THROTTLING_ERROR_CODES = ('SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequests', 'ServiceUnavailable', '503')
+# Persist the cleansed dataset so browsing/ and masked/ come from a single scan and shuffle
+MULTI_OUTPUT_CACHE = os.getenv('MULTI_OUTPUT_CACHE', 'true').lower() == 'true'
+# Per partition manifests of the source objects that fed each ds partition
+MANIFEST_PREFIX = os.getenv('MANIFEST_PREFIX', '_manifests/browsing/')
+# Hashed row keys of everything appended so far, partitioned by ds, and the index size up to which it is broadcast
+DEDUP_INDEX_PREFIX = os.getenv('DEDUP_INDEX_PREFIX', '_dedup_index/browsing/')
+DEDUP_BROADCAST_BYTES = int(os.getenv('DEDUP_BROADCAST_BYTES', str(64 * 1024 * 1024)))
+ROW_KEY_COLUMNS = ["row_key", "row_key2"]
+# Parquet layout of browsing/ and masked/: sort order inside each ds partition, row group size and Bloom filter columns
+SORT_COLUMNS = [name.strip() for name in os.getenv('SORT_COLUMNS', 'customer,resource_fk,ts').split(',') if name.strip()]
+PARQUET_ROW_GROUP_BYTES = int(os.getenv('PARQUET_ROW_GROUP_BYTES', str(64 * 1024 * 1024)))
+BLOOM_FILTER_COLUMNS = [name.strip() for name in os.getenv('BLOOM_FILTER_COLUMNS', 'customer,resource_fk').split(',') if name.strip()]
+# Optional stage rebuilding the combined_browsing_transactions partitions of the days each run touches
+ENRICHMENT_ENABLED = os.getenv('ENRICHMENT_ENABLED', 'false').lower() == 'true'
+TRANSACTIONS_PATH = os.getenv('TRANSACTIONS_PATH', 's3a://ecommtrans/transactions/')
+COMBINED_PREFIX = os.getenv('COMBINED_PREFIX', 'combined_browsing_transactions/')
+# The smaller join side is broadcast up to this size, otherwise both sides are hash partitioned on the join keys
+ENRICHMENT_BROADCAST_BYTES = int(os.getenv('ENRICHMENT_BROADCAST_BYTES', str(256 * 1024 * 1024)))
+ENRICHMENT_PARTITIONS = int(os.getenv('ENRICHMENT_PARTITIONS', '64'))
+# Opt-in: join browsing rows only with the transactions from their ds up to this many days later, so each run only
+# reads the transactions of that window, pruned on the transaction_date statistics. By default, like
+# create_table_combined_trans_and_logs.sql, every transaction of the table is joined
+ENRICHMENT_WINDOW_DAYS = int(os.getenv('ENRICHMENT_WINDOW_DAYS', '-1') or -1)
+# Last modified time of the newest transaction file already joined into combined_browsing_transactions
+ENRICHMENT_WATERMARK_KEY = os.getenv('ENRICHMENT_WATERMARK_KEY', '_watermarks/enrichment_transactions.json')
+# Files modified up to this many seconds before a watermark are checked again, S3 gives a multipart upload the
+# time it started, which can be older than files listed before it completed
+TRANSACTION_ARRIVAL_OVERLAP = int(os.getenv('TRANSACTION_ARRIVAL_OVERLAP', '3600'))
+TRANSACTION_COLUMNS = ["transaction_id", "item_description", "category", "quantity", "total_amount", "credit_card_number", "transaction_date"]
+# Refresh the curated rollups of spark_rollups_ecommerce.py for the days each run touches and the transactions that arrived
+ROLLUPS_ENABLED = os.getenv('ROLLUPS_ENABLED', 'false').lower() == 'true'
+# single processes S3_OBJECT_KEY and exits, service keeps a warm SparkSession and processes new objects in micro-batches
+RUN_MODE = os.getenv('RUN_MODE', 'single')
+# full overwrites the whole browsing/ and masked/ prefixes, incremental rebuilds only the ds partitions present in the new
+# objects from their current Parquet files and the new rows, append adds the rows not yet in the dedup index.
+# The service defaults to incremental, a full write per micro-batch would delete the output of the earlier ones
+WRITE_MODE = os.getenv('WRITE_MODE', 'incremental' if RUN_MODE == 'service' else 'full')
+MICRO_BATCH_MAX_KEYS = int(os.getenv('MICRO_BATCH_MAX_KEYS', '100'))
+MICRO_BATCH_INTERVAL = float(os.getenv('MICRO_BATCH_INTERVAL', '60'))
+# Keys of a failed micro-batch are retried one by one, a key failing this many times alone is tagged quarantined=true
+MAX_KEY_FAILURES = int(os.getenv('MAX_KEY_FAILURES', '3'))
+# Keys remembered by the service to skip their tag check, the oldest are forgotten and checked again when listed
+SEEN_KEYS_MAX = int(os.getenv('SEEN_KEYS_MAX', '100000'))
+POLL_INTERVAL = float(os.getenv('POLL_INTERVAL', '5'))
+# Service mode reads keys from NOTIFICATION_FILE when set, otherwise it lists SOURCE_PREFIX every SCAN_INTERVAL seconds
+NOTIFICATION_FILE = os.getenv('NOTIFICATION_FILE')
+SOURCE_PREFIX = os.getenv('SOURCE_PREFIX', '')
+SCAN_INTERVAL = float(os.getenv('SCAN_INTERVAL', '60'))
+# file commits through the default FileOutputCommitter and its renames, magic and partitioned use the S3A committers,
+# which upload the files as multipart uploads completed at job commit, without copies. partitioned replaces the ds
+# partitions it writes at job commit and needs a filesystem shared by the driver and executors as fs.defaultFS,
+# magic can only append or overwrite the whole prefix
+OUTPUT_COMMITTER = os.getenv('OUTPUT_COMMITTER', 'file')
+# Per run JSON report of phase timings and Spark stage metrics, written to REPORT_PREFIX in the destination bucket
+REPORT_ENABLED = os.getenv('REPORT_ENABLED', 'true').lower() == 'true'
+REPORT_PREFIX = os.getenv('REPORT_PREFIX', '_reports/cleansing/')
+# Longest wait for the partition or table leases held by the compaction tool before a run fails
+LEASE_WAIT_SECONDS = float(os.getenv('LEASE_WAIT_SECONDS', '1800'))
+# Role credentials are renewed this many seconds before they expire
+CREDENTIAL_REFRESH_MARGIN = int(os.getenv('CREDENTIAL_REFRESH_MARGIN', '300'))
+
+# One role session and S3 client shared by every S3 call of the job
+_s3_client_lock = threading.Lock()
+_s3_client_cache = {}
+_job_report = JobReport('cleansing')
+
+BROWSING_SCHEMA = StructType([
+    StructField("ip", StringType(), True),
+    StructField("ts", StringType(), True),
+    StructField("tz", StringType(), True),
+    StructField("verb", StringType(), True),
+    StructField("resource_type", StringType(), True),
+    StructField("resource_fk", StringType(), True),
+    StructField("response", IntegerType(), True),
+    StructField("browser", StringType(), True),
+    StructField("os", StringType(), True),
+    StructField("customer", IntegerType(), True),
+    StructField("d_day_name", StringType(), True),
+    StructField("i_current_price", DoubleType(), True),
+    StructField("i_category", StringType(), True),
+    StructField("i_description", StringType(), True),
+    StructField("c_preferred_cust_flag", BooleanType(), True),
+    StructField("ds", DateType(), True)
+])
+
 def check_environment_variables():
     """ Check for all necessary environment variables """
     required_vars = [
         'AWS_REGION', 'S3_ENDPOINT', 'SOURCE_BUCKET', 'DESTINATION_BUCKET',
         'SOURCE_ROLE_ARN', 'AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY',
         'SPARK_MASTER_URL', 'STS_ENDPOINT', 'STS_REGION', 'SESSION_DURATION',
-        'SPARK_DRIVER_HOST', 'S3_OBJECT_KEY'
+        'SPARK_DRIVER_HOST'
     ]
+    if RUN_MODE != 'service':
+        required_vars.append('S3_OBJECT_KEY')
     missing_vars = [var for var in required_vars if not os.getenv(var)]
     if missing_vars:
         logging.error("Missing environment variables:")
         for var in missing_vars:
             logging.error(var)
         sys.exit(1)
+    if WRITE_MODE not in ('full', 'incremental', 'append'):
+        logging.error(f"Unknown WRITE_MODE {WRITE_MODE}, expected full, incremental or append")
+        sys.exit(1)
+    if RUN_MODE == 'service' and WRITE_MODE == 'full':
+        logging.error("WRITE_MODE=full replaces browsing/ and masked/ on every micro-batch, use incremental or append with RUN_MODE=service")
+        sys.exit(1)
+    if OUTPUT_COMMITTER not in ('file', 'magic', 'partitioned'):
+        logging.error(f"Unknown OUTPUT_COMMITTER {OUTPUT_COMMITTER}, expected file, magic or partitioned")
+        sys.exit(1)
+    if OUTPUT_COMMITTER == 'magic' and (WRITE_MODE == 'incremental' or ENRICHMENT_ENABLED or ROLLUPS_ENABLED):
+        logging.error("OUTPUT_COMMITTER=magic can not replace single ds partitions, use partitioned with WRITE_MODE=incremental, "
+                      "ENRICHMENT_ENABLED or ROLLUPS_ENABLED")
+        sys.exit(1)
 
 def get_s3_client():
-    """ Get a configured S3 client using assumed role credentials """
-    session = boto3.Session(
-        region_name=os.getenv('AWS_REGION'),
-        aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-        aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
-    )
-    sts_client = session.client(
-        'sts',
-        endpoint_url=os.getenv('STS_ENDPOINT'),
-        region_name=os.getenv('STS_REGION')
-    )
-    assumed_role = sts_client.assume_role(
-        RoleArn=os.getenv('SOURCE_ROLE_ARN'),
-        RoleSessionName="AssumeRoleSession",
-        DurationSeconds=int(os.getenv('SESSION_DURATION'))
-    )
-    credentials = assumed_role['Credentials']
-    return boto3.client(
-        's3',
-        region_name=os.getenv('AWS_REGION'),
-        aws_access_key_id=credentials['AccessKeyId'],
-        aws_secret_access_key=credentials['SecretAccessKey'],
-        aws_session_token=credentials['SessionToken'],
-        endpoint_url=os.getenv('S3_ENDPOINT')
-    )
+    """ Get a configured S3 client using assumed role credentials, assuming the role once per job """
+    with _s3_client_lock:
+        if _s3_client_cache and time.time() < _s3_client_cache['refresh_at']:
+            return _s3_client_cache['s3']
+        with _job_report.phase('role_assumption'):
+            session = boto3.Session(
+                region_name=os.getenv('AWS_REGION'),
+                aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+                aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
+            )
+            sts_client = session.client(
+                'sts',
+                endpoint_url=os.getenv('STS_ENDPOINT'),
+                region_name=os.getenv('STS_REGION')
+            )
+            assumed_role = sts_client.assume_role(
+                RoleArn=os.getenv('SOURCE_ROLE_ARN'),
+                RoleSessionName="AssumeRoleSession",
+                DurationSeconds=int(os.getenv('SESSION_DURATION'))
+            )
+        credentials = assumed_role['Credentials']
+        _s3_client_cache['s3'] = boto3.client(
+            's3',
+            region_name=os.getenv('AWS_REGION'),
+            aws_access_key_id=credentials['AccessKeyId'],
+            aws_secret_access_key=credentials['SecretAccessKey'],
+            aws_session_token=credentials['SessionToken'],
+            endpoint_url=os.getenv('S3_ENDPOINT'),
+            config=Config(max_pool_connections=max(TAG_WORKERS, 10))
+        )
+        # Renewed CREDENTIAL_REFRESH_MARGIN seconds before expiry, or at half of the session if it is shorter than that
+        expires_at = credentials['Expiration'].timestamp()
+        _s3_client_cache['refresh_at'] = expires_at - min(CREDENTIAL_REFRESH_MARGIN, (expires_at - time.time()) / 2)
+        return _s3_client_cache['s3']
 
+def get_object_tags(bucket, key):
+    """ Return the tags of an S3 object, none if they can not be read """
+    s3 = get_s3_client()
+    with _job_report.phase('tag_check'):
+        try:
+            tagging_info = s3.get_object_tagging(Bucket=bucket, Key=key)
+            return {tag['Key']: tag['Value'] for tag in tagging_info['TagSet']}
+        except ClientError as e:
+            logging.error(f"Failed to get tags for {key}: {e}")
+            return {}
 
 def check_s3_object_tag(bucket, key, tag_key):
     """ Check if the S3 object has a specific tag set """
+    return get_object_tags(bucket, key).get(tag_key) == 'true'
+
+def list_parquet_file_sizes(bucket, prefix):
+    """ Return the size of every Parquet file under a prefix by key """
+    s3 = get_s3_client()
+    sizes = {}
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, PaginationConfig={'PageSize': 1000}):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('.parquet'):
+                sizes[obj['Key']] = obj['Size']
+    return sizes
+
+def list_parquet_files(bucket, prefix):
+    """ Return the keys of all Parquet files under a prefix """
+    return set(list_parquet_file_sizes(bucket, prefix))
+
+def list_partition_file_sizes(bucket, prefix, days):
+    """ Return the size of every Parquet file in the given ds partitions under a prefix by key """
+    sizes = {}
+    for day in days:
+        sizes.update(list_parquet_file_sizes(bucket, f"{prefix}ds={day.isoformat()}/"))
+    return sizes
+
+def partition_file_stats(file_sizes, prefix):
+    """ Files and bytes by ds partition, to spot skew across the ds partitions a run wrote """
+    stats = {}
+    for key, size in file_sizes.items():
+        partition = key[len(prefix):].split('/', 1)[0]
+        if partition.startswith('ds='):
+            partition_stats = stats.setdefault(partition[len('ds='):], {'files': 0, 'bytes': 0})
+            partition_stats['files'] += 1
+            partition_stats['bytes'] += size
+    return dict(sorted(stats.items()))
+
+def put_tag_set_with_retry(s3, bucket, key, tag_set):
+    """ Set the tags of one object, retrying throttled requests with exponential backoff and jitter """
+    for attempt in range(TAG_MAX_RETRIES + 1):
+        try:
+            s3.put_object_tagging(Bucket=bucket, Key=key, Tagging={'TagSet': tag_set})
+            return
+        except ClientError as e:
+            error_code = e.response.get('Error', {}).get('Code', '')
+            if error_code not in THROTTLING_ERROR_CODES or attempt == TAG_MAX_RETRIES:
+                raise
+            time.sleep(min(0.1 * 2 ** attempt, 10) * random.uniform(0.5, 1.5))
+
+def put_tag_with_retry(s3, bucket, key, tag_key, tag_value):
+    """ Tag one object, retrying throttled requests with exponential backoff and jitter """
+    put_tag_set_with_retry(s3, bucket, key, [{'Key': tag_key, 'Value': tag_value}])
+
+def tag_objects(bucket, keys, tag_key, tag_value):
+    """ Tag the given objects in parallel with the shared S3 client """
+    s3 = get_s3_client()
+    start = time.time()
+    with _job_report.phase('tagging'), ThreadPoolExecutor(max_workers=TAG_WORKERS) as executor:
+        futures = [executor.submit(put_tag_with_retry, s3, bucket, key, tag_key, tag_value) for key in sorted(keys)]
+        for future in futures:
+            future.result()
+    _job_report.count('objects_tagged', len(keys))
+    logging.info(f"Tagged {len(keys)} objects in {bucket} with {tag_key}={tag_value} in {time.time() - start:.1f}s")
+
+def manifest_key(ds):
+    return f"{MANIFEST_PREFIX}ds={ds}.json"
+
+def read_partition_manifest(bucket, ds):
+    """ Return the source objects recorded for a ds partition, an empty list if it has no manifest yet """
     s3 = get_s3_client()
     try:
-        tagging_info = s3.get_object_tagging(Bucket=bucket, Key=key)
-        tags = {tag['Key']: tag['Value'] for tag in tagging_info['TagSet']}
-        return tags.get(tag_key) == 'true'
+        response = s3.get_object(Bucket=bucket, Key=manifest_key(ds))
     except ClientError as e:
-        logging.error(f"Failed to get tags for {key}: {e}")
-        return False
+        if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+            return []
+        raise
+    return json.loads(response['Body'].read())['sources']
+
+def write_partition_manifest(bucket, ds, sources):
+    """ Record the source objects that make up a ds partition """
+    s3 = get_s3_client()
+    manifest = {'ds': ds, 'sources': sources, 'updated_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+    s3.put_object(Bucket=bucket, Key=manifest_key(ds), Body=json.dumps(manifest, indent=2).encode('utf-8'), ContentType='application/json')
+
+def read_browsing_csv(spark, paths):
+    """ Read raw browsing log CSV files with the browsing schema and a parsed ts column """
+    browsing_df = spark.read.schema(BROWSING_SCHEMA).csv(paths)
+    return browsing_df.withColumn("ts", to_timestamp(col("ts"), "yyyy-MM-dd HH:mm:ss"))
+
+def partition_manifests(browsing_df, destination_bucket, sources):
+    """ Return the updated manifests by ds of the partitions the new objects touch
+
+    Manifests record which source objects, with their ETags, fed each ds partition. They are lineage only, the
+    partitions are never rebuilt from the raw objects, which the lifecycle rule deletes once tagged as processed.
+    """
+    sources_by_path = {f"s3a://{source['bucket']}/{source['key']}": source for source in sources}
+    new_sources_by_day = {}
+    for row in browsing_df.select("ds", input_file_name().alias("path")).distinct().collect():
+        if row.ds is None:
+            continue
+        source = sources_by_path.get(unquote(row.path))
+        # Attribute the day to every object of the batch if the path can not be matched back to its object
+        new_sources_by_day.setdefault(row.ds, {}).update(
+            {(s['bucket'], s['key']): s for s in ([source] if source else sources)}
+        )
+    new_keys = {(source['bucket'], source['key']) for source in sources}
+    manifests = {}
+    for day, day_sources in sorted(new_sources_by_day.items()):
+        recorded = [s for s in read_partition_manifest(destination_bucket, day.isoformat())
+                    if (s['bucket'], s['key']) not in new_keys]
+        manifests[day.isoformat()] = recorded + [day_sources[key] for key in sorted(day_sources)]
+    return manifests
+
+def existing_partition_paths(bucket, prefix, days):
+    """ The s3a:// paths of the ds partitions under prefix that already have Parquet files """
+    s3 = get_s3_client()
+    paths = []
+    for day in days:
+        partition_prefix = f"{prefix}ds={day.isoformat()}/"
+        response = s3.list_objects_v2(Bucket=bucket, Prefix=partition_prefix)
+        if any(obj['Key'].endswith('.parquet') for obj in response.get('Contents', [])):
+            paths.append(f"s3a://{bucket}/{partition_prefix}")
+    return paths
 
-def tag_parquet_files(bucket, prefix, tag_key, tag_value):
-    """ Tag all Parquet files in a specified S3 bucket prefix """
+def add_existing_partition_rows(spark, browsing_df, destination_bucket, browsing_prefix, touched_days):
+    """ Extend the new rows with the rows already in the browsing/ ds partitions they touch
+
+    The incremental write replaces whole ds partitions, so they are rebuilt from their current Parquet files plus the
+    new rows. Returns a persisted DataFrame, materialized before the write replaces the files it was read from.
+    """
+    paths = existing_partition_paths(destination_bucket, browsing_prefix, touched_days)
+    if not paths:
+        return browsing_df
+    logging.info(f"Rebuilding {len(paths)} existing ds partitions of {len(touched_days)} touched from their Parquet files")
+    existing_df = spark.read \
+        .option("basePath", f"s3a://{destination_bucket}/{browsing_prefix}") \
+        .parquet(*paths) \
+        .withColumn("ds", col("ds").cast("date")) \
+        .select(*browsing_df.columns)
+    return browsing_df.unionByName(existing_df)
+
+def with_row_keys(browsing_df):
+    """ Add two independent 64 bit hashes of all columns, together a 128 bit key of the row """
+    columns = [col(name) for name in browsing_df.columns]
+    return browsing_df \
+        .withColumn("row_key", xxhash64(*columns)) \
+        .withColumn("row_key2", xxhash64(lit("row_key2"), *columns))
+
+def remove_indexed_rows(spark, browsing_df, destination_bucket, touched_days):
+    """ Add row keys and drop the rows whose keys are in the dedup index of the touched ds partitions
+
+    Only the index of those days is read, never the historical browsing data. The index is broadcast when its
+    files add up to at most DEDUP_BROADCAST_BYTES.
+    """
+    keyed_df = with_row_keys(browsing_df)
+    s3 = get_s3_client()
+    index_paths = []
+    index_bytes = 0
+    paginator = s3.get_paginator('list_objects_v2')
+    for ds in touched_days:
+        prefix = f"{DEDUP_INDEX_PREFIX}ds={ds}/"
+        sizes = [obj['Size'] for page in paginator.paginate(Bucket=destination_bucket, Prefix=prefix)
+                 for obj in page.get('Contents', []) if obj['Key'].endswith('.parquet')]
+        if sizes:
+            index_paths.append(f"s3a://{destination_bucket}/{prefix}")
+            index_bytes += sum(sizes)
+    if not index_paths:
+        return keyed_df
+    index_df = spark.read \
+        .option("basePath", f"s3a://{destination_bucket}/{DEDUP_INDEX_PREFIX}") \
+        .parquet(*index_paths) \
+        .select(col("ds").cast("date").alias("ds"), *ROW_KEY_COLUMNS)
+    if index_bytes <= DEDUP_BROADCAST_BYTES:
+        index_df = broadcast(index_df)
+    logging.info(f"Anti-joining against {index_bytes} bytes of dedup index for {len(index_paths)} ds partitions")
+    return keyed_df.join(index_df, on=["ds"] + ROW_KEY_COLUMNS, how="left_anti")
+
+def layout_clustered(df, partition_columns=("ds",)):
+    """ Range partition df by the partition columns, then by the SORT_COLUMNS df has, before a partitionBy write
+
+    Each task then holds a contiguous range of ds values and writes files into one or a few ds partitions, instead
+    of every task writing a small file into every ds. Large days are split over several tasks by the sort columns.
+    The number of tasks is spark.sql.shuffle.partitions, coalesced by adaptive query execution.
+    """
+    range_columns = list(partition_columns) + [name for name in SORT_COLUMNS if name in df.columns]
+    return df.repartitionByRange(*range_columns) if range_columns else df
+
+def layout_sorted(df, partition_columns=("ds",)):
+    """ Sort each Spark partition by the partition columns, then by the SORT_COLUMNS df has
+
+    Leading with the partition columns matches the ordering the partitioned writer needs, so it does not sort again.
+    Clustered values give every row group narrow min/max statistics that Trino can skip on.
+    """
+    sort_columns = list(partition_columns) + [name for name in SORT_COLUMNS if name in df.columns]
+    return df.sortWithinPartitions(*sort_columns) if sort_columns else df
+
+def parquet_options(writer, columns):
+    """ Row group size, dictionary encoding and Bloom filters for the Parquet writer
+
+    Column statistics and page indexes are written by the Parquet writer by default. Bloom filters need Parquet 1.12,
+    i.e. Spark 3.2 or later, and are ignored by older writers.
+    """
+    writer = writer \
+        .option("parquet.block.size", PARQUET_ROW_GROUP_BYTES) \
+        .option("parquet.enable.dictionary", "true")
+    for name in BLOOM_FILTER_COLUMNS:
+        if name in columns:
+            writer = writer.option(f"parquet.bloom.filter.enabled#{name}", "true")
+    return writer
+
+def replace_partitions(writer):
+    """ Make a partitionBy("ds") writer replace only the ds partitions present in its data
+
+    PathOutputCommitProtocol does not support dynamic partition overwrite, so with the partitioned committer the
+    rows are appended and the committer deletes the existing files of the partitions it writes at job commit.
+    """
+    if OUTPUT_COMMITTER == 'partitioned':
+        return writer.mode("append").option("fs.s3a.committer.staging.conflict-mode", "replace")
+    if OUTPUT_COMMITTER == 'magic':
+        raise ValueError("The magic committer can not replace single ds partitions")
+    return writer.mode("overwrite").option("partitionOverwriteMode", "dynamic")
+
+def save_mode(writer, mode):
+    """ Apply the save mode of write_outputs, an overwrite in incremental WRITE_MODE replaces the touched ds partitions """
+    if mode == "overwrite" and WRITE_MODE == 'incremental':
+        return replace_partitions(writer)
+    return writer.mode(mode)
+
+def write_outputs(browsing_cleaned, destination_bucket, browsing_prefix, masked_prefix, mode="overwrite", index_prefix=None):
+    """ Write the full browsing dataset and its masked projection, reusing one materialization of browsing_cleaned
+
+    With an index_prefix, browsing_cleaned carries the row key columns, which are appended to the dedup index
+    after both outputs are written.
+    """
+    # One shuffle shared by both outputs, masked/ keeps the clustering of the columns it drops
+    browsing_cleaned = layout_clustered(browsing_cleaned)
+    if MULTI_OUTPUT_CACHE:
+        # The first write fills the cache, the masked write reads it instead of parsing and shuffling the source again
+        browsing_cleaned = browsing_cleaned.persist(StorageLevel.MEMORY_AND_DISK)
+    try:
+        browsing_rows = browsing_cleaned.drop(*ROW_KEY_COLUMNS) if index_prefix else browsing_cleaned
+        masked_rows = browsing_rows.drop("ip", "customer")
+        # WRITE_MODE decides whether overwrite replaces the touched ds partitions or the whole prefix
+        parquet_options(save_mode(layout_sorted(browsing_rows).write.partitionBy("ds"), mode), browsing_rows.columns) \
+            .parquet(f"s3a://{destination_bucket}/{browsing_prefix}")
+        parquet_options(save_mode(layout_sorted(masked_rows).write.partitionBy("ds"), mode), masked_rows.columns) \
+            .parquet(f"s3a://{destination_bucket}/{masked_prefix}")
+        if index_prefix:
+            # Written last, a failure before this point leaves the rows unindexed so a retry appends them again
+            # rather than dropping them
+            browsing_cleaned.select("ds", *ROW_KEY_COLUMNS).write.partitionBy("ds").mode("append") \
+                .parquet(f"s3a://{destination_bucket}/{index_prefix}")
+    finally:
+        if MULTI_OUTPUT_CACHE:
+            browsing_cleaned.unpersist()
+
+def prefix_size(path):
+    """ Total size in bytes of the objects under an s3a:// path """
+    bucket, _, prefix = path[len('s3a://'):].partition('/')
     s3 = get_s3_client()
     paginator = s3.get_paginator('list_objects_v2')
+    return sum(obj['Size'] for page in paginator.paginate(Bucket=bucket, Prefix=prefix) for obj in page.get('Contents', []))
+
+def read_watermark(bucket, key):
+    """ A watermark of arrived files, with the keys of the files modified in its overlap, None before the first run """
+    try:
+        return json.loads(get_s3_client().get_object(Bucket=bucket, Key=key)['Body'].read())
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+            return None
+        raise
+
+def write_watermark(bucket, key, watermark):
+    get_s3_client().put_object(Bucket=bucket, Key=key, Body=json.dumps(watermark).encode('utf-8'), ContentType='application/json')
+
+def arrived_files(path, watermark_bucket, watermark_key):
+    """ The s3a:// paths of the Parquet files added under path since the watermark at watermark_key
+
+    Returns the paths and the watermark to write once they are processed, the first call returns every file.
+    """
+    bucket, _, prefix = path[len('s3a://'):].partition('/')
+    watermark = read_watermark(watermark_bucket, watermark_key)
+    since = datetime.fromisoformat(watermark['last_modified']) - timedelta(seconds=TRANSACTION_ARRIVAL_OVERLAP) if watermark else None
+    seen = set(watermark['keys']) if watermark else set()
+    files = {}
+    paginator = get_s3_client().get_paginator('list_objects_v2')
     for page in paginator.paginate(Bucket=bucket, Prefix=prefix, PaginationConfig={'PageSize': 1000}):
         for obj in page.get('Contents', []):
             if obj['Key'].endswith('.parquet'):
-                s3.put_object_tagging(
-                    Bucket=bucket,
-                    Key=obj['Key'],
-                    Tagging={'TagSet': [{'Key': tag_key, 'Value': tag_value}]}
-                )
+                files[obj['Key']] = obj['LastModified']
+    new_keys = sorted(key for key, modified in files.items() if (since is None or modified >= since) and key not in seen)
+    if not new_keys:
+        return [], None
+    last_modified = max(files.values())
+    overlap_start = last_modified - timedelta(seconds=TRANSACTION_ARRIVAL_OVERLAP)
+    new_watermark = {
+        'last_modified': last_modified.astimezone(timezone.utc).isoformat(),
+        'keys': sorted(key for key, modified in files.items() if modified >= overlap_start)
+    }
+    logging.info(f"{len(new_keys)} new files under {path} since the watermark {watermark_key}")
+    return [f"s3a://{bucket}/{key}" for key in new_keys], new_watermark
 
+def enrichment_join_condition(browsing, transactions):
+    """ The join of create_table_combined_trans_and_logs.sql, limited to ENRICHMENT_WINDOW_DAYS after ds when set """
+    condition = (transactions.client_id == browsing.customer) & (transactions.item_id == browsing.resource_fk)
+    if ENRICHMENT_WINDOW_DAYS < 0:
+        return condition
+    return condition \
+        & (transactions.transaction_date >= browsing.ds.cast("timestamp")) \
+        & (transactions.transaction_date < date_add(browsing.ds, ENRICHMENT_WINDOW_DAYS + 1).cast("timestamp"))
 
-def main():
-    """ Main function to process data using Spark with AWS IAM role assumption """
-    check_environment_variables()
-    source_bucket = os.getenv('SOURCE_BUCKET')
-    destination_bucket = os.getenv('DESTINATION_BUCKET')
-    s3_object_key = os.getenv('S3_OBJECT_KEY')
-    browsing_prefix = 'browsing/'
-    masked_prefix = 'masked/'
+def combined_days_of_transactions(spark, destination_bucket, browsing_prefix, transaction_files):
+    """ The ds partitions of combined_browsing_transactions that rows of the given transaction files join into
 
-    if check_s3_object_tag(source_bucket, s3_object_key, 'processed'):
-        logging.info(f"Object {s3_object_key} has already been processed.")
-        return
+    Reads the join keys of the new transactions and of browsing/, limited to the ds window the transactions can
+    match when ENRICHMENT_WINDOW_DAYS is set, otherwise the join key columns of the whole browsing table.
+    """
+    transactions = spark.read.parquet(*transaction_files).select("client_id", "item_id", "transaction_date")
+    browsing = spark.read.parquet(f"s3a://{destination_bucket}/{browsing_prefix}") \
+        .select("ds", col("customer").cast("bigint").alias("customer"), "resource_fk")
+    if ENRICHMENT_WINDOW_DAYS >= 0:
+        bounds = transactions.agg(spark_min("transaction_date").alias("first"), spark_max("transaction_date").alias("last")).collect()[0]
+        if bounds['first'] is None:
+            return []
+        browsing = browsing.filter(
+            (col("ds") >= lit(bounds['first'].date() - timedelta(days=ENRICHMENT_WINDOW_DAYS))) & (col("ds") <= lit(bounds['last'].date()))
+        )
+    days = browsing.join(transactions, enrichment_join_condition(browsing, transactions)).select("ds").distinct().collect()
+    return sorted(row.ds for row in days if row.ds is not None)
+
+def build_combined_partitions(spark, destination_bucket, browsing_prefix, touched_days):
+    """ Rebuild the combined_browsing_transactions partitions of the touched days
+
+    Joins the browsing rows of those days, read back from browsing/ so they are complete in every WRITE_MODE, with
+    the transactions on client id and item id, like create_table_combined_trans_and_logs.sql, limited to the
+    transactions of the ENRICHMENT_WINDOW_DAYS after each row's ds when it is set. The smaller side is broadcast
+    when it fits ENRICHMENT_BROADCAST_BYTES. Otherwise both sides are hash partitioned on the join keys into the
+    same ENRICHMENT_PARTITIONS partitions, which the sort merge join uses without another shuffle.
+    The output is sorted by customer inside each ds so joins on customer read it in order.
+    """
+    browsing_path = f"s3a://{destination_bucket}/{browsing_prefix}"
+    # customer is cast to the type of client_id up front, so the hash partitioning below is on the join key itself
+    # and not on the int column the join would cast again
+    browsing = spark.read.parquet(browsing_path).filter(col("ds").isin(touched_days)) \
+        .withColumn("customer", col("customer").cast("bigint"))
+    transactions = spark.read.parquet(TRANSACTIONS_PATH)
+    transaction_columns = [name for name in TRANSACTION_COLUMNS if name in transactions.columns]
+    transactions = transactions.select("client_id", "item_id", *transaction_columns)
+    if ENRICHMENT_WINDOW_DAYS >= 0:
+        # Pushed down to the Parquet scan, the row groups outside the window of the touched days are skipped
+        window_end = max(touched_days) + timedelta(days=ENRICHMENT_WINDOW_DAYS + 1)
+        transactions = transactions.filter(
+            (col("transaction_date") >= lit(min(touched_days)).cast("timestamp"))
+            & (col("transaction_date") < lit(window_end).cast("timestamp"))
+        )
+    join_condition = enrichment_join_condition(browsing, transactions)
 
+    browsing_bytes = sum(prefix_size(f"{browsing_path}ds={day.isoformat()}/") for day in touched_days)
+    transactions_bytes = prefix_size(TRANSACTIONS_PATH)
+    if transactions_bytes <= min(browsing_bytes, ENRICHMENT_BROADCAST_BYTES):
+        transactions = broadcast(transactions)
+        strategy = 'broadcast transactions'
+    elif browsing_bytes <= ENRICHMENT_BROADCAST_BYTES:
+        browsing = broadcast(browsing)
+        strategy = 'broadcast browsing'
+    else:
+        browsing = browsing.repartition(ENRICHMENT_PARTITIONS, "customer", "resource_fk")
+        transactions = transactions.repartition(ENRICHMENT_PARTITIONS, "client_id", "item_id")
+        strategy = f"hash partitioned join in {ENRICHMENT_PARTITIONS} partitions"
+    logging.info(f"Joining {browsing_bytes} bytes of browsing logs with {transactions_bytes} bytes of transactions: {strategy}")
+
+    combined = browsing.join(transactions, join_condition).select(*[browsing[name] for name in browsing.columns], *[transactions[name] for name in transaction_columns])
+    writer = replace_partitions(layout_clustered(combined).sortWithinPartitions("ds", "customer").write.partitionBy("ds"))
+    parquet_options(writer, combined.columns).parquet(f"s3a://{destination_bucket}/{COMBINED_PREFIX}")
+
+def committer_configs(committer):
+    """ Spark settings that commit the output with the given S3A committer, none for the default file committer
+
+    The S3A committers need the spark-hadoop-cloud module on the classpath.
+    """
+    if committer == 'file':
+        return {}
+    return {
+        "spark.hadoop.fs.s3a.committer.name": committer,
+        "spark.hadoop.fs.s3a.committer.magic.enabled": "true",
+        "spark.hadoop.fs.s3a.committer.staging.conflict-mode": "append",
+        "spark.hadoop.mapreduce.outputcommitter.factory.scheme.s3a": "org.apache.hadoop.fs.s3a.commit.S3ACommitterFactory",
+        "spark.sql.sources.commitProtocolClass": "org.apache.spark.internal.io.cloud.PathOutputCommitProtocol",
+        "spark.sql.parquet.output.committer.class": "org.apache.spark.internal.io.cloud.BindingParquetOutputCommitter"
+    }
+
+def build_spark_session():
+    """ Create the SparkSession reading and writing through S3A with the assumed role """
     spark_master_url = os.getenv('SPARK_MASTER_URL', 'spark://localhost:7077')
-    spark = SparkSession.builder \
+    builder = SparkSession.builder \
         .appName("Data Processing with IAM Role Assumption") \
         .master(spark_master_url) \
         .config("spark.driver.host", os.getenv('SPARK_DRIVER_HOST')) \
@@ -108,45 +599,322 @@ def main():
         .config("spark.hadoop.fs.s3a.assumed.role.credentials.provider", "org.apache.hadoop.fs.s3a.SimpleAWSCredentialsProvider") \
         .config("spark.hadoop.fs.s3a.impl", "org.apache.hadoop.fs.s3a.S3AFileSystem") \
         .config("spark.hadoop.fs.s3a.path.style.access", True) \
-        .getOrCreate()
-
-    browsing_schema = StructType([
-        StructField("ip", StringType(), True),
-        StructField("ts", StringType(), True),
-        StructField("tz", StringType(), True),
-        StructField("verb", StringType(), True),
-        StructField("resource_type", StringType(), True),
-        StructField("resource_fk", StringType(), True),
-        StructField("response", IntegerType(), True),
-        StructField("browser", StringType(), True),
-        StructField("os", StringType(), True),
-        StructField("customer", IntegerType(), True),
-        StructField("d_day_name", StringType(), True),
-        StructField("i_current_price", DoubleType(), True),
-        StructField("i_category", StringType(), True),
-        StructField("i_description", StringType(), True),
-        StructField("c_preferred_cust_flag", BooleanType(), True),
-        StructField("ds", DateType(), True)
-    ])
-
-    # Load and cleanse browsing data
-    file_path = f"s3a://{source_bucket}/{s3_object_key}"
-    browsing_df = spark.read.schema(browsing_schema).csv(file_path)
-    browsing_df = browsing_df.withColumn("ts", to_timestamp(col("ts"), "yyyy-MM-dd HH:mm:ss"))
-    browsing_cleaned = browsing_df.dropDuplicates()
-
-    browsing_cleaned.write.partitionBy("ds").mode("overwrite").parquet(f"s3a://{destination_bucket}/{browsing_prefix}")
-    browsing_cleaned.drop("ip", "customer").write.partitionBy("ds").mode("overwrite").parquet(f"s3a://{destination_bucket}/{masked_prefix}")
-
-    # Tag the original object as processed
-    s3 = get_s3_client()
-    s3.put_object_tagging(
-        Bucket=source_bucket,
-        Key=s3_object_key,
-        Tagging={'TagSet': [{'Key': 'processed', 'Value': 'true'}]}
-    )
-    tag_parquet_files(destination_bucket, browsing_prefix, 'secclearance', 'red')
+        .config("spark.sql.sources.partitionOverwriteMode", "dynamic" if WRITE_MODE == 'incremental' and OUTPUT_COMMITTER == 'file' else "static")
+    for key, value in committer_configs(OUTPUT_COMMITTER).items():
+        builder = builder.config(key, value)
+    return builder.getOrCreate()
+
+def unprocessed_keys(bucket, keys):
+    """ Return the keys neither tagged as processed nor quarantined, in their original order """
+    with ThreadPoolExecutor(max_workers=TAG_WORKERS) as executor:
+        tags = list(executor.map(lambda key: get_object_tags(bucket, key), keys))
+    pending = []
+    for key, object_tags in zip(keys, tags):
+        if object_tags.get('processed') == 'true':
+            logging.info(f"Object {key} has already been processed.")
+        elif object_tags.get('quarantined') == 'true':
+            logging.info(f"Object {key} is quarantined.")
+        else:
+            pending.append(key)
+    return pending
+
+def check_leases(leases):
+    """ Fail the run before a write if a lease expired while the job was stalled and the compaction tool may hold it """
+    for lease in leases:
+        lease.check()
+
+def process_objects(spark, source_bucket, destination_bucket, object_keys):
+    """ Cleanse a set of raw objects and write the run's report, also when the run fails
+
+    The report starts empty for every call, so a micro-batch's report never carries the phases of an earlier one.
+    """
+    _job_report.reset()
+    _job_report.set('source_objects', list(object_keys))
+    _job_report.set('write_mode', WRITE_MODE)
+    _job_report.set('status', 'failed')
+    try:
+        cleanse_objects(spark, source_bucket, destination_bucket, object_keys)
+        _job_report.set('status', 'succeeded')
+    except Exception as e:
+        _job_report.set('error', f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        if REPORT_ENABLED:
+            _job_report.write(spark, get_s3_client, destination_bucket, REPORT_PREFIX)
+
+def cleanse_objects(spark, source_bucket, destination_bucket, object_keys):
+    """ Cleanse a set of raw objects in one Spark job and write them to browsing/ and masked/ """
+    browsing_prefix = 'browsing/'
+    masked_prefix = 'masked/'
+
+    # The compaction tool rewrites ds partitions under the same leases, it skips the ones held here
+    lease_tables = [browsing_prefix, masked_prefix] + ([COMBINED_PREFIX] if ENRICHMENT_ENABLED else [])
+    owner = lease_owner('cleansing')
+    leases = []
+    try:
+        if WRITE_MODE == 'full':
+            leases = acquire_table_leases(get_s3_client, destination_bucket, lease_tables, owner, LEASE_WAIT_SECONDS)
+
+        # Load and cleanse browsing data. The pass finding the touched days fills the cache, the writes read the new
+        # rows from it, not the raw objects
+        new_rows = read_browsing_csv(spark, [f"s3a://{source_bucket}/{key}" for key in object_keys]) \
+            .persist(StorageLevel.MEMORY_AND_DISK)
+        browsing_df = new_rows
+        manifests = {}
+        if WRITE_MODE in ('incremental', 'append'):
+            s3 = get_s3_client()
+            sources = [
+                {'bucket': source_bucket, 'key': key, 'etag': s3.head_object(Bucket=source_bucket, Key=key)['ETag']}
+                for key in object_keys
+            ]
+            with _job_report.phase('partition_manifests', spark):
+                manifests = partition_manifests(new_rows, destination_bucket, sources)
+            touched_days = [date.fromisoformat(ds) for ds in sorted(manifests)]
+            # Taken before the current partition files are read, so no compaction replaces them until the write
+            with _job_report.phase('partition_leases'):
+                leases = acquire_partition_leases(get_s3_client, destination_bucket, lease_tables, sorted(manifests), owner, LEASE_WAIT_SECONDS)
+            if WRITE_MODE == 'incremental':
+                browsing_df = add_existing_partition_rows(spark, new_rows, destination_bucket, browsing_prefix, touched_days)
+        else:
+            touched_days = sorted(row.ds for row in new_rows.select("ds").distinct().collect() if row.ds is not None)
+        browsing_cleaned = browsing_df.dropDuplicates()
+        if WRITE_MODE == 'incremental' and browsing_df is not new_rows:
+            # Materialized before the write replaces the partition files it reads, masked/ is written from the same rows.
+            # If cached blocks are lost after the replace the job fails, and a rerun rebuilds the same partitions again
+            browsing_cleaned = browsing_cleaned.persist(StorageLevel.MEMORY_AND_DISK)
+            _job_report.count('rebuilt_partition_rows', browsing_cleaned.count())
+
+        # Append adds files next to the ones already in the touched partitions, which are not tagged again. The other
+        # modes replace those partitions, every file left in them after the write is one this run wrote
+        existing_browsing_files = set()
+        if WRITE_MODE == 'append':
+            existing_browsing_files = set(list_partition_file_sizes(destination_bucket, browsing_prefix, touched_days))
+        check_leases(leases)
+        with _job_report.phase('write_outputs', spark):
+            if WRITE_MODE == 'append':
+                browsing_cleaned = remove_indexed_rows(spark, browsing_cleaned, destination_bucket, sorted(manifests))
+                write_outputs(browsing_cleaned, destination_bucket, browsing_prefix, masked_prefix, mode="append", index_prefix=DEDUP_INDEX_PREFIX)
+            else:
+                write_outputs(browsing_cleaned, destination_bucket, browsing_prefix, masked_prefix)
+        # Only the partitions this run wrote are listed, still under the leases that keep other writers out of them.
+        # A full write replaced the whole prefix under the table leases, all of it is this run's output
+        if WRITE_MODE == 'full':
+            browsing_file_sizes = list_parquet_file_sizes(destination_bucket, browsing_prefix)
+        else:
+            browsing_file_sizes = list_partition_file_sizes(destination_bucket, browsing_prefix, touched_days)
+        written_browsing_files = set(browsing_file_sizes) - existing_browsing_files
+        browsing_cleaned.unpersist()
+        new_rows.unpersist()
+        for ds, sources in manifests.items():
+            write_partition_manifest(destination_bucket, ds, sources)
+
+        combined_days = []
+        written_combined_files = set()
+        if ENRICHMENT_ENABLED:
+            with _job_report.phase('enrichment', spark):
+                # Transactions that arrived since the last run also join into partitions of days this run did not touch
+                transaction_files, enrichment_watermark = arrived_files(TRANSACTIONS_PATH, destination_bucket, ENRICHMENT_WATERMARK_KEY)
+                arrival_days = combined_days_of_transactions(spark, destination_bucket, browsing_prefix, transaction_files) if transaction_files else []
+                combined_days = sorted(set(touched_days) | set(arrival_days))
+                extra_days = [day.isoformat() for day in arrival_days if day not in set(touched_days)]
+                if extra_days and WRITE_MODE != 'full':
+                    leases += acquire_partition_leases(get_s3_client, destination_bucket, [COMBINED_PREFIX], extra_days, owner, LEASE_WAIT_SECONDS)
+                if combined_days:
+                    check_leases(leases)
+                    build_combined_partitions(spark, destination_bucket, browsing_prefix, combined_days)
+                    # The rebuilt partitions only hold files of this run
+                    written_combined_files = set(list_partition_file_sizes(destination_bucket, COMBINED_PREFIX, combined_days))
+                if enrichment_watermark:
+                    # Written after the rebuild, a failed run joins the same files again
+                    write_watermark(destination_bucket, ENRICHMENT_WATERMARK_KEY, enrichment_watermark)
+        if ROLLUPS_ENABLED:
+            with _job_report.phase('rollups', spark):
+                # This module's own S3 client and settings, also when it runs as __main__
+                update_rollups(spark, sys.modules[__name__], destination_bucket, browsing_prefix, touched_days, combined_days=combined_days)
+    finally:
+        release_leases(leases)
+
+    # Tag the original objects as processed
+    tag_objects(source_bucket, object_keys, 'processed', 'true')
+    tag_objects(destination_bucket, written_browsing_files, 'secclearance', 'red')
+    if ENRICHMENT_ENABLED:
+        # The combined table carries the browsing PII columns
+        tag_objects(destination_bucket, written_combined_files, 'secclearance', 'red')
+
+    if REPORT_ENABLED:
+        _job_report.set('written_browsing_partitions', partition_file_stats(
+            {key: size for key, size in browsing_file_sizes.items() if key in written_browsing_files}, browsing_prefix
+        ))
+
+class PrefixScanKeySource:
+    """ New object keys found by listing the source bucket under a prefix """
+
+    def __init__(self, bucket, prefix, scan_interval):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.scan_interval = scan_interval
+        self.next_scan = 0
+
+    def poll(self):
+        if time.monotonic() < self.next_scan:
+            return []
+        self.next_scan = time.monotonic() + self.scan_interval
+        s3 = get_s3_client()
+        keys = []
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix, PaginationConfig={'PageSize': 1000}):
+            keys.extend(obj['Key'] for obj in page.get('Contents', []) if not obj['Key'].endswith('/'))
+        return keys
+
+class NotificationFileKeySource:
+    """ Object keys appended to a local file, one per line, either as plain keys or as S3 bucket notification JSON """
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+
+    def poll(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'r') as f:
+            f.seek(self.offset)
+            lines = f.readlines()
+            # A partially written last line is read again on the next poll
+            if lines and not lines[-1].endswith('\n'):
+                lines.pop()
+            self.offset += sum(len(line.encode('utf-8')) for line in lines)
+        keys = []
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('{'):
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    logging.error(f"Ignoring malformed notification: {line}")
+                    continue
+                keys.extend(unquote_plus(record['s3']['object']['key']) for record in event.get('Records', []))
+            else:
+                keys.append(line)
+        return keys
+
+class SeenKeys:
+    """ Insertion ordered set of keys that forgets the oldest ones beyond max_keys """
+
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self.keys = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def update(self, keys):
+        for key in keys:
+            self.keys[key] = None
+            self.keys.move_to_end(key)
+        while len(self.keys) > self.max_keys:
+            self.keys.popitem(last=False)
+
+def quarantine_object(bucket, key, error):
+    """ Tag an object that keeps failing as quarantined, the service and later scans skip it """
+    logging.error(f"Quarantining {key} after {MAX_KEY_FAILURES} failed attempts, last error: {error}")
+    try:
+        put_tag_with_retry(get_s3_client(), bucket, key, 'quarantined', 'true')
+    except ClientError as e:
+        logging.error(f"Failed to tag {key} as quarantined: {e}")
+
+def record_key_failure(bucket, key, error, key_failures):
+    """ Count a failure of a key processed alone, returns whether to try it again or False once it is quarantined """
+    key_failures[key] = key_failures.get(key, 0) + 1
+    logging.error(f"Failed to process {key}, attempt {key_failures[key]} of {MAX_KEY_FAILURES}: {error}")
+    if key_failures[key] < MAX_KEY_FAILURES:
+        return True
+    quarantine_object(bucket, key, error)
+    key_failures.pop(key)
+    return False
+
+def process_keys_one_by_one(spark, source_bucket, destination_bucket, keys, key_failures):
+    """ Process keys in micro-batches of one, so a bad or deleted object does not block the others
+
+    Returns the keys to try again later, a key failing MAX_KEY_FAILURES times is quarantined instead.
+    """
+    retry_keys = []
+    for key in keys:
+        try:
+            process_objects(spark, source_bucket, destination_bucket, [key])
+            key_failures.pop(key, None)
+        except Exception as e:
+            if record_key_failure(source_bucket, key, e, key_failures):
+                retry_keys.append(key)
+    return retry_keys
+
+def run_service(source_bucket, destination_bucket):
+    """ Keep one SparkSession warm and cleanse new objects in micro-batches of up to MICRO_BATCH_MAX_KEYS keys
+    or MICRO_BATCH_INTERVAL seconds
+
+    The keys of a failed micro-batch are processed one by one right away, the ones failing alone are retried one by
+    one every MICRO_BATCH_INTERVAL seconds until they succeed or are quarantined.
+    """
+    if NOTIFICATION_FILE:
+        key_source = NotificationFileKeySource(NOTIFICATION_FILE)
+    else:
+        key_source = PrefixScanKeySource(source_bucket, SOURCE_PREFIX, SCAN_INTERVAL)
+    spark = build_spark_session()
+    seen_keys = SeenKeys(SEEN_KEYS_MAX)
+    pending_keys = []
+    batch_opened_at = None
+    retry_keys = []
+    key_failures = {}
+    next_retry_at = 0
+    try:
+        while True:
+            if retry_keys and time.monotonic() >= next_retry_at:
+                retry_keys = process_keys_one_by_one(spark, source_bucket, destination_bucket, retry_keys, key_failures)
+                next_retry_at = time.monotonic() + MICRO_BATCH_INTERVAL
+            new_keys = [key for key in key_source.poll() if key not in seen_keys]
+            seen_keys.update(new_keys)
+            pending_keys.extend(unprocessed_keys(source_bucket, new_keys) if new_keys else [])
+            if pending_keys and batch_opened_at is None:
+                batch_opened_at = time.monotonic()
+            if not pending_keys or (len(pending_keys) < MICRO_BATCH_MAX_KEYS and time.monotonic() - batch_opened_at < MICRO_BATCH_INTERVAL):
+                time.sleep(POLL_INTERVAL)
+                continue
+            batch = pending_keys[:MICRO_BATCH_MAX_KEYS]
+            pending_keys = pending_keys[MICRO_BATCH_MAX_KEYS:]
+            batch_opened_at = time.monotonic() if pending_keys else None
+            start = time.time()
+            try:
+                process_objects(spark, source_bucket, destination_bucket, batch)
+                logging.info(f"Processed a micro-batch of {len(batch)} objects in {time.time() - start:.1f}s")
+            except Exception as e:
+                if len(batch) == 1:
+                    if record_key_failure(source_bucket, batch[0], e, key_failures):
+                        retry_keys.append(batch[0])
+                else:
+                    logging.error(f"Failed to process a micro-batch of {len(batch)} objects, processing them one by one: {e}")
+                    retry_keys.extend(process_keys_one_by_one(spark, source_bucket, destination_bucket, batch, key_failures))
+                next_retry_at = time.monotonic() + MICRO_BATCH_INTERVAL
+    finally:
+        spark.stop()
+
+def main():
+    """ Main function to process data using Spark with AWS IAM role assumption """
+    check_environment_variables()
+    source_bucket = os.getenv('SOURCE_BUCKET')
+    destination_bucket = os.getenv('DESTINATION_BUCKET')
+
+    if RUN_MODE == 'service':
+        run_service(source_bucket, destination_bucket)
+        return
+
+    s3_object_key = os.getenv('S3_OBJECT_KEY')
+    if check_s3_object_tag(source_bucket, s3_object_key, 'processed'):
+        logging.info(f"Object {s3_object_key} has already been processed.")
+        return
 
+    spark = build_spark_session()
+    process_objects(spark, source_bucket, destination_bucket, [s3_object_key])
 
     spark.stop()
 
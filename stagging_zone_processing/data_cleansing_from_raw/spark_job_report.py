@@ -0,0 +1,169 @@
+import json
+import time
+import logging
+import threading
+import urllib.request
+from contextlib import contextmanager
+
+STAGE_FIELDS = [
+    "numTasks", "executorRunTime", "executorCpuTime", "jvmGcTime",
+    "inputBytes", "inputRecords", "outputBytes", "outputRecords",
+    "shuffleReadBytes", "shuffleReadRecords", "shuffleWriteBytes", "shuffleWriteRecords",
+    "memoryBytesSpilled", "diskBytesSpilled"
+]
+TOTAL_FIELDS = [field for field in STAGE_FIELDS if field != "numTasks"]
+
+
+def get_json(url):
+    with urllib.request.urlopen(url, timeout=10) as response:
+        return json.loads(response.read())
+
+
+def skew(quantiles):
+    """ Max over median of a [median, max] task quantile pair, None when the median is 0 """
+    median, maximum = quantiles
+    return round(maximum / median, 2) if median else None
+
+
+class JobReport:
+    """ Python-side phase timings and Spark stage and task metrics of one run of a job
+
+    No SparkListener is registered for this: a Python listener has to implement the whole listener interface through
+    a py4j callback server, and every listener bus event, one per task, would then be a call from the JVM into the
+    driver's Python process. Spark's own AppStatusListener already aggregates the same stage and task metrics for
+    the application status store, so they are read back from the driver's status REST API at the end of each run,
+    and the report names that source. Stages are attributed to the phase whose job group ran them. The report covers
+    what happened since the last reset, so a long-running job writes one report per batch.
+    """
+
+    def __init__(self, job_name):
+        self.job_name = job_name
+        self._lock = threading.Lock()
+        self._reported_stages = set()
+        self._s3a_baseline = {}
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started_at = time.time()
+            self.phases = {}
+            self.counters = {}
+            self.details = {}
+
+    @contextmanager
+    def phase(self, name, spark=None):
+        """ Time a block of the job, with spark the Spark jobs it runs are put in a job group named after the phase """
+        if spark is not None:
+            spark.sparkContext.setJobGroup(name, f"{self.job_name} {name}")
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                timing = self.phases.setdefault(name, {'seconds': 0.0, 'calls': 0})
+                timing['seconds'] += elapsed
+                timing['calls'] += 1
+            if spark is not None:
+                spark.sparkContext.setLocalProperty("spark.jobGroup.id", None)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        with self._lock:
+            self.details[name] = value
+
+    def stage_metrics(self, spark):
+        """ Metrics of the stages finished since the last report, with the task skew of the multi-task ones """
+        sc = spark.sparkContext
+        if not sc.uiWebUrl:
+            return []
+        base = f"{sc.uiWebUrl}/api/v1/applications/{sc.applicationId}"
+        phase_by_stage = {}
+        for job in get_json(f"{base}/jobs"):
+            for stage_id in job.get('stageIds', []):
+                phase_by_stage[stage_id] = job.get('jobGroup')
+        stages = []
+        for stage in get_json(f"{base}/stages"):
+            stage_key = (stage['stageId'], stage['attemptId'])
+            if stage['status'] not in ('COMPLETE', 'FAILED') or stage_key in self._reported_stages:
+                continue
+            self._reported_stages.add(stage_key)
+            metrics = {
+                'stage_id': stage['stageId'],
+                'attempt_id': stage['attemptId'],
+                'name': stage['name'],
+                'status': stage['status'],
+                'phase': phase_by_stage.get(stage['stageId']),
+                'completion_time': stage.get('completionTime'),
+                **{field: stage.get(field, 0) for field in STAGE_FIELDS}
+            }
+            if stage.get('numTasks', 0) > 1:
+                summary = get_json(f"{base}/stages/{stage['stageId']}/{stage['attemptId']}/taskSummary?quantiles=0.5,1.0")
+                metrics['task_run_time_skew'] = skew(summary['executorRunTime'])
+                shuffle_read = summary.get('shuffleReadMetrics', {}).get('readBytes')
+                if shuffle_read:
+                    metrics['task_shuffle_read_skew'] = skew(shuffle_read)
+            stages.append(metrics)
+        return stages
+
+    def s3a_statistics(self, spark, path):
+        """ S3A storage statistics of the driver's filesystem instance since the last report
+
+        Executors keep their own S3A instances, whose statistics Spark does not ship back to the driver.
+        """
+        jvm = spark._jvm
+        fs = jvm.org.apache.hadoop.fs.FileSystem.get(jvm.java.net.URI(path), spark._jsc.hadoopConfiguration())
+        current = {}
+        statistics = fs.getStorageStatistics().getLongStatistics()
+        while statistics.hasNext():
+            statistic = statistics.next()
+            current[statistic.getName()] = statistic.getValue()
+        baseline, self._s3a_baseline = self._s3a_baseline, current
+        return {name: value - baseline.get(name, 0) for name, value in sorted(current.items()) if value - baseline.get(name, 0)}
+
+    def build(self, spark, s3a_path):
+        """ Assemble the report and start the next one """
+        stages = self.stage_metrics(spark)
+        totals_by_phase = {}
+        for stage in stages:
+            totals = totals_by_phase.setdefault(stage['phase'] or 'other', {field: 0 for field in TOTAL_FIELDS})
+            for field in TOTAL_FIELDS:
+                totals[field] += stage[field]
+        finished_at = time.time()
+        with self._lock:
+            report = {
+                'job': self.job_name,
+                'application_id': spark.sparkContext.applicationId,
+                'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.started_at)),
+                'finished_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(finished_at)),
+                'duration_seconds': round(finished_at - self.started_at, 3),
+                'phases': {name: {'seconds': round(t['seconds'], 3), 'calls': t['calls']} for name, t in self.phases.items()},
+                'counters': dict(self.counters),
+                **self.details,
+                'stage_metrics_source': 'Spark status REST API (/jobs and /stages), filled by AppStatusListener',
+                'spark_totals_by_phase': totals_by_phase,
+                'stages': stages,
+                'driver_s3a_statistics': {
+                    'scope': 'driver only, the requests of the executors, e.g. the Parquet reads and writes, are not included',
+                    'statistics': self.s3a_statistics(spark, s3a_path)
+                }
+            }
+        self.reset()
+        return report
+
+    def write(self, spark, s3_client, bucket, prefix):
+        """ Store the report as JSON under prefix in bucket with the client s3_client returns
+
+        A failure, including one to get the client, is logged and does not fail the job.
+        """
+        try:
+            s3 = s3_client()
+            report = self.build(spark, f"s3a://{bucket}/")
+            key = f"{prefix}{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}-{report['application_id']}.json"
+            s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(report, indent=2).encode('utf-8'), ContentType='application/json')
+            logging.info(f"Wrote the job report to s3://{bucket}/{key}")
+        except Exception as e:
+            logging.error(f"Failed to write the job report: {e}")
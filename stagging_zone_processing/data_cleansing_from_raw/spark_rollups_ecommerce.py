@@ -0,0 +1,160 @@
+import os
+import sys
+import logging
+import argparse
+from datetime import date, timedelta
+from pyspark.sql.functions import col, lit, to_date, count, countDistinct, sum as sum_, unix_timestamp
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Pre-aggregated tables, one small file per ds partition under ROLLUP_PREFIX/<rollup>/ in the destination bucket
+ROLLUP_PREFIX = os.getenv('ROLLUP_PREFIX', 'rollups/')
+# Last modified time of the newest transaction file already rolled up, kept in the destination bucket
+TRANSACTION_WATERMARK_KEY = os.getenv('TRANSACTION_WATERMARK_KEY', f"{ROLLUP_PREFIX}_transactions_watermark.json")
+
+
+def check_environment_variables():
+    """ Check for all necessary environment variables """
+    required_vars = [
+        'AWS_REGION', 'S3_ENDPOINT', 'DESTINATION_BUCKET', 'SOURCE_ROLE_ARN',
+        'AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'SPARK_MASTER_URL',
+        'STS_ENDPOINT', 'STS_REGION', 'SESSION_DURATION', 'SPARK_DRIVER_HOST'
+    ]
+    missing_vars = [var for var in required_vars if not os.getenv(var)]
+    if missing_vars:
+        logging.error("Missing environment variables:")
+        for var in missing_vars:
+            logging.error(var)
+        sys.exit(1)
+
+
+def category_sales_daily(transactions):
+    """ Revenue, units and transactions per product category and day """
+    return transactions.groupBy("ds", "category").agg(
+        sum_("total_amount").alias("total_sales"),
+        sum_("quantity").alias("units_sold"),
+        countDistinct("transaction_id").alias("transactions")
+    )
+
+
+def product_sales_daily(transactions):
+    """ Purchases, units and revenue per item and day, top products are ranked over the days of the dashboard """
+    return transactions.groupBy("ds", "item_id", "item_description", "category").agg(
+        count("*").alias("purchase_count"),
+        sum_("quantity").alias("units_sold"),
+        sum_("total_amount").alias("revenue")
+    )
+
+
+def browsing_activity_daily(browsing):
+    """ Page views and visitors per item category, resource type and day """
+    return browsing.groupBy("ds", "i_category", "resource_type").agg(
+        count("*").alias("views"),
+        countDistinct("customer").alias("customers")
+    )
+
+
+def browse_to_purchase_daily(combined):
+    """ Sum and count of the lags between a view and a later purchase of the same item, per category and browse day
+
+    Kept as a sum and a count so the average lag over any range of days is sum(lag_seconds) / sum(purchases).
+    """
+    lag = unix_timestamp(col("transaction_date")) - unix_timestamp(col("ts"))
+    return combined.filter(col("transaction_date") > col("ts")).groupBy("ds", "category").agg(
+        sum_(lag).alias("lag_seconds"),
+        count("*").alias("purchases"),
+        countDistinct("customer").alias("customers")
+    )
+
+
+def write_rollup(cleansing, rollup_df, destination_bucket, name):
+    """ Replace the ds partitions of a rollup present in rollup_df, one file per partition """
+    writer = cleansing.replace_partitions(rollup_df.repartition("ds").sortWithinPartitions("ds").write.partitionBy("ds"))
+    cleansing.parquet_options(writer, rollup_df.columns).parquet(f"s3a://{destination_bucket}/{ROLLUP_PREFIX}{name}/")
+
+
+def read_transactions(spark, cleansing, days):
+    """ The transactions of the given days with their ds
+
+    The range filter on transaction_date is pushed down to the Parquet scan, which skips the row groups of other
+    days, the to_date filter then keeps the given days.
+    """
+    return spark.read.parquet(cleansing.TRANSACTIONS_PATH) \
+        .filter((col("transaction_date") >= lit(min(days)).cast("timestamp"))
+                & (col("transaction_date") < lit(max(days) + timedelta(days=1)).cast("timestamp"))) \
+        .withColumn("ds", to_date(col("transaction_date"))) \
+        .filter(col("ds").isin(days))
+
+
+def arrived_transaction_days(spark, cleansing, destination_bucket):
+    """ The ds of the transactions in the files added to TRANSACTIONS_PATH since the rollup watermark
+
+    Returns the days and the watermark to write once their rollups are updated, the first run takes every file.
+    Only the transaction_date column of the new files is read.
+    """
+    files, watermark = cleansing.arrived_files(cleansing.TRANSACTIONS_PATH, destination_bucket, TRANSACTION_WATERMARK_KEY)
+    if not files:
+        return [], None
+    days = spark.read.parquet(*files).select(to_date(col("transaction_date")).alias("ds")).distinct().collect()
+    return sorted(row.ds for row in days if row.ds is not None), watermark
+
+
+def update_rollups(spark, cleansing, destination_bucket, browsing_prefix, touched_days, transaction_days=None, combined_days=None):
+    """ Recompute the rollups of the days whose facts changed
+
+    cleansing is the cleansing job's module, whose S3 client, writer settings and table paths the rollups share, so a
+    run inside the job does not import it a second time with its own role session. Each rollup partition depends on
+    the facts of its own day alone. The browsing rollups are refreshed for the touched days. The browse-to-purchase
+    rollup is refreshed for combined_days, the combined_browsing_transactions partitions the run rebuilt, by default
+    the touched days that have one. The transaction rollups are refreshed for transaction_days, by default the days
+    of the transaction files that arrived since the last run.
+    """
+    watermark = None
+    if transaction_days is None:
+        transaction_days, watermark = arrived_transaction_days(spark, cleansing, destination_bucket)
+    rollups = {}
+    if transaction_days:
+        transactions = read_transactions(spark, cleansing, transaction_days)
+        rollups['category_sales_daily'] = category_sales_daily(transactions)
+        rollups['product_sales_daily'] = product_sales_daily(transactions)
+    if touched_days:
+        browsing = spark.read.parquet(f"s3a://{destination_bucket}/{browsing_prefix}").filter(col("ds").isin(touched_days))
+        rollups['browsing_activity_daily'] = browsing_activity_daily(browsing)
+    combined_path = f"s3a://{destination_bucket}/{cleansing.COMBINED_PREFIX}"
+    if combined_days is None:
+        combined_days = [day for day in touched_days if cleansing.prefix_size(f"{combined_path}ds={day.isoformat()}/")]
+    if combined_days:
+        combined = spark.read.parquet(combined_path).filter(col("ds").isin(combined_days))
+        rollups['browse_to_purchase_daily'] = browse_to_purchase_daily(combined)
+    for name, rollup_df in rollups.items():
+        write_rollup(cleansing, rollup_df, destination_bucket, name)
+    if watermark:
+        # Written after the rollups, a failed run reads the same files again
+        cleansing.write_watermark(destination_bucket, TRANSACTION_WATERMARK_KEY, watermark)
+    if rollups:
+        logging.info(f"Updated {', '.join(rollups)} for {len(touched_days)} browsing and {len(transaction_days)} transaction ds partitions")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the curated rollup tables for a range of ds partitions.')
+    parser.add_argument('--from-date', type=date.fromisoformat, required=True, help='First ds to rebuild, YYYY-MM-DD')
+    parser.add_argument('--to-date', type=date.fromisoformat, help='Last ds to rebuild, defaults to --from-date')
+    parser.add_argument('--browsing-prefix', default='browsing/', help='Browsing table prefix in DESTINATION_BUCKET')
+    args = parser.parse_args()
+
+    # Imported only when run on its own, the cleansing job passes itself to update_rollups
+    import spark_data_cleansing_from_raw_ecommerce as cleansing
+
+    check_environment_variables()
+    last_day = args.to_date or args.from_date
+    days = [args.from_date + timedelta(days=offset) for offset in range((last_day - args.from_date).days + 1)]
+    spark = cleansing.build_spark_session()
+    try:
+        update_rollups(spark, cleansing, os.getenv('DESTINATION_BUCKET'), args.browsing_prefix, days, days)
+    finally:
+        spark.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+CREATE TABLE IF NOT EXISTS "ecommerce_broswer_logs"."browsing".combined_browsing_transactions_partitioned (
+    ip VARCHAR,
+    ts TIMESTAMP,
+    tz VARCHAR,
+    verb VARCHAR,
+    resource_type VARCHAR,
+    resource_fk VARCHAR,
+    response INTEGER,
+    browser VARCHAR,
+    os VARCHAR,
+    customer BIGINT,
+    d_day_name VARCHAR,
+    i_current_price DOUBLE,
+    i_category VARCHAR,
+    i_description VARCHAR,
+    c_preferred_cust_flag BOOLEAN,
+    transaction_id VARCHAR,
+    item_description VARCHAR,
+    category VARCHAR,
+    quantity INTEGER,
+    total_amount DOUBLE,
+    credit_card_number VARCHAR,
+    transaction_date TIMESTAMP,
+    ds DATE
+) 
+WITH (
+    format = 'Parquet',
+    external_location = 's3a://ecommlogs/combined_browsing_transactions/',
+    partitioned_by = ARRAY['ds']
+);
+
+CALL ecommerce_broswer_logs.system.sync_partition_metadata(schema_name => 'browsing', table_name => 'combined_browsing_transactions_partitioned', mode => 'ADD');
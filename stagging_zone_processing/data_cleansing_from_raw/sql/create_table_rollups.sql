@@ -0,0 +1,58 @@
+CREATE TABLE IF NOT EXISTS "ecommerce_broswer_logs"."browsing".category_sales_daily (
+    category VARCHAR,
+    total_sales DOUBLE,
+    units_sold BIGINT,
+    transactions BIGINT,
+    ds DATE
+) 
+WITH (
+    format = 'Parquet',
+    external_location = 's3a://ecommlogs/rollups/category_sales_daily/',
+    partitioned_by = ARRAY['ds']
+);
+
+CREATE TABLE IF NOT EXISTS "ecommerce_broswer_logs"."browsing".product_sales_daily (
+    item_id VARCHAR,
+    item_description VARCHAR,
+    category VARCHAR,
+    purchase_count BIGINT,
+    units_sold BIGINT,
+    revenue DOUBLE,
+    ds DATE
+) 
+WITH (
+    format = 'Parquet',
+    external_location = 's3a://ecommlogs/rollups/product_sales_daily/',
+    partitioned_by = ARRAY['ds']
+);
+
+CREATE TABLE IF NOT EXISTS "ecommerce_broswer_logs"."browsing".browsing_activity_daily (
+    i_category VARCHAR,
+    resource_type VARCHAR,
+    views BIGINT,
+    customers BIGINT,
+    ds DATE
+) 
+WITH (
+    format = 'Parquet',
+    external_location = 's3a://ecommlogs/rollups/browsing_activity_daily/',
+    partitioned_by = ARRAY['ds']
+);
+
+CREATE TABLE IF NOT EXISTS "ecommerce_broswer_logs"."browsing".browse_to_purchase_daily (
+    category VARCHAR,
+    lag_seconds BIGINT,
+    purchases BIGINT,
+    customers BIGINT,
+    ds DATE
+) 
+WITH (
+    format = 'Parquet',
+    external_location = 's3a://ecommlogs/rollups/browse_to_purchase_daily/',
+    partitioned_by = ARRAY['ds']
+);
+
+CALL ecommerce_broswer_logs.system.sync_partition_metadata(schema_name => 'browsing', table_name => 'category_sales_daily', mode => 'ADD');
+CALL ecommerce_broswer_logs.system.sync_partition_metadata(schema_name => 'browsing', table_name => 'product_sales_daily', mode => 'ADD');
+CALL ecommerce_broswer_logs.system.sync_partition_metadata(schema_name => 'browsing', table_name => 'browsing_activity_daily', mode => 'ADD');
+CALL ecommerce_broswer_logs.system.sync_partition_metadata(schema_name => 'browsing', table_name => 'browse_to_purchase_daily', mode => 'ADD');
@@ -0,0 +1,35 @@
+Superset dashboards read the rollups instead of the transactions and browsing tables, so each chart scans one small
+row set per day of its time range.
+
+Aggregate Total Sales by Product Category:
+SELECT category, SUM(total_sales) AS total_sales
+FROM category_sales_daily
+WHERE ds BETWEEN DATE '2024-01-01' AND DATE '2024-01-31'
+GROUP BY category;
+
+Find Top 5 Most Frequently Purchased Products:
+SELECT item_id, item_description, SUM(purchase_count) AS purchase_count
+FROM product_sales_daily
+WHERE ds BETWEEN DATE '2024-01-01' AND DATE '2024-01-31'
+GROUP BY item_id, item_description
+ORDER BY purchase_count DESC
+LIMIT 5;
+
+Sales Trends Over Time (Daily):
+SELECT ds, SUM(total_sales) AS daily_sales, SUM(transactions) AS transactions
+FROM category_sales_daily
+GROUP BY ds
+ORDER BY ds;
+
+Page Views by Item Category:
+SELECT i_category, SUM(views) AS views
+FROM browsing_activity_daily
+WHERE ds BETWEEN DATE '2024-01-01' AND DATE '2024-01-31'
+GROUP BY i_category
+ORDER BY views DESC;
+
+Analyze Time Lag Between Browsing and Purchasing:
+SELECT category, SUM(lag_seconds) / SUM(purchases) AS avg_lag_seconds
+FROM browse_to_purchase_daily
+WHERE ds BETWEEN DATE '2024-01-01' AND DATE '2024-01-31'
+GROUP BY category;
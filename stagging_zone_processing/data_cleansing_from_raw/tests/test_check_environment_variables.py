@@ -0,0 +1,43 @@
+import os
+import sys
+import pytest
+
+pytest.importorskip('pyspark')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import spark_data_cleansing_from_raw_ecommerce as cleansing
+
+REQUIRED_VARS = [
+    'AWS_REGION', 'S3_ENDPOINT', 'SOURCE_BUCKET', 'DESTINATION_BUCKET',
+    'SOURCE_ROLE_ARN', 'AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY',
+    'SPARK_MASTER_URL', 'STS_ENDPOINT', 'STS_REGION', 'SESSION_DURATION',
+    'SPARK_DRIVER_HOST'
+]
+
+
+@pytest.fixture
+def environment(monkeypatch):
+    for var in REQUIRED_VARS:
+        monkeypatch.setenv(var, 'x')
+    monkeypatch.setattr(cleansing, 'RUN_MODE', 'service')
+    monkeypatch.setattr(cleansing, 'OUTPUT_COMMITTER', 'file')
+    return monkeypatch
+
+
+def test_service_rejects_full_write_mode(environment):
+    environment.setattr(cleansing, 'WRITE_MODE', 'full')
+    with pytest.raises(SystemExit):
+        cleansing.check_environment_variables()
+
+
+@pytest.mark.parametrize('write_mode', ['incremental', 'append'])
+def test_service_accepts_partition_write_modes(environment, write_mode):
+    environment.setattr(cleansing, 'WRITE_MODE', write_mode)
+    cleansing.check_environment_variables()
+
+
+def test_single_run_accepts_full_write_mode(environment):
+    environment.setattr(cleansing, 'RUN_MODE', 'single')
+    environment.setattr(cleansing, 'WRITE_MODE', 'full')
+    environment.setenv('S3_OBJECT_KEY', 'key')
+    cleansing.check_environment_variables()